@@ -0,0 +1,94 @@
+# Description
+'''
+Adaptive Supersampling
+
+After the first pass (one Ray through each pixel) only pixels differing from a neighbour by
+more than a threshold get extra jittered samples. Sampling of a pixel stops as soon as the
+standard error of its mean Color is small enough or max_samples are taken.
+The jitter of a sample only depends on its pixel and number (see jitter), so every backend,
+Tile size and Process count takes the same samples.
+'''
+
+# Imports
+import numpy
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+AA_MAX_SAMPLES = 16         # max. samples per pixel (incl. the first pass)
+AA_THRESHOLD = 24           # max. channel difference to a neighbour before a pixel is refined
+AA_TOLERANCE = 2.0          # standard error (0..255 scale) at which a pixel counts as converged
+AA_BATCH = 4                # samples added to every unconverged pixel per round
+
+
+# -----  Detection  ------------------------------------------------------------------------------------ #
+
+def edges(pixels, threshold=AA_THRESHOLD):
+    ''' (h,w) bool mask of pixels differing from their right or lower neighbour (both are marked) '''
+    pixels = numpy.asarray(pixels, dtype=numpy.int16)
+    mask = numpy.zeros(pixels.shape[:2], dtype=bool)
+    horizontal = numpy.abs(pixels[:, 1:] - pixels[:, :-1]).max(axis=2) > threshold
+    vertical = numpy.abs(pixels[1:] - pixels[:-1]).max(axis=2) > threshold
+    mask[:, 1:] |= horizontal
+    mask[:, :-1] |= horizontal
+    mask[1:] |= vertical
+    mask[:-1] |= vertical
+    return mask
+
+def refine_tasks(pixels, tiles, threshold=AA_THRESHOLD):
+    ''' Lense.compute_tile tasks supersampling the edge pixels of each Tile (Tiles without edges are left out)
+
+        Edges are detected Tile by Tile (plus a one pixel border), so only one Tile of pixels
+        is read at a time, even from a memory mapped Framebuffer. '''
+    height, width = pixels.shape[:2]
+    tasks = []
+    for x0, y0, x1, y1 in tiles:
+        left, top = max(x0 - 1, 0), max(y0 - 1, 0)
+        mask = edges(pixels[top:min(y1 + 1, height), left:min(x1 + 1, width)], threshold)
+        ys, xs = numpy.nonzero(mask[y0 - top:y1 - top, x0 - left:x1 - left])
+        if len(xs):
+            tasks.append((x0, y0, x1, y1, 1, 0, (xs + x0, ys + y0)))
+    return tasks
+
+
+# -----  Sampling  ------------------------------------------------------------------------------------- #
+
+def mix(z):
+    ''' splitmix64 finalizer of a uint64 array '''
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return z ^ (z >> numpy.uint64(31))
+
+def jitter(xs, ys, samples):
+    ''' (n,2) offsets in [-0.5, 0.5) of sample samples[i] of the pixels (xs[i], ys[i]) '''
+    pixels = mix((numpy.asarray(ys, dtype=numpy.uint64) << numpy.uint64(32)) + numpy.asarray(xs, dtype=numpy.uint64))
+    keys = pixels[:, None] ^ (numpy.asarray(samples, dtype=numpy.uint64)[:, None] * numpy.uint64(2) + numpy.arange(2, dtype=numpy.uint64))
+    return (mix(keys) >> numpy.uint64(11)) * 2.0**-53 - 0.5
+
+def supersample(shade, first, xs, ys, max_samples=AA_MAX_SAMPLES, tolerance=AA_TOLERANCE, batch=AA_BATCH):
+    ''' Mean Colors (n,3) and sample counts of the pixels (xs[i], ys[i])
+
+        shade(xs, ys) returns the (n,3) float Colors of Rays through (fractional) pixel coordinates,
+        first are the Colors of the first pass. '''
+    first = numpy.asarray(first, dtype=float)
+    total, squares = first.copy(), first**2
+    counts = numpy.ones(len(xs), dtype=int)
+    active = numpy.arange(len(xs))
+    while len(active):
+        n = min(batch, max_samples - int(counts[active].min()))
+        if n <= 0:
+            break
+        samples = (counts[active][:, None] + numpy.arange(n)).ravel()
+        offsets = jitter(numpy.repeat(xs[active], n), numpy.repeat(ys[active], n), samples)
+        sx = numpy.repeat(xs[active], n) + offsets[:, 0]
+        sy = numpy.repeat(ys[active], n) + offsets[:, 1]
+        colors = numpy.asarray(shade(sx, sy), dtype=float).reshape(len(active), n, 3)
+        total[active] += colors.sum(axis=1)
+        squares[active] += (colors**2).sum(axis=1)
+        counts[active] += n
+
+        c = counts[active][:, None]
+        variance = numpy.maximum(squares[active]/c - (total[active]/c)**2, 0)
+        error = numpy.sqrt(variance / c).max(axis=1)
+        active = active[(error > tolerance) & (counts[active] < max_samples)]
+    return total / counts[:, None], counts
@@ -0,0 +1,269 @@
+# Description
+'''
+Render Benchmark
+
+Renders the built-in Scenes (camera.build_scenes, sc1 is the squirrel mesh) and 'mesh' (a
+sphere of MESH_FACES triangles, see mesh_scene) at fixed resolutions and reports primary rays
+per second, the time spent per phase (ray generation, intersection, shading, saving) and the
+scaling over 1..N worker Processes.
+Results are written as JSON and can be compared against a stored baseline of the same
+backend, depth and resolutions (other configurations are refused):
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --backend numpy
+'''
+
+# Imports
+import argparse, contextlib, io, json, os, platform, sys, tempfile, time
+import multiprocessing
+import numpy
+from PIL import Image
+import camera, packet, kernels
+from elements import TriangleMesh, Plane, Point, Vector, Color, Texture, Checkerboard, Material
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+RESOLUTIONS = {'sc0': (160, 96), 'sc1': (64, 64), 'sc2': (160, 96), 'sc3': (160, 96), 'sc4': (160, 96), 'mesh': (64, 48)}
+MESH_FACES = 20000          # triangles of the 'mesh' Scene (rounded to a UV sphere)
+TOLERANCE = 0.1             # relative rays/s loss reported as regression
+CONFIGURATION = ('backend', 'recursion_depth', 'numba')    # meta entries that must match the baseline
+REPEAT = 1                  # best of REPEAT runs is reported
+
+
+# -----  Scenes  --------------------------------------------------------------------------------------- #
+
+def mesh_scene(lense, lights, faces=MESH_FACES):
+    ''' (Lense, Scene) of a bumpy UV sphere TriangleMesh with about faces triangles over a Plane '''
+    n = max(2, int(round((faces / 4) ** 0.5)))                               # 2n x n quads
+    theta, phi = numpy.meshgrid(numpy.linspace(0, numpy.pi, n + 1), numpy.linspace(0, 2*numpy.pi, 2*n + 1), indexing='ij')
+    radius = 4 * (1 + 0.05*numpy.sin(7*theta)*numpy.cos(5*phi))
+    vertices = numpy.stack([numpy.sin(theta)*numpy.cos(phi), numpy.cos(theta), numpy.sin(theta)*numpy.sin(phi)], axis=-1)
+    vertices = (vertices * radius[..., None] + (0, 4, -12)).reshape(-1, 3)
+    i, j = numpy.meshgrid(numpy.arange(n), numpy.arange(2*n), indexing='ij')
+    a = (i * (2*n + 1) + j).ravel()
+    b, c = a + 1, a + 2*n + 1
+    triangles = numpy.concatenate([numpy.stack([a, c, b], axis=1), numpy.stack([b, c, c + 1], axis=1)])
+    mesh = TriangleMesh(vertices, triangles, Texture(Color(200, 100, 50), Material(1.0, 0.5, 0.5, 0.5, 5.0)))
+    plane = Plane(Point(0, 0, 0), Vector(0, 1, 0), Checkerboard(Color(150, 150, 150), Color(0, 0, 0), Material(1.0, 0.2, 0.7, 0.5, 5.0), 2.0))
+    return lense, camera.Scene([mesh, plane], lights, 0.4)
+
+def build_scenes():
+    ''' camera.build_scenes and 'mesh' (see mesh_scene) '''
+    scenes = camera.build_scenes()
+    lense, scene = scenes['sc1']
+    scenes['mesh'] = mesh_scene(lense, scene.lights)
+    return scenes
+
+
+# -----  Measuring  ------------------------------------------------------------------------------------ #
+
+def best_time(function, repeat):
+    ''' Shortest wall time of repeat calls of function '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def phase_times(lense, scene, resolution, backend, depth=camera.RECURSION_DEPTH):
+    ''' Seconds per phase rendering resolution in this Process
+
+        Shading is the full trace (incl. shadow and reflected Rays) minus the primary intersection.
+        The numba kernels render in one piece, only 'render' and 'save' are reported for them. '''
+    width, height = resolution
+    with contextlib.redirect_stdout(io.StringIO()):
+        lense.prepare(scene, {'width': width, 'height': height}, backend, depth=depth)
+    xs, ys = numpy.meshgrid(numpy.arange(width), numpy.arange(height))
+    xs, ys = xs.ravel(), ys.ravel()
+    phases = {}
+
+    start = time.perf_counter()
+    if lense.backend == 'python':
+        rays = [lense.compute_ray(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+        phases['ray_generation'] = time.perf_counter() - start
+        bvh = scene.get_bvh()
+        start = time.perf_counter()
+        for ray in rays:
+            bvh.closest_hit(ray)
+        phases['intersection'] = time.perf_counter() - start
+        start = time.perf_counter()
+        colors = numpy.array([lense.trace(ray).values for ray in rays], dtype=numpy.uint8)
+        render = time.perf_counter() - start
+    elif lense.backend == 'numpy':
+        origins, directions = packet.camera_rays(lense, xs, ys)
+        phases['ray_generation'] = time.perf_counter() - start
+        start = time.perf_counter()
+        packet.closest_hits(scene, origins, directions)
+        phases['intersection'] = time.perf_counter() - start
+        start = time.perf_counter()
+        colors = packet.trace(scene, origins, directions, lense.depth, min_contribution=lense.min_contribution).astype(numpy.uint8)
+        render = time.perf_counter() - start
+    else:
+        kernels.render_tile(lense, 0, 0, width, height, lense.depth)      # compile (or load from cache) first
+        start = time.perf_counter()
+        colors = kernels.render_tile(lense, 0, 0, width, height, lense.depth)
+        phases['render'] = time.perf_counter() - start
+
+    if 'intersection' in phases:
+        phases['shading'] = max(0.0, render - phases['intersection'])
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        Image.fromarray(colors.reshape(height, width, 3), 'RGB').save(os.path.join(directory, 'phase.png'))
+        phases['save'] = time.perf_counter() - start
+    return phases
+
+def scaling(lense, scene, resolution, backend, processes, repeat, depth=camera.RECURSION_DEPTH):
+    ''' End-to-end Lense.capture timings {processes: {...}} for each count in processes '''
+    width, height = resolution
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'capture.png')
+        for count in processes:
+            def capture():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lense.capture(scene, {'width': width, 'height': height}, filename, backend, count, depth=depth)
+            seconds = best_time(capture, repeat)
+            results[count] = {'seconds': seconds, 'rays_per_second': width * height / seconds}
+    first = results[processes[0]]['seconds']
+    for count, result in results.items():
+        result['speedup'] = first / result['seconds']
+        result['efficiency'] = result['speedup'] * processes[0] / count
+    return results
+
+def run(names, backend, processes, repeat, depth=camera.RECURSION_DEPTH):
+    ''' Benchmarks the Scenes names, returns the JSON-ready report '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        scenes = build_scenes()
+    report = {'meta': meta(backend, depth), 'scenes': {}}
+    for name in names:
+        lense, scene = scenes[name]
+        resolution = RESOLUTIONS[name]
+        print('|-- %s (%d x %d)' %(name, resolution[0], resolution[1]))
+        report['scenes'][name] = {
+            'resolution': list(resolution),
+            'barriers': len(scene.barriers),
+            'phases': phase_times(lense, scene, resolution, backend, depth),
+            'scaling': dict((str(count), result) for count, result in scaling(lense, scene, resolution, backend, processes, repeat, depth).items()),
+        }
+    return report
+
+def meta(backend, depth=camera.RECURSION_DEPTH):
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backend': backend,
+        'numba': kernels.available(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'recursion_depth': depth,
+    }
+
+
+# -----  Reporting  ------------------------------------------------------------------------------------ #
+
+def print_report(report):
+    for name, result in report['scenes'].items():
+        phases = ', '.join('%s %.3fs' %(phase, seconds) for phase, seconds in result['phases'].items())
+        print('%s  %d x %d  %s' %(name, result['resolution'][0], result['resolution'][1], phases))
+        for count, timing in result['scaling'].items():
+            print('    %3s processes  %8.3fs  %12.0f rays/s  speedup %5.2f  efficiency %4.0f%%'
+                  %(count, timing['seconds'], timing['rays_per_second'], timing['speedup'], timing['efficiency']*100))
+
+def configuration(report):
+    ''' Human readable configuration of a report '''
+    return ', '.join('%s %s' %(key, report.get('meta', {}).get(key)) for key in CONFIGURATION)
+
+def mismatches(report, baseline):
+    ''' (what, baseline value, value) for every configuration difference making the timings incomparable '''
+    result = []
+    for key in CONFIGURATION:
+        old, new = baseline.get('meta', {}).get(key), report['meta'].get(key)
+        if old != new:
+            result.append((key, old, new))
+    for name, scene in report['scenes'].items():
+        old = baseline.get('scenes', {}).get(name)
+        if old is not None and old['resolution'] != scene['resolution']:
+            result.append(('%s resolution' %(name), 'x'.join(map(str, old['resolution'])), 'x'.join(map(str, scene['resolution']))))
+    return result
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    ''' (scene, processes, baseline rays/s, rays/s) for every run slower than baseline by more than tolerance
+
+        Raises a ValueError if the configurations differ (see mismatches). '''
+    different = mismatches(report, baseline)
+    if different:
+        raise ValueError('configuration differs from the baseline: %s' %(', '.join('%s %s -> %s' %(item) for item in different)))
+    regressions = []
+    for name, result in report['scenes'].items():
+        old = baseline.get('scenes', {}).get(name)
+        if old is None:
+            continue
+        for count, timing in result['scaling'].items():
+            if count in old['scaling']:
+                before = old['scaling'][count]['rays_per_second']
+                if timing['rays_per_second'] < before * (1 - tolerance):
+                    regressions.append((name, count, before, timing['rays_per_second']))
+    return regressions
+
+
+# -----  Main  ----------------------------------------------------------------------------------------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks rendering of the built-in Scenes')
+    parser.add_argument('--scenes', default=','.join(sorted(RESOLUTIONS)), help='comma separated Scene names (default: all)')
+    parser.add_argument('--backend', default='python', choices=['python', 'numpy', 'numba'])
+    parser.add_argument('--processes', default=None, help='comma separated Process counts (default: 1, 2, 4 .. cpu count)')
+    parser.add_argument('--depth', type=int, default=camera.RECURSION_DEPTH, help='reflection depth (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='report the best of REPEAT runs')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative rays/s loss (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.scenes.split(',') if name]
+    unknown = [name for name in names if name not in RESOLUTIONS]
+    if unknown:
+        parser.error('unknown scenes: %s' %(', '.join(unknown)))
+    if args.processes:
+        processes = [int(count) for count in args.processes.split(',')]
+    else:
+        processes = [1]
+        while processes[-1] * 2 <= multiprocessing.cpu_count():
+            processes.append(processes[-1] * 2)
+        if processes[-1] != multiprocessing.cpu_count():
+            processes.append(multiprocessing.cpu_count())
+
+    report = run(names, args.backend, processes, args.repeat, args.depth)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('|-- Results written to %s' %(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print('|-- Baseline: %s' %(configuration(baseline)))
+        print('|-- This run: %s' %(configuration(report)))
+        different = mismatches(report, baseline)
+        for key, old, new in different:
+            print('CONFIGURATION MISMATCH %s: %s in the baseline, %s now' %(key, old, new))
+        if different:
+            print('|-- Not comparing against %s' %(args.baseline))
+            return 2
+        regressions = compare(report, baseline, args.tolerance)
+        for name, count, before, after in regressions:
+            print('REGRESSION %s with %s processes: %.0f -> %.0f rays/s (%+.1f%%)' %(name, count, before, after, (after/before - 1)*100))
+        if regressions:
+            return 1
+        print('|-- No regressions against %s' %(args.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
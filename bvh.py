@@ -0,0 +1,404 @@
+# Description
+'''
+Bounding Volume Hierarchy for Barriers
+'''
+
+# Imports
+import math, numpy
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+LEAF_SIZE = 4               # max. Barriers per Leaf
+BIN_COUNT = 12              # SAH Bins per Axis
+TRAVERSAL_COST = 1.0        # SAH cost of visiting a Node (relative to one intersection test)
+BOUNDS_EPSILON = 1e-7       # Padding so Hits on the Surface are never culled by rounding
+REBUILD_FACTOR = 2.0        # refit() asks for a rebuild once the root surface grew by this factor
+SAH_LIMIT = 1024            # more Barriers are built in Morton order (see build_morton)
+MORTON_BITS = 10            # grid resolution per axis of the Morton codes
+PACKET_ITEMS = 64           # Ray packets test subtrees with at most this many Barriers as a whole
+
+
+# -----  BVH  ------------------------------------------------------------------------------------------ #
+
+class BVH():
+    ''' Bounding Volume Hierarchy over all bounded Barriers of a Scene (binned SAH splits)
+
+        Barriers without bounds (e.g. Plane) are kept in a separate list and tested linearly.
+        Ties between equal distances are resolved by the Barrier index in the Scene, exactly
+        like the linear loop in Lense.trace did.
+        boxes (lower, upper) are (n,3) arrays with the bounds of all n barriers when they are
+        known already (e.g. the faces of a TriangleMesh, barriers can then be any sequence). '''
+    def __init__(self, barriers, leaf_size=LEAF_SIZE, bin_count=BIN_COUNT, boxes=None):
+        self.leaf_size = leaf_size
+        self.bin_count = bin_count
+        self.unbounded = []                                                     # [(index, Barrier)]
+        self.items = []                                                         # [(index, Barrier)] in Leaf order
+        self.nodes = []                                                         # [[lo, hi, axis, left|start, right|count, is_leaf]]
+
+        if boxes is not None:
+            entries = list(enumerate(barriers))
+            self.lower, self.upper = numpy.asarray(boxes[0], dtype=float), numpy.asarray(boxes[1], dtype=float)
+        else:
+            bounded = []
+            for i, b in enumerate(barriers):
+                bounds = b.bounds()
+                if bounds is None:
+                    self.unbounded.append((i, b))
+                else:
+                    bounded.append((i, b, bounds))
+            entries = [(i, b) for i, b, bounds in bounded]
+            if bounded:
+                self.lower = numpy.array([bounds[0].values for i, b, bounds in bounded], dtype=float)
+                self.upper = numpy.array([bounds[1].values for i, b, bounds in bounded], dtype=float)
+
+        if len(entries) > SAH_LIMIT:
+            self.build_morton(entries)
+        elif entries:
+            self.build(entries)
+        self.positions = dict((index, pos) for pos, (index, b) in enumerate(self.items))
+        self.ranges = item_ranges(self.nodes)                                   # (first, count) of the items below each Node
+        self.root_area = surface_areas(numpy.array(self.nodes[0][0]), numpy.array(self.nodes[0][1])) if self.nodes else 0.0
+
+    def __repr__(self):
+        return 'BVH(%d nodes, %d barriers, %d unbounded)' %(len(self.nodes), len(self.items), len(self.unbounded))
+
+    # -----  Build  ----- #
+
+    def build(self, entries):
+        ''' Builds the Node list top-down, splitting on the cheapest binned SAH plane '''
+        lower, upper = self.lower, self.upper
+        centroids = (lower + upper) * 0.5
+        order = []                                                              # prim ids in Leaf order
+        stack = [(numpy.arange(len(entries)), None, None)]                      # (prim ids, parent node, side)
+        while stack:
+            ids, parent, side = stack.pop()
+            node = len(self.nodes)
+            if parent is not None:
+                self.nodes[parent][3 + side] = node
+
+            lo, hi = lower[ids].min(axis=0), upper[ids].max(axis=0)
+            lo = lo - BOUNDS_EPSILON * (1 + numpy.abs(lo))
+            hi = hi + BOUNDS_EPSILON * (1 + numpy.abs(hi))
+            split = self.find_split(ids, lower, upper, centroids) if len(ids) > self.leaf_size else None
+
+            if split is None:
+                start = len(self.items)
+                order.extend(sorted(ids))
+                self.items.extend(entries[i] for i in sorted(ids))
+                self.nodes.append([tuple(lo.tolist()), tuple(hi.tolist()), 0, start, len(ids), True])
+            else:
+                axis, left_ids, right_ids = split
+                self.nodes.append([tuple(lo.tolist()), tuple(hi.tolist()), axis, None, None, False])
+                stack.append((right_ids, node, 1))
+                stack.append((left_ids, node, 0))                               # left first -> depth-first layout
+
+        # freeze to tuples for fast attribute-free access while tracing
+        self.nodes = [tuple(n) for n in self.nodes]
+        self.lower, self.upper = lower[order], upper[order]                    # bounds in Leaf order (for refit)
+
+    def build_morton(self, entries):
+        ''' Builds the Node list from the Barriers sorted along a Morton curve of their centers
+
+            Leaves take leaf_size neighbours on the curve, inner Nodes halve their range of Leaves.
+            Worse trees than build, but with a few NumPy passes instead of a SAH search per Node. '''
+        lower, upper = self.lower, self.upper
+        centroids = (lower + upper) * 0.5
+        c_min, c_max = centroids.min(axis=0), centroids.max(axis=0)
+        scale = ((1 << MORTON_BITS) - 1) / numpy.where(c_max > c_min, c_max - c_min, 1.0)
+        cells = ((centroids - c_min) * scale).astype(numpy.int64)
+        codes = numpy.zeros(len(entries), dtype=numpy.int64)
+        for bit in range(MORTON_BITS):
+            for axis in range(3):
+                codes |= ((cells[:, axis] >> bit) & 1) << (3*bit + 2 - axis)
+        order = numpy.argsort(codes, kind='stable')
+
+        # Nodes in depth-first order, each covering the Barriers [first, last) in Morton order
+        leaves = -(-len(entries) // self.leaf_size)
+        ranges, stack = [], [(0, leaves, None, None)]                           # (Leaf range, parent node, side)
+        while stack:
+            l0, l1, parent, side = stack.pop()
+            node = len(self.nodes)
+            if parent is not None:
+                self.nodes[parent][3 + side] = node
+            first, last = l0 * self.leaf_size, min(l1 * self.leaf_size, len(entries))
+            ranges.append((first, last))
+            if l1 - l0 == 1:
+                self.nodes.append([None, None, 0, first, last - first, True])
+            else:
+                middle = (l0 + l1) // 2
+                self.nodes.append([None, None, 0, None, None, False])
+                stack.append((middle, l1, node, 1))
+                stack.append((l0, middle, node, 0))
+
+        # bounds of all Nodes at once: reduce over [first, last), padded so last is a valid index
+        self.lower, self.upper = lower[order], upper[order]
+        ranges = numpy.array(ranges, dtype=numpy.int64).ravel()
+        lo = numpy.minimum.reduceat(numpy.vstack([self.lower, self.lower[:1]]), ranges)[::2]
+        hi = numpy.maximum.reduceat(numpy.vstack([self.upper, self.upper[:1]]), ranges)[::2]
+        axes = numpy.argmax(hi - lo, axis=1)                                    # near child first along the longest axis
+        lo = lo - BOUNDS_EPSILON * (1 + numpy.abs(lo))
+        hi = hi + BOUNDS_EPSILON * (1 + numpy.abs(hi))
+        for node, (l, h, axis) in enumerate(zip(lo.tolist(), hi.tolist(), axes.tolist())):
+            n = self.nodes[node]
+            self.nodes[node] = (tuple(l), tuple(h), axis, n[3], n[4], n[5])
+        self.items = [entries[i] for i in order.tolist()]
+
+    def refit(self, changes):
+        ''' Puts moved Barriers {scene index: Barrier} into the tree and recomputes the Node bounds
+            bottom-up without changing the topology. Returns False if the tree should be rebuilt
+            instead (a Barrier changed between bounded and unbounded or the tree degraded). '''
+        unbounded = dict(self.unbounded)
+        for index, barrier in changes.items():
+            bounds = barrier.bounds()
+            if index in self.positions and bounds is not None:
+                pos = self.positions[index]
+                self.items[pos] = (index, barrier)
+                self.lower[pos], self.upper[pos] = bounds[0].values, bounds[1].values
+            elif index in unbounded and bounds is None:
+                unbounded[index] = barrier
+            else:
+                return False
+        self.unbounded = sorted(unbounded.items(), key=lambda item: item[0])
+
+        # children always follow their parent in the depth-first layout
+        boxes = [None] * len(self.nodes)
+        for node in range(len(self.nodes) - 1, -1, -1):
+            lo, hi, axis, a, b, leaf = self.nodes[node]
+            if leaf:
+                lo, hi = self.lower[a:a + b].min(axis=0), self.upper[a:a + b].max(axis=0)
+                boxes[node] = (lo, hi)
+            else:
+                lo = numpy.minimum(boxes[a][0], boxes[b][0])
+                hi = numpy.maximum(boxes[a][1], boxes[b][1])
+                boxes[node] = (lo, hi)
+            padded_lo = lo - BOUNDS_EPSILON * (1 + numpy.abs(lo))
+            padded_hi = hi + BOUNDS_EPSILON * (1 + numpy.abs(hi))
+            self.nodes[node] = (tuple(padded_lo.tolist()), tuple(padded_hi.tolist()), axis, a, b, leaf)
+
+        return not self.nodes or surface_areas(*boxes[0]) <= REBUILD_FACTOR * self.root_area
+
+    def find_split(self, ids, lower, upper, centroids):
+        ''' Returns (axis, left ids, right ids) of the cheapest SAH split or None if a Leaf is cheaper '''
+        c = centroids[ids]
+        c_min, c_max = c.min(axis=0), c.max(axis=0)
+        best_cost = len(ids)                                                    # cost of not splitting
+        best = None
+        parent_area = surface_areas(lower[ids].min(axis=0), upper[ids].max(axis=0))
+        if parent_area <= 0:
+            return None
+
+        for axis in range(3):
+            extent = c_max[axis] - c_min[axis]
+            if extent <= 0:
+                continue
+            bins = numpy.minimum(((c[:, axis] - c_min[axis]) / extent * self.bin_count).astype(int), self.bin_count - 1)
+
+            counts = numpy.bincount(bins, minlength=self.bin_count)
+            bin_lo = numpy.full((self.bin_count, 3), math.inf)
+            bin_hi = numpy.full((self.bin_count, 3), -math.inf)
+            numpy.minimum.at(bin_lo, bins, lower[ids])
+            numpy.maximum.at(bin_hi, bins, upper[ids])
+
+            # sweep from both sides accumulating bounds and surface areas
+            areas_l = surface_areas(numpy.minimum.accumulate(bin_lo)[:-1], numpy.maximum.accumulate(bin_hi)[:-1])
+            areas_r = surface_areas(numpy.minimum.accumulate(bin_lo[::-1])[::-1][1:], numpy.maximum.accumulate(bin_hi[::-1])[::-1][1:])
+
+            left_counts = numpy.cumsum(counts)[:-1]
+            right_counts = len(ids) - left_counts
+            with numpy.errstate(invalid='ignore'):                              # empty sides are inf * 0
+                costs = TRAVERSAL_COST + (areas_l * left_counts + areas_r * right_counts) / parent_area
+            costs[(left_counts == 0) | (right_counts == 0)] = math.inf
+
+            k = int(numpy.argmin(costs))
+            if costs[k] < best_cost:
+                best_cost = costs[k]
+                best = (axis, ids[bins <= k], ids[bins > k])
+
+        return best
+
+    # -----  Traversal  ----- #
+
+    def closest_hit(self, ray, stats=None):
+        ''' Returns (distance, Barrier, face) of the closest positive Intersection or (inf, None, -1)
+
+            face is the hit face of the Barrier (see Barrier.intersectionFace).
+            stats (profiling.RenderStats) counts Node visits, tests and the hit Barrier '''
+        closest_d = math.inf
+        closest_b = None
+        closest_i = math.inf
+        closest_f = -1
+
+        for i, b in self.unbounded:
+            dist, face = b.intersectionFace(ray) if stats is None else stats.intersect(i, b.intersectionFace, ray)
+            if dist and dist > 0 and (dist < closest_d or (dist == closest_d and i < closest_i)):
+                closest_d, closest_b, closest_i, closest_f = dist, b, i, face
+
+        if not self.nodes:
+            if stats is not None and closest_b is not None:
+                stats.hits[closest_i] += 1
+            return closest_d, closest_b, closest_f
+
+        o, d = ray.origin, ray.direction
+        ox, oy, oz = o.x, o.y, o.z
+        dx, dy, dz = d.x, d.y, d.z
+        ix, iy, iz = inverse(dx), inverse(dy), inverse(dz)
+        negative = (dx < 0, dy < 0, dz < 0)
+        nodes, items = self.nodes, self.items
+
+        stack = [0]
+        while stack:
+            lo, hi, axis, a, b, leaf = nodes[stack.pop()]
+            if stats is not None:
+                stats.node_tests += 1
+            tmin = slab_entry(lo, hi, ox, oy, oz, ix, iy, iz, closest_d)
+            if tmin is None:
+                continue
+            if leaf:
+                for i, barrier in items[a:a + b]:
+                    dist, face = barrier.intersectionFace(ray) if stats is None else stats.intersect(i, barrier.intersectionFace, ray)
+                    if dist and dist > 0 and (dist < closest_d or (dist == closest_d and i < closest_i)):
+                        closest_d, closest_b, closest_i, closest_f = dist, barrier, i, face
+            elif negative[axis]:                                                # visit near child first
+                stack.append(a)
+                stack.append(b)
+            else:
+                stack.append(b)
+                stack.append(a)
+
+        if stats is not None and closest_b is not None:
+            stats.hits[closest_i] += 1
+        return closest_d, closest_b, closest_f
+
+    def any_hit(self, ray, exclude=None, t_max=math.inf, stats=None, face=-1):
+        ''' Returns the Scene index of the first Barrier hit within (0, t_max) or None
+
+            exclude is the Barrier the Ray starts on (from face), it is only tested for self shadowing.
+            Stops at the first such Barrier, Nodes beyond t_max are never visited. '''
+        for i, b in self.unbounded:
+            if b is exclude:
+                test, args = b.selfIntersectionParameter, (face,)
+            else:
+                test, args = b.intersectionParameter, ()
+            dist = test(ray, *args) if stats is None else stats.intersect(i, test, ray, *args)
+            if dist and 0 < dist < t_max:
+                return i
+
+        if not self.nodes:
+            return None
+
+        o, d = ray.origin, ray.direction
+        ox, oy, oz = o.x, o.y, o.z
+        dx, dy, dz = d.x, d.y, d.z
+        ix, iy, iz = inverse(dx), inverse(dy), inverse(dz)
+        nodes, items = self.nodes, self.items
+
+        stack = [0]
+        while stack:
+            lo, hi, axis, a, b, leaf = nodes[stack.pop()]
+            if stats is not None:
+                stats.node_tests += 1
+            if slab_entry(lo, hi, ox, oy, oz, ix, iy, iz, t_max) is None:
+                continue
+            if leaf:
+                for i, barrier in items[a:a + b]:
+                    if barrier is exclude:
+                        test, args = barrier.selfIntersectionParameter, (face,)
+                    else:
+                        test, args = barrier.intersectionParameter, ()
+                    dist = test(ray, *args) if stats is None else stats.intersect(i, test, ray, *args)
+                    if dist and 0 < dist < t_max:
+                        return i
+            else:
+                stack.append(b)
+                stack.append(a)
+        return None
+
+    def packet_ranges(self, origins, inverses, t_far, items=PACKET_ITEMS):
+        ''' Vectorized traversal for Ray packets (see packet), yields (first, count, rows)
+
+            rows (indices into origins) are the Rays entering a subtree within t_far whose Barriers are
+            self.items[first:first + count]. Subtrees of at most items Barriers (and Leaves) are yielded
+            whole, one NumPy pass over their Barriers beats visiting every Node. t_far is read when a
+            Node is reached, so callers may shorten it in between (below 0 drops a Ray). '''
+        if not self.nodes:
+            return
+        nodes, ranges = self.nodes, self.ranges
+        stack = [(0, numpy.arange(len(inverses)))]
+        while stack:
+            node, rows = stack.pop()
+            lo, hi, axis, a, b, leaf = nodes[node]
+            rows = rows[box_hits(lo, hi, origins[rows], inverses[rows], t_far[rows])]
+            if not len(rows):
+                continue
+            first, count = ranges[node]
+            if leaf or count <= items:
+                yield first, count, rows
+            elif (inverses[rows, axis] < 0).sum() * 2 > len(rows):              # near child first for most Rays
+                stack.append((a, rows))
+                stack.append((b, rows))
+            else:
+                stack.append((b, rows))
+                stack.append((a, rows))
+
+
+# -----  Helpers  -------------------------------------------------------------------------------------- #
+
+def inverse(d):
+    ''' 1/d with an infinite (signed) result for axis-parallel Rays '''
+    if d == 0:
+        return math.inf
+    return 1.0 / d
+
+def slab_entry(lo, hi, ox, oy, oz, ix, iy, iz, t_far):
+    ''' Ray-Box slab test, returns the entry distance or None if the Box is missed within (0, t_far] '''
+    tmin, tmax = 0.0, t_far
+    for o, inv, l, h in ((ox, ix, lo[0], hi[0]), (oy, iy, lo[1], hi[1]), (oz, iz, lo[2], hi[2])):
+        if inv == math.inf:
+            if o < l or o > h:
+                return None
+            continue
+        t0 = (l - o) * inv
+        t1 = (h - o) * inv
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > tmin:
+            tmin = t0
+        if t1 < tmax:
+            tmax = t1
+        if tmin > tmax:
+            return None
+    return tmin
+
+def inverse_rows(directions):
+    ''' inverse for each component of (n,3) Ray directions '''
+    with numpy.errstate(divide='ignore'):
+        return 1.0 / numpy.asarray(directions, dtype=float)
+
+def box_hits(lo, hi, origins, inverses, t_far):
+    ''' slab_entry for (n,3) Rays, True where the Box is entered within (0, t_far]
+
+        Axes the Ray runs parallel to give NaN (0 * inf) on the Box surface and are ignored there. '''
+    with numpy.errstate(invalid='ignore'):
+        t0 = (numpy.asarray(lo) - origins) * inverses
+        t1 = (numpy.asarray(hi) - origins) * inverses
+        near, far = numpy.minimum(t0, t1), numpy.maximum(t0, t1)
+        tmin = numpy.fmax(numpy.fmax(numpy.fmax(near[:, 0], near[:, 1]), near[:, 2]), 0.0)
+        tmax = numpy.fmin(numpy.fmin(numpy.fmin(far[:, 0], far[:, 1]), far[:, 2]), t_far)
+        return tmin <= tmax
+
+def item_ranges(nodes):
+    ''' (first, count) of the items below each Node (a subtree holds a contiguous run of Leaves) '''
+    ranges = [None] * len(nodes)
+    for node in range(len(nodes) - 1, -1, -1):                                  # children follow their parent
+        lo, hi, axis, a, b, leaf = nodes[node]
+        if leaf:
+            ranges[node] = (a, b)
+        else:
+            ranges[node] = (ranges[a][0], ranges[a][1] + ranges[b][1])
+    return ranges
+
+def surface_areas(lo, hi):
+    ''' Surface area of one Box or of each Box in (n,3) corner arrays '''
+    e = hi - lo
+    return 2.0 * (e[..., 0]*e[..., 1] + e[..., 1]*e[..., 2] + e[..., 2]*e[..., 0])
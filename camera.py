@@ -4,15 +4,31 @@ Its a Camera
 '''
 
 # Imports
-import sys, numpy, math, time, random, threading
+import sys, os, numpy, math, time, random, threading
 from multiprocessing import Process, Pool
 import multiprocessing
 from elements import *
+import elements
+from bvh import BVH
+from framebuffer import SharedFramebuffer, DiskFramebuffer
+from writers import write_image, check_streamed
+from scheduler import TileRenderer, tiles, TILE_SIZE
+from profiling import RenderStats, save_heatmap
+from antialiasing import refine_tasks, supersample, AA_THRESHOLD
+from checkpoint import Checkpoint, fingerprint
+from farm import FarmRenderer
+import packet, kernels
 from PIL import Image
 
 # Constants
 RECURSION_DEPTH = 1
+MIN_CONTRIBUTION = 0.5 / 255                                                        # reflections with a smaller share of the pixel are not traced
+ROULETTE_WEIGHT = 0.1                                                               # share below which reflections are continued at random
 PROCESSES_COUNT = multiprocessing.cpu_count()
+PROGRESSIVE_STEPS = (8, 4, 2, 1)                                                    # pixel spacing of the progressive passes
+BATCH_BACKENDS = {'numpy': packet, 'numba': kernels}                                # backends rendering whole tiles at once
+DISK_SUFFIX = '.framebuffer'                                                        # memory mapped image of capture(disk=True)
+CHECKPOINT_SUFFIX = '.checkpoint'                                                   # finished Tiles of capture(checkpoint=True)
 
 __author__ = 'Jan Ningelgen'
 
@@ -25,18 +41,21 @@ __author__ = 'Jan Ningelgen'
 
 class Ray():
     ''' Ray '''
+    __slots__ = ('origin', 'direction')
     def __init__(self, origin, direction):
         self.origin = origin                                                        # Point
         self.direction = direction.normalized()                                     # Vector
-        length = numpy.linalg.norm(self.direction.values)
-        if (length > 1.0001):
-            print('VEKTOR NICHT NORMIERT: ', length)
+        if elements.DEBUG:                                                          # read at runtime, see elements.DEBUG
+            length = self.direction.length()
+            if (length > 1.0001):
+                print('VEKTOR NICHT NORMIERT: ', length)
 
     def __repr__(self):
         return 'Ray(%s, %s)' %(repr(self.origin), repr(self.direction))
 
     def pointAtParameter(self, t):
-        return self.origin + self.direction.scaled(t)
+        o, d = self.origin, self.direction
+        return Point(o.x + d.x*t, o.y + d.y*t, o.z + d.z*t)
 
 
 # -----  Lense  ---------------------------------------------------------------------------------------- #
@@ -61,32 +80,324 @@ class Lense():
 
         self.fow = fow                                                              # angle
         self.pixels = []
+        self.profile = False                                                        # collect RenderStats (see capture)
+        self.stats = None                                                           # RenderStats of the Tile in progress
+        self.random = random.Random()                                               # light sampling, reseeded per Tile
+        self.depth = RECURSION_DEPTH                                                # tracing settings, see prepare
+        self.min_contribution = MIN_CONTRIBUTION
+        self.roulette_weight = 0.0
     
-    def capture(self, scene, resolution, filename='default.png'):
+    def capture(self, scene, resolution, filename='default.png', backend='python', processes=PROCESSES_COUNT, profile=False, heatmap=None,
+                antialias=1, aa_threshold=AA_THRESHOLD, depth=RECURSION_DEPTH, min_contribution=MIN_CONTRIBUTION, roulette=False, disk=False,
+                checkpoint=False, resume=False, farm=None, authkey=None):
+        ''' Renders scene into filename
+
+            backend 'python' (one Ray per pixel), 'numpy' (vectorized Ray packets) or 'numba'
+            (compiled kernels, falls back to 'python' without Numba)
+            With profile (or a heatmap filename) the RenderStats of all Tiles are merged, printed
+            and returned, heatmap gets the time spent per pixel as false color image.
+            With antialias > 1 pixels differing from a neighbour by more than aa_threshold get up to
+            antialias jittered samples in a second pass (see antialiasing).
+            depth, min_contribution and roulette control the reflections (see prepare).
+            With disk the image is rendered into a memory mapped file (filename + DISK_SUFFIX) and
+            streamed into filename (.png or .tif), so memory use does not grow with the resolution.
+            The file is kept if saving fails.
+            With checkpoint (implies the memory mapped file) the finished Tiles are saved to
+            filename + CHECKPOINT_SUFFIX regularly, with resume an interrupted capture of the same
+            Lense, Scene and settings only renders the missing Tiles. Both files are removed once
+            the image is saved.
+            With farm ('host:port' to listen on) the Tiles are rendered by remote workers instead of
+            processes local ones (see farm), authenticated with authkey (or a printed random one). '''
+
+        if disk:
+            check_streamed(filename)                                                # before anything is rendered
+        start_time = time.time()
+        profile = profile or heatmap is not None
+        self.prepare(scene, resolution, backend, profile, antialias, depth, min_contribution, roulette)
+        stats = RenderStats(len(scene.barriers)) if profile else None
+
+        progress = None
+        resumed = False
+        if checkpoint or resume:
+            progress = Checkpoint(filename + CHECKPOINT_SUFFIX, fingerprint(self, aa_threshold))
+            resumed = resume and os.path.exists(filename + DISK_SUFFIX) and progress.load()
+            if resumed:
+                print('|-- Resuming with %d finished Tiles' %(len(progress.done)))
+            else:
+                progress.remove()                                                   # files left by another render
+                if resume:
+                    print('|-- No matching checkpoint, starting over')
+
+        print('|-- Computing Pixel Colors')
+        if disk or progress is not None:
+            framebuffer = DiskFramebuffer(self.w, self.h, filename + DISK_SUFFIX, create=not resumed, keep=progress is not None)
+        else:
+            framebuffer = SharedFramebuffer(self.w, self.h)
+        with framebuffer:
+            try:
+                if farm is not None:
+                    renderer = FarmRenderer(self, framebuffer, farm, authkey)
+                else:
+                    renderer = TileRenderer(self, framebuffer, processes)
+                with renderer:
+                    self.render_passes(renderer, framebuffer, aa_threshold, stats, progress, resumed)
+            except BaseException:
+                if progress is not None:
+                    progress.save(framebuffer)                                      # keep what is done for resume
+                raise
+
+            print('|-- Saving Image')
+            try:
+                if disk:
+                    write_image(framebuffer.pixels, filename, framebuffer.release)
+                else:
+                    self.pixels = framebuffer.pixels
+                    self.save_image(filename)
+            except BaseException:
+                if isinstance(framebuffer, DiskFramebuffer):
+                    framebuffer.keep = True                                         # rendered pixels are not lost
+                    if progress is not None:
+                        progress.save(framebuffer)
+                    print('|-- Saving failed, pixels kept in %s' %(framebuffer.path))
+                raise
+
+        if progress is not None:
+            progress.remove()
+            os.remove(filename + DISK_SUFFIX)                                       # kept by the Framebuffer for resume
+
+        if stats is not None:
+            print(stats.report(scene.barriers))
+            if heatmap is not None:
+                print('|-- Saving Heatmap')
+                save_heatmap(stats.heatmap(self.w, self.h), heatmap)
+        self.profile = False
+
+        print('|-- Execution completed in %.2f seconds ' %(time.time() - start_time))
+        return stats
+
+    def render_passes(self, renderer, framebuffer, aa_threshold=AA_THRESHOLD, stats=None, progress=None, resumed=False, publish=None, quiet=False):
+        ''' Renders all Tiles of the prepared Lense with renderer (see scheduler) into framebuffer and,
+            with antialias > 1, supersamples the edge pixels (used by capture and service)
+
+            The RenderStats of the Tiles are merged into stats, finished Tiles are recorded in progress
+            (a Checkpoint, loaded if resumed) and publish(pass, done, total) is called after each Tile. '''
+        def render(name, tasks):
+            if progress is not None:
+                tasks = progress.todo(name, tasks)
+            if name == 'antialias' and not quiet:
+                print('|-- Supersampling %d Edge Pixels' %(sum(len(task[-1][0]) for task in tasks)))
+            if publish is not None:
+                publish(name, 0, len(tasks))
+            for done, (task, tile_stats) in enumerate(renderer.render(tasks), 1):
+                if stats is not None:
+                    stats.merge(tile_stats)
+                if progress is not None:
+                    progress.finished(name, task, framebuffer)
+                if publish is not None:
+                    publish(name, done, len(tasks))
+
+        render('render', tiles(self.w, self.h, self.tile_size))
+        if self.antialias > 1:
+            tasks = progress.load_tasks('antialias', framebuffer.pixels) if resumed else None
+            if tasks is None:
+                tasks = refine_tasks(framebuffer.pixels, tiles(self.w, self.h, self.tile_size), aa_threshold)
+                framebuffer.release()
+                if progress is not None:
+                    progress.save_tasks('antialias', tasks, framebuffer.pixels)
+            render('antialias', tasks)
+
+    def capture_progressive(self, scene, resolution, filename='default.png', callback=None, time_budget=None, backend='python', processes=PROCESSES_COUNT,
+                            depth=RECURSION_DEPTH, roulette=False):
+        ''' Like capture, but renders coarse to fine (see progressive) calling callback(step, pixels) after each pass '''
+
+        start_time = time.time()
+
+        print('|-- Computing Pixel Colors (progressive)')
+        for step, pixels in self.progressive(scene, resolution, time_budget, backend, processes, depth=depth, roulette=roulette):
+            print('|-- Pass with %d pixel spacing done after %.2f seconds' %(step, time.time() - start_time))
+            if callback:
+                callback(step, pixels)
+
+        print('|-- Saving Image')
+        self.pixels = pixels
+        self.save_image(filename)
+
+        print('|-- Execution completed in %.2f seconds ' %(time.time() - start_time))
+
+    def progressive(self, scene, resolution, time_budget=None, backend='python', processes=PROCESSES_COUNT, steps=PROGRESSIVE_STEPS,
+                    depth=RECURSION_DEPTH, roulette=False):
+        ''' Generator rendering in interleaved passes, yields (step, copy of the image) after each pass
+
+            The first pass traces every steps[0]-th pixel and fills whole blocks, each further pass only
+            traces the pixels not traced before. With time_budget (seconds) refinement stops (mid pass)
+            once the budget is used up, the last yielded image is then the best one available. '''
+        start_time = time.time()
+        self.prepare(scene, resolution, backend, depth=depth, roulette=roulette)
+
+        with SharedFramebuffer(self.w, self.h) as framebuffer:
+            with TileRenderer(self, framebuffer, processes) as renderer:
+                previous = 0
+                for step in steps:
+                    tasks = [tile + (step, previous) for tile in tiles(self.w, self.h, self.tile_size)]
+                    out_of_time = False
+                    for task in renderer.render(tasks):
+                        if time_budget is not None and time.time() - start_time > time_budget:
+                            out_of_time = True
+                            break
+                    yield step, framebuffer.pixels.copy()
+                    if out_of_time:
+                        return
+                    previous = step
+
+    def animate(self, scene, resolution, frames, transforms, filename='animation.gif', frame_duration=40, backend='python', processes=PROCESSES_COUNT,
+                depth=RECURSION_DEPTH, roulette=False):
+        ''' Renders frames images of scene into one animated GIF (or APNG for .png filenames)
+
+            Before each frame every transform(frame, scene) is called, moves Barriers in place and
+            returns the moved ones. The worker Pool and the BVH are kept for the whole animation,
+            only the moved Barriers are sent to the workers and refitted into the BVH. '''
 
         start_time = time.time()
-        computing_progress = 0
+        self.prepare(scene, resolution, backend, depth=depth, roulette=roulette)
+        images = []
+
+        print('|-- Computing %d Frames' %(frames))
+        with SharedFramebuffer(self.w, self.h) as framebuffer:
+            with TileRenderer(self, framebuffer, processes) as renderer:
+                for frame in range(frames):
+                    moved = []
+                    for transform in transforms:
+                        moved.extend(transform(frame, scene) or [])
+                    changes = dict((i, b) for i, b in enumerate(scene.barriers) if any(b is m for m in moved))
+                    if changes:
+                        renderer.update(changes)
+
+                    for task in renderer.render(tiles(self.w, self.h, self.tile_size)):
+                        pass
+                    images.append(Image.fromarray(framebuffer.pixels.copy(), 'RGB'))
+                    print('|-- Frame %d done after %.2f seconds' %(frame, time.time() - start_time))
+
+        print('|-- Saving Animation')
+        images[0].save(filename, save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
 
+        print('|-- Execution completed in %.2f seconds ' %(time.time() - start_time))
+
+    def prepare(self, scene, resolution, backend='python', profile=False, antialias=1, depth=RECURSION_DEPTH, min_contribution=MIN_CONTRIBUTION, roulette=False):
+        ''' Sets up sensor and Scene (incl. BVH) for rendering resolution
+
+            Rays are reflected up to depth times, but only while their share of the pixel Color (product
+            of the reflection factors) is at least min_contribution. With roulette, reflections with a
+            share below ROULETTE_WEIGHT are continued at random and weighted up when they are. '''
+        if backend == 'numba' and not kernels.available():
+            print('|-- Numba not installed, using the python backend')
+            backend = 'python'
+        self.backend = backend
+        self.profile = profile
+        self.antialias = antialias                                                  # max. samples per pixel
+        self.depth = depth
+        self.min_contribution = min_contribution
+        self.roulette_weight = ROULETTE_WEIGHT if roulette else 0.0
+        self.tile_size = packet.TILE_SIZE if backend == 'numpy' else TILE_SIZE
         self.h = resolution['height']
         self.w = resolution['width']
         self.aspect_ratio = self.w / (self.h * 1.)
         self.scene = scene
+        self.scene.compile()                                                        # shading constants, see Scene.compile
+        self.scene.refresh()                                                        # Barriers may have been moved since the last capture
+        self.scene.get_bvh()                                                        # build once, shipped to workers with the scene
+        if backend == 'numba':
+            self.scene.get_arrays()
         # sensor size
         self.sensor_height = 2*math.tan(self.fow/2.0)
         self.sensor_width = self.sensor_height * self.aspect_ratio
         # pixel size
         self.pixel_height = self.sensor_height / (self.h-1)
         self.pixel_width = self.sensor_width / (self.w-1)
-
-        print('|-- Computing Pixel Colors')
-        with multiprocessing.Pool(PROCESSES_COUNT) as pool:
-            self.pixels = pool.map(self.compute_row, range(self.h))
-
-        print('|-- Saving Image')
-        self.save_image(filename)
-
-        print('|-- Execution completed in %.2f seconds ' %(time.time() - start_time))
     
+    def compute_tile(self, pixels, x0, y0, x1, y1, step=1, previous=0, refine=None):
+        ''' Computing the Pixels [y0:y1, x0:x1] directly into pixels (h,w,3 uint8 array)
+
+            With step > 1 only every step-th pixel is traced and fills its step x step block,
+            pixels already traced in a pass with spacing previous are skipped.
+            With refine (xs, ys) only these already traced pixels are supersampled (see supersample_tile).
+            Returns the RenderStats of the Tile when profiling (see prepare), else None.
+            The batch backends are only timed as a whole, their cost is spread over the Tile. '''
+        if not self.profile:
+            self.trace_tile(pixels, x0, y0, x1, y1, step, previous, refine)
+            return None
+
+        self.stats = stats = RenderStats(len(self.scene.barriers), (x0, y0, x1, y1))
+        start = time.perf_counter()
+        traced = self.trace_tile(pixels, x0, y0, x1, y1, step, previous, refine)
+        stats.times['render'] = time.perf_counter() - start
+        if self.backend in BATCH_BACKENDS and refine is None:
+            stats.rays['primary'] += traced
+            stats.cost[:] = stats.times['render'] / stats.cost.size
+        self.stats = None
+        return stats
+
+    def trace_tile(self, pixels, x0, y0, x1, y1, step=1, previous=0, refine=None):
+        ''' compute_tile without profiling, returns the number of traced pixels '''
+        self.random.seed('%d %d %d %d' %(x0, y0, step, refine is not None))         # same samples for any Process count
+        if refine is not None:
+            return self.supersample_tile(pixels, x0, y0, *refine)
+        if step == 1 and not previous:
+            if self.backend in BATCH_BACKENDS:
+                pixels[y0:y1, x0:x1] = BATCH_BACKENDS[self.backend].render_tile(self, x0, y0, x1, y1, self.depth)
+            else:
+                for y in range(y0, y1):
+                    for x in range(x0, x1):
+                        color = self.trace_pixel(x, y)
+                        pixels[y, x] = (color.x, color.y, color.z)
+            return (x1 - x0) * (y1 - y0)
+
+        coords = [(x, y) for y in range(y0 + (-y0 % step), y1, step) for x in range(x0 + (-x0 % step), x1, step)
+                  if not (previous and x % previous == 0 and y % previous == 0)]
+        xs, ys = numpy.array(coords, dtype=int).reshape(-1, 2).T
+        if self.backend in BATCH_BACKENDS:
+            colors = BATCH_BACKENDS[self.backend].render_pixels(self, xs, ys, self.depth)
+        else:
+            colors = numpy.array([self.trace_pixel(x, y).values for x, y in coords]).reshape(-1, 3)
+        if step == 1:
+            pixels[ys, xs] = colors
+        else:
+            for (x, y), color in zip(coords, colors):
+                pixels[y:min(y + step, y1), x:min(x + step, x1)] = color
+        return len(coords)
+
+    def trace_pixel(self, x, y):
+        ''' Color of the primary Ray through pixel (x, y), recording its cost while profiling '''
+        stats = self.stats
+        if stats is None:
+            return self.trace(self.compute_ray(x,y))
+        start = time.perf_counter()
+        ray = self.compute_ray(x,y)
+        generated = time.perf_counter()
+        color = self.trace(ray)
+        stats.rays['primary'] += 1
+        stats.times['ray_generation'] += generated - start
+        stats.cost[y - stats.y0, x - stats.x0] += time.perf_counter() - start
+        return color
+
+    def supersample_tile(self, pixels, x0, y0, xs, ys):
+        ''' Replaces the pixels (xs[i], ys[i]) of the Tile starting at (x0, y0) by the mean of up to
+            self.antialias jittered samples (see antialiasing.supersample), returns the number of extra Rays '''
+        start = time.perf_counter()
+        colors, counts = supersample(self.shade, pixels[ys, xs], xs, ys, self.antialias)
+        pixels[ys, xs] = numpy.clip(numpy.rint(colors), 0, 255)
+        extra = int(counts.sum()) - len(counts)
+        stats = self.stats
+        if stats is not None:
+            stats.rays['primary'] += extra
+            stats.cost[ys - y0, xs - x0] += (time.perf_counter() - start) * (counts - 1) / max(extra, 1)
+        return extra
+
+    def shade(self, xs, ys):
+        ''' float Colors (n,3) of the primary Rays through the (fractional) pixel coordinates (xs[i], ys[i]) '''
+        if self.backend in BATCH_BACKENDS:
+            return BATCH_BACKENDS[self.backend].render_pixels(self, xs, ys, self.depth)
+        return numpy.array([self.trace(self.compute_ray(x,y)).values for x, y in zip(xs.tolist(), ys.tolist())]).reshape(-1, 3)
+
     def compute_row(self, y):
         ''' Computing a Pixel Row bases on y (height) param '''
         row = [self.trace(self.compute_ray(x,y)).values for x in range(self.w)]
@@ -97,76 +408,122 @@ class Lense():
         xcomp = self.s.scaled(x*self.pixel_width - self.sensor_width/2)
         return Ray(self.origin, self.f + xcomp + ycomp)
 
-    def trace(self, ray, depth=RECURSION_DEPTH):
+    def trace(self, ray, depth=None, weight=1.0):
+        ''' Color seen along ray, following up to depth (default self.depth) reflections
 
-        # reset for new Ray
-        closest_d = math.inf
-        closest_b = None
+            weight is the share of the pixel Color carried by ray (see prepare) '''
+        if depth is None:
+            depth = self.depth
 
-        # check intersection for each barrier
-        for b in self.scene.barriers:
-            dist = b.intersectionParameter(ray)
-            # distance must be greater 0, update if smaller than current leastdist
-            if dist and dist < closest_d and dist > 0:
-                closest_d = dist
-                closest_b = b
+        # closest intersection (distance must be greater 0) via the scene's BVH
+        stats = self.stats
+        if stats is None:
+            closest_d, closest_b, face = self.scene.get_bvh().closest_hit(ray)
+        else:
+            start = time.perf_counter()
+            closest_d, closest_b, face = self.scene.get_bvh().closest_hit(ray, stats)
+            stats.times['intersection'] += time.perf_counter() - start
         
         # when intersection found, compute color
         if closest_b:
             intersection = ray.pointAtParameter(closest_d)
-            if depth==0:
-                return self.compute_light(closest_b, intersection, ray.direction)
-            else:
-                normal = closest_b.normalAt(intersection)
-                reflected_ray = Ray(intersection, ray.direction.reflect_on(normal))
-                return self.compute_light(closest_b, intersection, ray.direction) + self.trace(reflected_ray, depth-1).scaled(closest_b.get_reflection_factor())
+            normal, mirror = closest_b.compiled[5:]
+            if normal is None:
+                normal = closest_b.normalValuesAt(intersection.x, intersection.y, intersection.z, face)
+            reflection = closest_b.compiled[3]
+            weight = weight * reflection
+            if depth==0 or reflection <= 0 or weight < self.min_contribution:
+                return self.compute_light(closest_b, intersection, ray.direction, normal, face)
+            if weight < self.roulette_weight:                                           # Russian roulette
+                survival = weight / self.roulette_weight
+                if self.random.random() >= survival:
+                    return self.compute_light(closest_b, intersection, ray.direction, normal, face)
+                reflection, weight = reflection / survival, self.roulette_weight
+            mx, my, mz = mirror or normalized_values(*normal)                           # Vector.reflect_on
+            d = ray.direction
+            k = (mx*d.x + my*d.y + mz*d.z)*2
+            reflected_ray = Ray(intersection, Vector(d.x - mx*k, d.y - my*k, d.z - mz*k))
+            if stats is not None:
+                stats.rays['reflected'] += 1
+            return self.compute_light(closest_b, intersection, ray.direction, normal, face) + self.trace(reflected_ray, depth-1, weight).scaled(reflection)
         return Color(0,0,0)
 
-    def compute_light(self, barrier, origin, dir):
-        ''' Computes Color of Point(origin) on Barrier(barrier) with viewing direction Vector(dir) '''
-        a  = self.ambient(barrier, origin)                                              # ambient lighting
-        ds = self.diffuse_specular(barrier, origin, dir, self.scene.lights[0])          # diffuse and specular lighting
-        return a + ds
+    def compute_light(self, barrier, origin, dir, normal=None, face=-1):
+        ''' Computes Color of Point(origin) on Barrier(barrier) with viewing direction Vector(dir)
+
+            Sums up all lights of the Scene (or a random sample of them, see Scene.sample_lights).
+            normal (float tuple) is the Barrier's normal at origin (on face), looked up when not given.
+            Works on the compiled Barrier (see Scene.compile) and plain floats, rounding exactly
+            like the Color arithmetic it replaces. '''
+        stats = self.stats
+        if stats is not None:
+            start, shadow = time.perf_counter(), stats.times['shadow']
+        if normal is None:
+            normal = barrier.compiled[5] or barrier.normalValuesAt(origin.x, origin.y, origin.z, face)
+        r, g, b = self.ambient(barrier, origin)                                         # ambient lighting
+        indices, weight = self.scene.sample_lights(self.random)
+        for index in indices:                                                           # diffuse and specular lighting
+            dr, dg, db = self.diffuse_specular(barrier, origin, dir, self.scene.lights[index], index, normal, face)
+            if weight != 1:
+                dr, dg, db = dr*weight, dg*weight, db*weight
+            r, g, b = min(max(r + dr, 0), 255), min(max(g + dg, 0), 255), min(max(b + db, 0), 255)
+        if stats is not None:
+            stats.times['shading'] += time.perf_counter() - start - (stats.times['shadow'] - shadow)
+        return Color(r, g, b)
 
     def ambient(self, barrier, origin):
-        total_factor = barrier.get_ambient_factor() * self.scene.global_ambient_factor
-        return barrier.colorAt(origin).scaled(total_factor)
+        total_factor = barrier.compiled[0] * self.scene.global_ambient_factor
+        r, g, b = barrier.texture.colorValuesAt(origin.x, origin.y, origin.z)
+        return (r*total_factor, g*total_factor, b*total_factor)
     
-    def diffuse_specular(self, barrier, origin, dir, source):
-        ''' computes diffuse and specular light at >point< on >barrier< with >source< as light and >dir< as viewing point vector '''
+    def diffuse_specular(self, barrier, origin, dir, source, index=0, normal=None, face=-1):
+        ''' computes diffuse and specular light (r, g, b) at >point< on >barrier< with >source< (the index-th light) as light and >dir< as viewing point vector '''
 
-        normal = barrier.normalAt(origin)
-        bs  = (source.origin - origin).normalized()                                     # Vector (Point on barrier to lightsource)
-        bsr = bs.scaled(-1).reflect_on(normal)                                          # Vector
-        diffuse_cos  = bs.dot(normal)                                                   # float  (cos of angle between vectors)
-        specular_cos = max(bsr.dot(dir.scaled(-1)),0)                                   # float  (cos of angle between vectors)
-        light_ray = Ray(origin, bs)
+        ambient, diffuse, specular, reflection, shininess, fixed, mirror = barrier.compiled
+        nx, ny, nz = normal or fixed or barrier.normalValuesAt(origin.x, origin.y, origin.z, face)
+        lo = source.origin
+        tx, ty, tz = lo.x - origin.x, lo.y - origin.y, lo.z - origin.z                  # Point on barrier to lightsource
+        distance = math.sqrt(tx*tx + ty*ty + tz*tz)                                     # float  (shadows only count before the light)
+        bx, by, bz = normalized_values(tx, ty, tz)
+        diffuse_cos = bx*nx + by*ny + bz*nz                                             # float  (cos of angle between vectors)
 
         if diffuse_cos <= 0:
-            return Color(0,0,0)                                                         # if angle > 90° -> shadow
-        # else check every barrier
-        else:
-            for b in self.scene.barriers:
+            return (0, 0, 0)                                                            # if angle > 90° -> shadow
+        # else check for any barrier in between
+        elif self.shadowed(Ray(origin, Vector(bx, by, bz)), barrier, distance, index, face):   # if intersecting -> shadow
+            return (0, 0, 0)
 
-                dist = b.intersectionParameter(light_ray)
-                if dist and dist > 0 and b != barrier:                                                   # if intersecting -> shadow [TODO: Not occuring, WHY?!]
-                    return Color(0,0,0)
+        # light reflected on the normal (Vector.reflect_on normalizes it once more)
+        mx, my, mz = mirror or normalized_values(nx, ny, nz)
+        k = (mx*-bx + my*-by + mz*-bz)*2
+        specular_cos = max((-bx - mx*k)*(dir.x*-1) + (-by - my*k)*(dir.y*-1) + (-bz - mz*k)*(dir.z*-1), 0)
 
         # compute total factors based on texture and angle
-        total_diffuse_factor  = barrier.get_diffuse_factor()*diffuse_cos
-        total_specular_factor = barrier.get_specular_factor()*(specular_cos**barrier.get_shininess_exponent())
+        total_diffuse_factor  = diffuse*diffuse_cos
+        total_specular_factor = specular*(specular_cos**shininess)
 
         # comute color based on factors
-        diffuse_color  = source.color.scaled(total_diffuse_factor)
-        specular_color = source.color.scaled(total_specular_factor)
-
-        return diffuse_color + specular_color
+        c = source.color
+        return (min(max(c.x*total_diffuse_factor + c.x*total_specular_factor, 0), 255),
+                min(max(c.y*total_diffuse_factor + c.y*total_specular_factor, 0), 255),
+                min(max(c.z*total_diffuse_factor + c.z*total_specular_factor, 0), 255))
     
+    def shadowed(self, light_ray, barrier, distance=math.inf, light=0, face=-1):
+        ''' True if light_ray (starting on face of barrier) hits any Barrier before distance (see Scene.occluded) '''
+        stats = self.stats
+        if stats is None:
+            return self.scene.occluded(light_ray, barrier, distance, light, None, face)
+        start = time.perf_counter()
+        blocked = self.scene.occluded(light_ray, barrier, distance, light, stats, face)
+        stats.rays['shadow'] += 1
+        stats.times['shadow'] += time.perf_counter() - start
+        return blocked
+
     def set_scene(self, scene):
         self.scene = scene
 
     def save_image(self, filename):
-        arr = numpy.array(self.pixels, dtype=numpy.uint8)
+        arr = numpy.asarray(self.pixels, dtype=numpy.uint8)                            # no copy for framebuffers
         img = Image.fromarray(arr, 'RGB')
         img.save(filename)
         self.pixels = []
@@ -176,14 +533,19 @@ class Lense():
 
 class Scene():
     ''' Handling Barriers, Lights and global light '''
-    def __init__(self, barriers=[], lights=[], global_ambient_factor=0.7, ambient_light=Color(50,50,50)):
+    def __init__(self, barriers=[], lights=[], global_ambient_factor=0.7, ambient_light=Color(50,50,50), light_samples=None):
         self.BACKGROUND_COLOR = Color(0,0,0)
         self.barriers = []
         self.lights = []
+        self.bvh = None
+        self.arrays = None
+        self.geometry = []                                                          # Barrier.geometry when the BVH was built
+        self.occluders = {}                                                         # {light index: Barrier index} that shadowed last
         self.put_barriers(barriers)
         self.put_lights(lights)
         self.ambient_light=ambient_light
         self.global_ambient_factor = global_ambient_factor
+        self.light_samples = light_samples                                          # lights shaded per Point (None: all)
 
     def put_barriers(self, barriers):
         for b in barriers:
@@ -191,11 +553,89 @@ class Scene():
                 self.barriers.append(b)
             else:
                 print('%s is not a Barrier' %(repr(b)))
+        self.bvh = None                                                             # rebuilt on next use
+        self.arrays = None
+
+    def update_barriers(self, changes):
+        ''' Puts changed Barriers {index: Barrier} into the Scene, refitting (or dropping) the BVH '''
+        for index, barrier in changes.items():
+            self.barriers[index] = barrier
+            barrier.compile()
+        if self.bvh is not None:
+            if self.bvh.refit(changes):
+                for index, barrier in changes.items():
+                    self.geometry[index] = barrier.geometry()
+            else:
+                self.bvh = None
+        self.arrays = None
+
+    def refresh(self):
+        ''' Finds Barriers changed in place (see Barrier.geometry) since the BVH was built and puts
+            them in like update_barriers. The arrays of the compiled kernels are always rebuilt,
+            they also hold Materials and Lights. Called by Lense.prepare. '''
+        if self.bvh is not None:
+            if len(self.geometry) != len(self.barriers):
+                self.bvh = None
+            else:
+                changes = dict((i, b) for i, b in enumerate(self.barriers) if b.geometry() != self.geometry[i])
+                if changes:
+                    self.update_barriers(changes)
+        self.arrays = None
+
+    def compile(self):
+        ''' Freezes Materials, Texture parameters and fixed normals of all Barriers into plain
+            tuples (see Barrier.compile), Lense.trace shades from these. Called by Lense.prepare. '''
+        for b in self.barriers:
+            b.compile()
+
+    def get_bvh(self):
+        ''' Bounding Volume Hierarchy over all Barriers, built once and reused for every Ray '''
+        if self.bvh is None:
+            self.bvh = BVH(self.barriers)
+            self.geometry = [b.geometry() for b in self.barriers]
+        return self.bvh
+
+    def get_arrays(self):
+        ''' Scene flattened into arrays for the compiled kernels, built once '''
+        if self.arrays is None:
+            self.arrays = kernels.SceneArrays(self)
+        return self.arrays
     
     def put_lights(self, lights):
         for l in lights:
             if isinstance(l, Light):
                 self.lights.append(l)
+        self.arrays = None
+
+    def sample_lights(self, rng):
+        ''' (light indices, weight) to shade one Point with
+
+            All lights with weight 1, or with more lights than light_samples that many lights drawn
+            by rng (random.Random) weighted by their share, so the expected Color stays the same. '''
+        n = len(self.lights)
+        if not self.light_samples or self.light_samples >= n:
+            return range(n), 1.0
+        return rng.sample(range(n), self.light_samples), n / self.light_samples
+
+    def occluded(self, ray, barrier, distance=math.inf, light=0, stats=None, face=-1):
+        ''' True if ray (starting on face of barrier) hits any Barrier within (0, distance)
+
+            The Barrier that shadowed the last Ray towards light is tested first, neighbouring
+            shadow Rays are mostly blocked by the same Barrier. '''
+        cached = self.occluders.get(light)
+        if cached is not None and cached < len(self.barriers):
+            b = self.barriers[cached]
+            test, args = (b.selfIntersectionParameter, (face,)) if b is barrier else (b.intersectionParameter, ())
+            dist = test(ray, *args) if stats is None else stats.intersect(cached, test, ray, *args)
+            if dist and 0 < dist < distance:
+                if stats is not None:
+                    stats.cached_occlusions += 1
+                return True
+        index = self.get_bvh().any_hit(ray, barrier, distance, stats, face)
+        if index is None:
+            return False
+        self.occluders[light] = index
+        return True
         
     def show_barriers(self):
         for b in self.barriers:
@@ -204,29 +644,27 @@ class Scene():
 
 # -----  Build  ---------------------------------------------------------------------------------------- #
 
-def build_bounce_gif(lense, scene, sphere, plane):
+def build_bounce_gif(lense, scene, sphere, plane, filename='bounce.gif'):
 
     acceleration = Vector(0,-0.1,0)
     velocity     = Vector(-0.8, -1, -1)
 
-    for x in range(71):
+    def bounce(frame, scene):
+        nonlocal velocity
         velocity += acceleration
         sphere.center += velocity
 
         if(sphere.center[1]-sphere.radius < plane.point[1]):
-            velocity.values[1] = velocity.values[1] * -1
-            sphere.center.values[1] = plane.point.values[1] + sphere.radius
-        
-        lense.capture(sc, {'width': int(256*5), 'height': int(256*3)}, 'bouncing_gif2/bouncing%02d.png' %(x))
-        # imageio for python gif generation
+            velocity = Vector(velocity[0], -velocity[1], velocity[2])
+            sphere.center = Point(sphere.center[0], plane.point[1] + sphere.radius, sphere.center[2])
+        return [sphere]
 
-if __name__ == "__main__":
+    lense.animate(scene, {'width': int(256*5), 'height': int(256*3)}, 71, [bounce], filename)
 
-    # Computing 640 * 384 Pixel Image (Depth 3)
-    # 1 Process 73 Seconds
-    # 8 Processes 29 Seconds (Number of Cores)
+# -----  Scenes  --------------------------------------------------------------------------------------- #
 
-    # TODO: Woher kommen die in Abständen, kreisförmig um die Linse auftretenden Pixelanomalien?
+def build_scenes(squirrel_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'squirrel_aligned_lowres.obj')):
+    ''' Built-in Scenes sc0 - sc4 as {name: (Lense, Scene)} (sc1 is the squirrel mesh) '''
 
     # Materials
     shiny10 = Material(1.0, 0.1, 0.9, 0.8, 40.0)
@@ -262,16 +700,34 @@ if __name__ == "__main__":
     lense1 = Lense(Point(0,2,10), Point(0,3,0), Vector(0,1,0), 45)
 
     # Eichhorn
-    squirrel = build_triangular_network('squirrel_aligned_lowres.obj')
+    squirrel = build_triangle_mesh(squirrel_path)
 
     # Scenes
     sc0 = Scene([sphere0, sphere1, plane], [light1], 0.1)
-    sc1 = Scene([*squirrel], [light1],0.6)
+    sc1 = Scene([squirrel], [light1],0.6)
     sc2 = Scene([triangle, sphere0], [light1], 0.4)
     sc3 = Scene([sphere3, plane], [light1], 0.6)
     sc4 = Scene([sphere4, sphere5, sphere6, triangle, plane], [light1])
+
+    return {'sc0': (lense, sc0), 'sc1': (lense, sc1), 'sc2': (lense, sc2), 'sc3': (lense, sc3), 'sc4': (lense1, sc4)}
+
+
+if __name__ == "__main__":
+
+    # Computing 640 * 384 Pixel Image (Depth 3)
+    # 1 Process 73 Seconds
+    # 8 Processes 29 Seconds (Number of Cores)
+    # (see benchmark.py for reproducible numbers)
+
+    # TODO: Woher kommen die in Abständen, kreisförmig um die Linse auftretenden Pixelanomalien?
+
+    scenes = build_scenes()
+    lense, sc0 = scenes['sc0']
+    lense, sc1 = scenes['sc1']
+    lense, sc3 = scenes['sc3']
+    lense1, sc4 = scenes['sc4']
     
-    #build_bounce_gif(lense0, scene3, sphere3, plane)   Das dauert!
+    #build_bounce_gif(lense, sc3, *sc3.barriers)   Das dauert!
 
     # Shoot the Shot
     #lense.capture(sc0, {'width': int(512*10), 'height': int(512*6)})
@@ -0,0 +1,152 @@
+# Description
+'''
+Checkpoints for long Renders
+
+While Lense.capture(checkpoint=True) renders into a DiskFramebuffer, the finished Tiles are
+listed in a small JSON file next to the image. Both survive a killed Process, and
+capture(resume=True) only renders the Tiles still missing - as long as the fingerprint of
+Lense, Scene and render settings stored in the checkpoint still matches.
+'''
+
+# Imports
+import hashlib, json, os, struct, time
+import numpy
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+CHECKPOINT_INTERVAL = 30.0  # seconds between two checkpoint writes
+TASK_FILES = ('antialias',) # passes whose tasks are stored next to the checkpoint (see save_tasks)
+TRANSIENT = frozenset(('pixels', 'random', 'stats', 'profile', 'bvh', 'arrays', 'occluders', 'leaves', 'face_order', 'compiled', 'geometry'))   # caches, not content
+
+
+# -----  Fingerprint  ---------------------------------------------------------------------------------- #
+
+def fingerprint(*objects):
+    ''' SHA-256 hex digest of the content of objects (Lense, Scene, Barriers, settings ...)
+
+        Objects are walked through their attributes (without caches, see TRANSIENT), so equal
+        Scenes built separately get the same fingerprint and any changed value a new one. '''
+    digest = hashlib.sha256()
+    for obj in objects:
+        feed(digest, obj, set())
+    return digest.hexdigest()
+
+def feed(digest, obj, seen):
+    if obj is None or isinstance(obj, (bool, int, str)):
+        digest.update(('%s:%r;' %(type(obj).__name__, obj)).encode())
+    elif isinstance(obj, float):
+        digest.update(b'float:' + struct.pack('<d', obj))
+    elif isinstance(obj, numpy.ndarray):
+        digest.update(('ndarray:%s:%s;' %(obj.dtype.str, obj.shape)).encode())
+        digest.update(numpy.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, numpy.generic):
+        feed(digest, obj.item(), seen)
+    elif isinstance(obj, (list, tuple, range)):
+        digest.update(('%s:%d[' %(type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            feed(digest, item, seen)
+        digest.update(b']')
+    elif isinstance(obj, dict):
+        digest.update(('dict:%d{' %(len(obj))).encode())
+        for key in sorted(obj, key=repr):
+            feed(digest, key, seen)
+            feed(digest, obj[key], seen)
+        digest.update(b'}')
+    else:
+        if id(obj) in seen:                                                     # shared or cyclic references
+            digest.update(b'seen;')
+            return
+        seen.add(id(obj))
+        names = list(getattr(obj, '__dict__', {}))
+        for cls in type(obj).__mro__:
+            names.extend(getattr(cls, '__slots__', ()))
+        digest.update(('%s{' %(type(obj).__name__)).encode())
+        for name in sorted(set(names) - TRANSIENT):
+            if hasattr(obj, name) and not callable(getattr(obj, name)):
+                feed(digest, name, seen)
+                feed(digest, getattr(obj, name), seen)
+        digest.update(b'}')
+
+
+# -----  Checkpoint  ----------------------------------------------------------------------------------- #
+
+class Checkpoint():
+    ''' Finished Tiles of one capture, written to path as JSON at most every interval seconds
+
+        Tiles are keyed by (pass, x0, y0). The Framebuffer is flushed before every write, so a
+        listed Tile is always on disk. '''
+    def __init__(self, path, fingerprint, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.done = set()
+        self.saved = time.time()
+
+    def __repr__(self):
+        return 'Checkpoint(%s, %d tiles)' %(self.path, len(self.done))
+
+    def load(self):
+        ''' Reads the finished Tiles, False (and nothing read) if missing or made for another render '''
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('fingerprint') != self.fingerprint:
+            return False
+        self.done = set(tuple(key) for key in data['done'])
+        return True
+
+    def finished(self, kind, task, framebuffer):
+        ''' Marks the Tile of task (arguments of Lense.compute_tile) done in pass kind, saves when due '''
+        self.done.add((kind, task[0], task[1]))
+        if time.time() - self.saved >= self.interval:
+            self.save(framebuffer)
+
+    def todo(self, kind, tasks):
+        ''' tasks whose Tile is not finished in pass kind yet '''
+        return [task for task in tasks if (kind, task[0], task[1]) not in self.done]
+
+    def save_tasks(self, kind, tasks, pixels):
+        ''' Stores the refine tasks of pass kind (see antialiasing.refine_tasks) with the first pass
+            Colors of their pixels - both can not be recovered from a partly refined image.
+            The fingerprint is stored with them, load_tasks ignores files of other renders. '''
+        header = numpy.array([task[:4] + (len(task[-1][0]),) for task in tasks], dtype=numpy.int64).reshape(-1, 5)
+        xs = numpy.concatenate([task[-1][0] for task in tasks]) if tasks else numpy.zeros(0, dtype=numpy.int64)
+        ys = numpy.concatenate([task[-1][1] for task in tasks]) if tasks else numpy.zeros(0, dtype=numpy.int64)
+        with open('%s.%s.npz' %(self.path, kind), 'wb') as f:
+            numpy.savez(f, fingerprint=numpy.array(self.fingerprint), header=header, xs=xs, ys=ys, colors=pixels[ys, xs])
+
+    def load_tasks(self, kind, pixels):
+        ''' Refine tasks stored by save_tasks or None (also if stored for another render), unfinished Tiles
+            get their first pass Colors back in pixels (a Tile may have been written without being listed as finished) '''
+        path = '%s.%s.npz' %(self.path, kind)
+        if not os.path.exists(path):
+            return None
+        with numpy.load(path) as data:
+            if 'fingerprint' not in data.files or str(data['fingerprint']) != self.fingerprint:
+                return None
+            header, xs, ys, colors = data['header'], data['xs'], data['ys'], data['colors']
+        tasks, start = [], 0
+        for x0, y0, x1, y1, count in header.tolist():
+            part = slice(start, start + count)
+            tasks.append((x0, y0, x1, y1, 1, 0, (xs[part], ys[part])))
+            if (kind, x0, y0) not in self.done:
+                pixels[ys[part], xs[part]] = colors[part]
+            start += count
+        return tasks
+
+    def save(self, framebuffer):
+        framebuffer.flush()
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'done': sorted(self.done)}, f)
+        os.replace(temporary, self.path)                                        # never a half written checkpoint
+        self.saved = time.time()
+
+    def remove(self):
+        ''' Deletes the checkpoint and its task files (when done, or before starting over) '''
+        for path in [self.path] + ['%s.%s.npz' %(self.path, kind) for kind in TASK_FILES]:
+            if os.path.exists(path):
+                os.remove(path)
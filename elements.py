@@ -4,85 +4,132 @@ Geometric Shapes, Points and Vectors
 '''
 
 # Imports
-import math, numpy
+import math, numpy, copy, os, mmap
+from bvh import BVH, inverse, slab_entry, inverse_rows
 
 __author__ = 'Jan Ningelgen'
 
+# Constants
+DEBUG = False                   # sanity checks (zero length Vectors, unnormalized Rays) on the per-ray path
+MESH_BATCH_SIZE = 1 << 20       # max. Ray-Face pairs tested at once by a TriangleMesh
+OBJ_CACHE_SUFFIX = '.npz'       # binary cache written next to loaded .obj files
+OBJ_ARRAYS = ('vertices', 'normals', 'texcoords', 'faces', 'face_texcoords', 'face_normals')
+OBJ_CHUNK_SIZE = 1 << 22        # bytes of an .obj file parsed at once
+OBJ_RECORD_WIDTHS = {'v': (3, 3), 'vt': (2, 1), 'vn': (3, 3)}   # values kept, values required per record
+
+
 # -----  Point -> (Vector -> (Color))  ----------------------------------------------------------------- #
 
 class Point():
-    ''' 3D Point wrapping NumPy operations '''
+    ''' 3D Point with plain float fields (x, y, z), values gives them as NumPy Array '''
+    __slots__ = ('x', 'y', 'z')
     def __init__(self,*args):
-        # constructing Point with numpy Array
-        if(len(args)==1 and hasattr(args[0], '__len__') and len(args[0])==3):
-            self.values=args[0]
         # constructing Point with 3 values
-        elif(len(args)==3):
-            self.values=numpy.array([args[0],args[1],args[2]])
+        if(len(args)==3):
+            self.x, self.y, self.z = args
+        # constructing Point with numpy Array (or any other sequence of 3 values)
+        elif(len(args)==1 and hasattr(args[0], '__len__') and len(args[0])==3):
+            self.values = args[0]
         else:
             print(args)
             print("unvalid number of arguments")
-    
+
+    @property
+    def values(self):
+        ''' (x, y, z) as a read-only copy, write the fields (or assign values) to change the Point '''
+        values = numpy.array([self.x, self.y, self.z])
+        values.flags.writeable = False
+        return values
+
+    @values.setter
+    def values(self, values):
+        self.x, self.y, self.z = values.tolist() if isinstance(values, numpy.ndarray) else values
+
     def __repr__(self):
-        return '%s(%s, %s, %s)' %(self.__class__.__name__, self.values[0], self.values[1], self.values[2])
+        return '%s(%s, %s, %s)' %(self.__class__.__name__, self.x, self.y, self.z)
     
     def __add__(self, other):
-        return Point(numpy.add(self.values, other.values))
+        return Point(self.x + other.x, self.y + other.y, self.z + other.z)
     
     def __sub__(self, other):
-        temp = Vector(numpy.subtract(self.values, other.values))
-        if temp.length() == 0:
+        temp = Vector(self.x - other.x, self.y - other.y, self.z - other.z)
+        if DEBUG and temp.length() == 0:
             print('Länge 0: v1 ', self, ' v2 ', other)
-        return Vector(numpy.subtract(self.values, other.values))
+        return temp
 
     def __getitem__(self, i):
-        return self.values[i]
+        return (self.x, self.y, self.z)[i]
+
+    def __getstate__(self):
+        return (self.x, self.y, self.z)
+
+    def __setstate__(self, state):
+        self.x, self.y, self.z = state
 
 
 class Vector(Point):
     ''' 3D Vector '''
-    def __init__(self, *args):
-        super(Vector, self).__init__(*args)
+    __slots__ = ()
     
     def __add__(self, other):
-        return Vector(numpy.add(self.values, other.values))
+        return Vector(self.x + other.x, self.y + other.y, self.z + other.z)
 
     def length(self):
-        return numpy.linalg.norm(self.values)
+        return math.sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
 
     def scaled(self, t):
-        return Vector(numpy.multiply(self.values, t))
+        return Vector(self.x*t, self.y*t, self.z*t)
     
     def normalized(self):
-        if self.length != 0:
-            return self.scaled(1/(numpy.linalg.norm(self.values)))
+        length = self.length()
+        if length != 0:
+            return self.scaled(1/length)
         else:
-            print('Error, vektor 0 lang')
+            if DEBUG:
+                print('Error, vektor 0 lang')
+            return self.scaled(math.inf)
 
     def dot(self, other):
-        return numpy.dot(self.values, other.values)
+        return self.x*other.x + self.y*other.y + self.z*other.z
 
     def cross(self, other):
-        return Vector(numpy.cross(self.values, other.values))
+        return Vector(self.y*other.z - self.z*other.y, self.z*other.x - self.x*other.z, self.x*other.y - self.y*other.x)
 
     def reflect_on(self, normal):
         normal = normal.normalized()
-        return self - normal.scaled(normal.dot(self)*2)
+        k = normal.dot(self)*2
+        return Vector(self.x - normal.x*k, self.y - normal.y*k, self.z - normal.z*k)
 
 
 class Color(Vector):
     ''' Specialized 3D Vector only containing numbers betweeen 0.0 and 255.0 '''
-    def __init__(self, *args):
-        super(Vector, self).__init__(*args)
+    __slots__ = ()
 
     def __add__(self, other):
-        return Color(numpy.clip(numpy.add(self.values, other.values), a_min=0, a_max=255))
+        return Color(min(max(self.x + other.x, 0), 255), min(max(self.y + other.y, 0), 255), min(max(self.z + other.z, 0), 255))
     
     def __sub__(self, other):
-        return Color(numpy.subtract(self.values, other.values))
+        return Color(self.x - other.x, self.y - other.y, self.z - other.z)
 
     def scaled(self, t):
-        return Color(numpy.multiply(self.values, t))
+        return Color(self.x*t, self.y*t, self.z*t)
+
+
+# -----  Row-wise helpers for (n,3) arrays  ------------------------------------------------------------ #
+
+def dot_rows(a, b):
+    ''' Dot product of each row of a with each row of b (or a single vector b) '''
+    return a[..., 0]*b[..., 0] + a[..., 1]*b[..., 1] + a[..., 2]*b[..., 2]
+
+def normalized_rows(a):
+    ''' Scales each row of a to length 1 (like Vector.normalized) '''
+    return a * (1/numpy.sqrt(dot_rows(a, a)))[:, None]
+
+def normalized_values(x, y, z):
+    ''' Vector(x, y, z).normalized() as float tuple (same rounding) '''
+    length = math.sqrt(x*x + y*y + z*z)
+    t = 1/length if length != 0 else math.inf
+    return (x*t, y*t, z*t)
 
 
 # -----  Texture -> (Checkerboard)  -------------------------------------------------------------------- #
@@ -100,9 +147,21 @@ class Texture():
         self.reflection_factor  = material.reflection_factor                # float   > 0
         self.shininess_exponent = material.shininess_exponent               # float   > 1 
 
+    def compile(self):
+        ''' Freezes the Colors into float tuples for colorValuesAt (see Scene.compile) '''
+        self.compiled = ((self.primary.x, self.primary.y, self.primary.z),)
+
     def colorAt(self, p):
         return self.primary
 
+    def colorValuesAt(self, x, y, z):
+        ''' colorAt as (r, g, b) tuple, needs compile '''
+        return self.compiled[0]
+
+    def colorsAt(self, points):
+        ''' colorAt for an (n,3) array of points, returns (n,3) colors '''
+        return numpy.broadcast_to(numpy.asarray(self.primary.values, dtype=float), points.shape)
+
 
 class Checkerboard(Texture):
     ''' typical Checkerboard Texture '''
@@ -112,12 +171,27 @@ class Checkerboard(Texture):
         self.size = size
     
     def colorAt(self, p):
-        v = Vector(p.values).scaled(1.0/self.size)
+        v = Vector(p.x, p.y, p.z).scaled(1.0/self.size)
         if (int(abs(v[0]) + 0.5) + int(abs(v[1]) + 0.5) + int(abs(v[2]) + 0.5))%2:
             return self.primary
         else:
             return self.secondary
 
+    def compile(self):
+        s = self.secondary
+        self.compiled = ((self.primary.x, self.primary.y, self.primary.z), (s.x, s.y, s.z), 1.0/self.size)
+
+    def colorValuesAt(self, x, y, z):
+        primary, secondary, t = self.compiled
+        if (int(abs(x*t) + 0.5) + int(abs(y*t) + 0.5) + int(abs(z*t) + 0.5))%2:
+            return primary
+        return secondary
+
+    def colorsAt(self, points):
+        v = numpy.multiply(points, 1.0/self.size)
+        odd = numpy.floor(numpy.abs(v) + 0.5).sum(axis=1) % 2 == 1
+        return numpy.where(odd[:, None], numpy.asarray(self.primary.values, dtype=float), numpy.asarray(self.secondary.values, dtype=float))
+
 
 # -----  Material  ------------------------------------------------------------------------------------- #
 
@@ -131,7 +205,7 @@ class Material():
         self.shininess_exponent = max(shininess_exponent, 1.0)  # float   > 1   
 
 
-# -----  Barrier -> (Sphere, Plane, Triangle)  --------------------------------------------------------- #
+# -----  Barrier -> (Sphere, Plane, Triangle, TriangleMesh)  ------------------------------------------- #
 
 class Barrier():
     ''' Super Class for each Barrier handling Texture and Material '''
@@ -140,9 +214,54 @@ class Barrier():
     
     def intersectionParamenter(self, ray):
         return None
+
+    def intersectionFace(self, ray):
+        ''' intersectionParameter plus the hit face (-1 for single-face Barriers) '''
+        return self.intersectionParameter(ray), -1
+
+    def selfIntersectionParameter(self, ray, face=-1):
+        ''' Intersection of a Ray leaving face of this Barrier with the Barrier itself (None: no self shadowing) '''
+        return None
+
+    def intersectionFaces(self, origins, directions):
+        ''' intersectionParameters plus the hit face per Ray (None for single-face Barriers) '''
+        return self.intersectionParameters(origins, directions), None
+
+    def selfIntersectionParameters(self, origins, directions, faces):
+        return numpy.full(len(directions), numpy.nan)
+
+    def bounds(self):
+        ''' Axis aligned bounding box as (lower Point, upper Point), None if unbounded '''
+        return None
+
+    def geometry(self):
+        ''' Values defining the shape as tuple, compared to find Barriers moved in place (see Scene.refresh) '''
+        return ()
+
+    def compile(self):
+        ''' Freezes the per hit constants of Lense.trace into self.compiled (see Scene.compile):
+            (ambient, diffuse, specular, reflection, shininess, normal, mirror) with the normal of flat
+            Barriers as float tuple and again normalized for reflections (mirror), else both None '''
+        t = self.texture
+        t.compile()
+        normal = self.fixedNormal()
+        mirror = None if normal is None else normalized_values(*normal)
+        self.compiled = (t.ambient_factor, t.diffuse_factor, t.specular_factor, t.reflection_factor, t.shininess_exponent, normal, mirror)
+
+    def fixedNormal(self):
+        ''' Normal of Barriers with the same normal everywhere as float tuple, None otherwise '''
+        return None
+
+    def normalValuesAt(self, x, y, z, face=-1):
+        ''' normalAt Point(x, y, z) (on face, see intersectionFace) as float tuple '''
+        n = self.normalAt(Point(x, y, z))
+        return (n.x, n.y, n.z)
     
     def colorAt(self, p):
         return self.texture.colorAt(p)
+
+    def colorsAt(self, points):
+        return self.texture.colorsAt(points)
     
     def get_ambient_factor(self):
         return self.texture.ambient_factor
@@ -178,10 +297,31 @@ class Sphere(Barrier):
             return None
         else:
             return v - math.sqrt(discriminant)
+
+    def intersectionParameters(self, origins, directions):
+        ''' intersectionParameter for (n,3) arrays of ray origins and directions, NaN where missed '''
+        co = numpy.subtract(self.center.values, origins)
+        v = dot_rows(co, directions)
+        discriminant = v**2 - dot_rows(co, co) + self.radius**2
+        with numpy.errstate(invalid='ignore'):
+            return v - numpy.sqrt(discriminant)
+
+    def bounds(self):
+        return (Point(numpy.subtract(self.center.values, self.radius)), Point(numpy.add(self.center.values, self.radius)))
+
+    def geometry(self):
+        return (self.center.x, self.center.y, self.center.z, self.radius)
     
     def normalAt(self, p):
         return (p - self.center).normalized()
 
+    def normalValuesAt(self, x, y, z, face=-1):
+        c = self.center
+        return normalized_values(x - c.x, y - c.y, z - c.z)
+
+    def normalsAt(self, points, faces=None):
+        return normalized_rows(numpy.subtract(points, self.center.values))
+
 
 class Plane(Barrier):
     ''' Plane Barrier (point on plane of Class Point, normal of Class Vector) '''
@@ -201,10 +341,25 @@ class Plane(Barrier):
             return -a/b
         else:
             return None
+
+    def intersectionParameters(self, origins, directions):
+        a = dot_rows(numpy.subtract(origins, self.point.values), self.normal.values)
+        b = dot_rows(directions, self.normal.values)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(b != 0, -a/b, numpy.nan)
     
+    def geometry(self):
+        return (self.point.x, self.point.y, self.point.z, self.normal.x, self.normal.y, self.normal.z)
+
     def normalAt(self, p):
         return self.normal
 
+    def fixedNormal(self):
+        return (self.normal.x, self.normal.y, self.normal.z)
+
+    def normalsAt(self, points, faces=None):
+        return numpy.broadcast_to(self.normal.values, points.shape)
+
 
 class Triangle(Barrier):
     ''' Triangle Barrier (corner Points a,b,c of Class Point) '''
@@ -233,21 +388,419 @@ class Triangle(Barrier):
         else:
             return None
 
+    def intersectionParameters(self, origins, directions):
+        w = numpy.subtract(origins, self.a.values)
+        dv = numpy.cross(directions, self.v.values)
+        dvu = dot_rows(dv, self.u.values)
+        wu = numpy.cross(w, self.u.values)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            r = dot_rows(dv, w) / dvu
+            s = dot_rows(wu, directions) / dvu
+            inside = (dvu != 0) & (0 <= r) & (r <= 1) & (0 <= s) & (s <= 1) & (r + s <= 1)
+            return numpy.where(inside, dot_rows(wu, self.v.values) / dvu, numpy.nan)
+
+    def bounds(self):
+        corners = numpy.array([self.a.values, self.b.values, self.c.values], dtype=float)
+        return (Point(corners.min(axis=0)), Point(corners.max(axis=0)))
+
+    def geometry(self):
+        return tuple(value for p in (self.a, self.u, self.v) for value in (p.x, p.y, p.z))
+
     def normalAt(self, p):
         return self.u.cross(self.v).normalized()
 
+    def fixedNormal(self):
+        n = self.normalAt(None)
+        return (n.x, n.y, n.z)
+
+    def normalsAt(self, points, faces=None):
+        return numpy.broadcast_to(self.normalAt(None).values, points.shape)
+
+
+class TriangleMesh(Barrier):
+    ''' Triangle Mesh Barrier (shared vertex/face arrays and a BVH over the faces, see get_bvh)
+
+        vertices (n,3) floats, faces (m,3) zero based vertex indices (see load_obj). Single Rays walk the
+        BVH face by face, Ray packets test the faces of whole subtrees in batches (see packet_faces).
+        The hit face comes back with the distance (see intersectionFace). '''
+    def __init__(self, vertices, faces, texture=None, material=None, dtype=numpy.float64,
+                 normals=None, texcoords=None, face_normals=None, face_texcoords=None):
+        if texture is None:
+            texture = Texture(Color(80, 80, 80), Material(1.0, 0.5, 0.5, 0.5, 5.0))
+        if material is not None:
+            texture = copy.copy(texture)
+            texture.set_material(material)
+        super(TriangleMesh, self).__init__(texture)
+        self.dtype = numpy.dtype(dtype)
+        self.vertices = numpy.ascontiguousarray(vertices, dtype=self.dtype)    # (n,3)
+        self.faces = numpy.ascontiguousarray(faces, dtype=numpy.int32)          # (m,3)
+        self.a = self.vertices[self.faces[:, 0]]                                # (m,3) first corners
+        self.u = self.vertices[self.faces[:, 1]] - self.a                       # (m,3) edges a->b
+        self.v = self.vertices[self.faces[:, 2]] - self.a                       # (m,3) edges a->c
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.normals = normalized_rows(numpy.cross(self.u, self.v))         # (m,3)
+        self.bvh = None                                                         # over the faces, see get_bvh
+        self.face_order = None                                                  # face of each BVH item
+        self.leaves = {}                                                        # {Leaf start: faces as float tuples}
+
+        # optional .obj data, kept for texturing / smooth shading
+        self.vertex_normals = normals                                           # (k,3)
+        self.texcoords = texcoords                                              # (j,2)
+        self.face_normals = face_normals                                        # (m,3) indices into vertex_normals
+        self.face_texcoords = face_texcoords                                    # (m,3) indices into texcoords
+        self.files = None                                                       # {argument: .npy path} when memory mapped (see scenefile)
+
+    def __repr__(self):
+        return 'TriangleMesh(%d vertices, %d faces)' %(len(self.vertices), len(self.faces))
+
+    def __getstate__(self):
+        ''' Meshes loaded from scene files are pickled as their file names, so workers map the
+            same files instead of receiving (and unpickling) copies of all arrays (and build the
+            face BVH themselves) '''
+        if self.files is None:
+            return dict(self.__dict__, leaves={})
+        return {'files': self.files, 'texture': self.texture, 'dtype': self.dtype, 'compiled': getattr(self, 'compiled', None)}
+
+    def __setstate__(self, state):
+        if state.get('files') is None:
+            self.__dict__.update(state)
+            return
+        arrays = dict((name, numpy.load(path, mmap_mode='r')) for name, path in state['files'].items())
+        self.__init__(texture=state['texture'], dtype=state['dtype'], **arrays)
+        self.files = state['files']
+        if state.get('compiled') is not None:
+            self.compiled = state['compiled']
+
+    def compile(self):
+        super(TriangleMesh, self).compile()
+        self.get_bvh()                                                          # built once, shipped to workers with the mesh
+
+    def get_bvh(self):
+        ''' BVH over the faces (their indices as Barriers), built once '''
+        if self.bvh is None:
+            corners = self.vertices[self.faces]
+            self.bvh = BVH(range(len(self.faces)), boxes=(corners.min(axis=1), corners.max(axis=1)))
+            self.face_order = numpy.array([face for face, _ in self.bvh.items], dtype=numpy.int64)
+            self.leaves = {}
+        return self.bvh
+
+    def leaf_triangles(self, start, count):
+        ''' (face, a, u, v as 9 floats) of the faces in the Leaf at start, converted on first use '''
+        faces = [face for face, _ in self.get_bvh().items[start:start + count]]
+        rows = numpy.hstack([self.a[faces], self.u[faces], self.v[faces]]).astype(float).tolist()
+        triangles = self.leaves[start] = [(face,) + tuple(row) for face, row in zip(faces, rows)]
+        return triangles
+
+    def face_parameters(self, origins, directions, faces=slice(None)):
+        ''' Batched Möller-Trumbore: (n,m) hit distances of n Rays with the selected m faces, NaN where missed
+
+            Computed in float64 whatever dtype the mesh is stored in, like closest_face and the kernels. '''
+        o = numpy.asarray(origins, dtype=float)[:, None, :]
+        d = numpy.asarray(directions, dtype=float)[:, None, :]
+        a, u, v = (numpy.asarray(values[faces], dtype=float)[None] for values in (self.a, self.u, self.v))
+        w = o - a
+        dv = numpy.cross(d, v)
+        dvu = dot_rows(dv, u)
+        wu = numpy.cross(w, u)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            r = dot_rows(dv, w) / dvu
+            s = dot_rows(wu, d) / dvu
+            inside = (dvu != 0) & (0 <= r) & (r <= 1) & (0 <= s) & (s <= 1) & (r + s <= 1)
+            return numpy.where(inside, dot_rows(wu, v) / dvu, numpy.nan)
+
+    def closest_faces(self, t):
+        ''' Closest positive distance and face per row of t ((n,m) from face_parameters), NaN/-1 where missed '''
+        t = numpy.where(t > 0, t, numpy.inf)
+        faces = numpy.argmin(t, axis=1)
+        dist = t[numpy.arange(len(t)), faces]
+        missed = dist == numpy.inf
+        return numpy.where(missed, numpy.nan, dist), numpy.where(missed, -1, faces)
+
+    def closest_face(self, ray, skip=-1):
+        ''' (distance, face) of the closest hit of ray with any face but skip, (None, -1) if missed
+
+            Walks the face BVH like BVH.closest_hit, the faces of a Leaf are tested on plain floats
+            rounding like face_parameters. Ties go to the lower face index (like closest_faces). '''
+        nodes = self.get_bvh().nodes
+        if not nodes:
+            return None, -1
+        o, d = ray.origin, ray.direction
+        ox, oy, oz = o.x, o.y, o.z
+        dx, dy, dz = d.x, d.y, d.z
+        ix, iy, iz = inverse(dx), inverse(dy), inverse(dz)
+        negative = (dx < 0, dy < 0, dz < 0)
+        leaves = self.leaves
+        closest_d, closest_f = math.inf, -1
+
+        stack = [0]
+        while stack:
+            lo, hi, axis, a, b, leaf = nodes[stack.pop()]
+            if slab_entry(lo, hi, ox, oy, oz, ix, iy, iz, closest_d) is None:
+                continue
+            if not leaf:
+                if negative[axis]:                                              # visit near child first
+                    stack.append(a)
+                    stack.append(b)
+                else:
+                    stack.append(b)
+                    stack.append(a)
+                continue
+            for face, ax, ay, az, ux, uy, uz, vx, vy, vz in leaves.get(a) or self.leaf_triangles(a, b):
+                if face == skip:
+                    continue
+                wx, wy, wz = ox - ax, oy - ay, oz - az
+                dvx, dvy, dvz = dy*vz - dz*vy, dz*vx - dx*vz, dx*vy - dy*vx
+                dvu = dvx*ux + dvy*uy + dvz*uz
+                if dvu == 0:
+                    continue
+                r = (dvx*wx + dvy*wy + dvz*wz) / dvu
+                if not 0 <= r <= 1:
+                    continue
+                wux, wuy, wuz = wy*uz - wz*uy, wz*ux - wx*uz, wx*uy - wy*ux
+                s = (wux*dx + wuy*dy + wuz*dz) / dvu
+                if not (0 <= s <= 1 and r + s <= 1):
+                    continue
+                t = (wux*vx + wuy*vy + wuz*vz) / dvu
+                if t > 0 and (t < closest_d or (t == closest_d and face < closest_f)):
+                    closest_d, closest_f = t, face
+        return (closest_d, closest_f) if closest_f >= 0 else (None, -1)
+
+    def intersectionFace(self, ray):
+        return self.closest_face(ray)
+
+    def intersectionParameter(self, ray):
+        return self.closest_face(ray)[0]
+
+    def selfIntersectionParameter(self, ray, face=-1):
+        ''' Intersection with any face except face (shadows cast by the mesh on itself) '''
+        return self.closest_face(ray, face)[0]
+
+    def packet_faces(self, origins, directions, skip=None):
+        ''' Closest distance and face per Ray of (n,3) arrays, NaN/-1 where missed (skip: face per Ray to leave out)
+
+            The face BVH is walked by the whole packet (see BVH.packet_ranges), the faces of each
+            reached subtree are tested in index order, so ties go to the lower face like closest_faces. '''
+        closest_d, closest_f = numpy.full(len(directions), numpy.inf), numpy.full(len(directions), -1)
+        bvh = self.get_bvh()
+        for first, count, rows in bvh.packet_ranges(origins, inverse_rows(directions), closest_d):
+            block = numpy.sort(self.face_order[first:first + count])
+            step = max(1, MESH_BATCH_SIZE // count)
+            for i in range(0, len(rows), step):
+                part = rows[i:i + step]
+                t = self.face_parameters(origins[part], directions[part], block)
+                if skip is not None:
+                    t[block[None, :] == skip[part][:, None]] = numpy.nan
+                dist, faces = self.closest_faces(t)
+                faces = block[faces]
+                better = (dist < closest_d[part]) | ((dist == closest_d[part]) & (faces < closest_f[part]))   # NaN compares False
+                closest_d[part[better]], closest_f[part[better]] = dist[better], faces[better]
+        closest_d[closest_f < 0] = numpy.nan
+        return closest_d, closest_f
+
+    def intersectionFaces(self, origins, directions):
+        return self.packet_faces(origins, directions)
+
+    def intersectionParameters(self, origins, directions):
+        return self.packet_faces(origins, directions)[0]
+
+    def selfIntersectionParameters(self, origins, directions, faces):
+        return self.packet_faces(origins, directions, faces)[0]
+
+    def bounds(self):
+        used = self.vertices[self.faces.ravel()]
+        return (Point(used.min(axis=0).astype(float)), Point(used.max(axis=0).astype(float)))
+
+    def geometry(self):
+        ''' The face arrays are derived once (see __init__), a moved mesh gets new ones '''
+        return (id(self.a), id(self.u), id(self.v), len(self.faces))
+
+    def normalAt(self, p, face=-1):
+        return Vector(self.normals[face].astype(float))
+
+    def normalValuesAt(self, x, y, z, face=-1):
+        return tuple(self.normals[face].tolist())
+
+    def normalsAt(self, points, faces=None):
+        return self.normals[faces].astype(float)
+
+
+def build_triangle_mesh(path, texture=None, material=None, dtype=numpy.float64, cache=True):
+    ''' Creating one TriangleMesh out of an .obj file (see load_obj) '''
+    obj = load_obj(path, cache)
+    return TriangleMesh(obj['vertices'], obj['faces'], texture, material, dtype,
+                        obj['normals'], obj['texcoords'], obj['face_normals'], obj['face_texcoords'])
+
 def build_triangular_network(path):
-    ''' Creating Vertices (Point(v x y z)) and Faces /Triangle(f v1_ord v2_ord v3_ord)) out of lines '''
-    vertices = ['cheat']
-    faces = []
-    with open(path) as data:
-        for line in data.readlines():
-            temp = line.split()
-            if temp[0] == 'v':
-                vertices.append(Point(float(temp[1]), float(temp[2]), float(temp[3])))
-            elif temp[0] == 'f':
-                faces.append(Triangle(vertices[int(temp[1])], vertices[int(temp[2])], vertices[int(temp[3])]))
-    return faces
+    ''' Creating Vertices (Point(v x y z)) and Faces /Triangle(f v1_ord v2_ord v3_ord)) out of an .obj file '''
+    obj = load_obj(path)
+    vertices = [Point(*v) for v in obj['vertices'].tolist()]
+    return [Triangle(vertices[a], vertices[b], vertices[c]) for a, b, c in obj['faces'].tolist()]
+
+
+# -----  OBJ Loader  ----------------------------------------------------------------------------------- #
+
+def load_obj(path, cache=True):
+    ''' Loads an .obj file into NumPy arrays
+
+        vertices (n,3), normals (k,3), texcoords (j,2) and the triangulated faces (m,3) with their
+        face_normals (m,3) / face_texcoords (m,3), all indices zero based (-1 where not given).
+        With cache the arrays are stored in <path>.npz and reused as long as the .obj is unchanged. '''
+    stat = os.stat(path)
+    key = numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+    cache_path = path + OBJ_CACHE_SUFFIX
+
+    if cache and os.path.exists(cache_path):
+        try:
+            with numpy.load(cache_path) as data:
+                if numpy.array_equal(data['key'], key):
+                    return {name: data[name] for name in OBJ_ARRAYS}
+        except (OSError, ValueError, KeyError):
+            pass                                                            # broken cache -> parse again
+
+    obj = parse_obj(path)
+    if cache:
+        temp_path = '%s.%d.tmp' %(cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                numpy.savez(f, key=key, **obj)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return obj
+
+def chunk_ranges(content, size=OBJ_CHUNK_SIZE):
+    ''' (start, end) byte ranges of about size bytes covering content, each ending after a line break '''
+    ranges, start = [], 0
+    while start < len(content):
+        end = content.find(b'\n', min(start + size, len(content)) - 1)
+        end = len(content) if end < 0 else end + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def token_text(buf, mask):
+    ''' The bytes of buf selected by mask as uint8 text, whitespace turned into spaces and one appended '''
+    text = numpy.append(buf[mask], numpy.uint8(32))
+    text[(text == 9) | (text == 10) | (text == 13)] = 32
+    return text
+
+def parse_numbers(text, count, dtype=numpy.float64):
+    ''' count whitespace separated numbers of a uint8 text array '''
+    values = numpy.fromstring(text.tobytes(), dtype=dtype, sep=' ') if count else numpy.zeros(0, dtype=dtype)
+    if len(values) != count:
+        raise ValueError('invalid number in .obj records')
+    return values
+
+def record_values(values, counts, width, required):
+    ''' First width of the counts values per record as (records, width) array, 0 for missing optional values '''
+    if (counts < required).any():
+        raise ValueError('.obj record with less than %d values' %(required))
+    first = numpy.cumsum(counts) - counts
+    given = numpy.arange(width) < counts[:, None]
+    result = numpy.zeros((len(counts), width))
+    result[given] = values[(first[:, None] + numpy.arange(width))[given]]
+    return result
+
+def parse_corners(text):
+    ''' Face corners 'v', 'v/vt', 'v//vn' or 'v/vt/vn' of a token text -> (corners, 3) index array, 0 where not given '''
+    slash = text == ord('/')
+    gap = text == 32
+    empty = numpy.flatnonzero(slash[:-1] & (slash[1:] | gap[1:])) + 1      # 'v//vn', 'v/vt/' -> fill in a 0
+    text = numpy.insert(text, empty, numpy.uint8(ord('0')))
+    slash = text == ord('/')
+    gap = text == 32
+    starts = numpy.flatnonzero(~gap & numpy.concatenate(([True], gap[:-1])))
+    fields = 1 + numpy.bincount(numpy.searchsorted(starts, numpy.flatnonzero(slash), 'right') - 1, minlength=len(starts))
+    text[slash] = 32
+    values = parse_numbers(text, int(fields.sum()), numpy.int64)
+
+    rows = numpy.repeat(numpy.arange(len(starts)), fields)
+    columns = numpy.arange(len(values)) - numpy.repeat(numpy.cumsum(fields) - fields, fields)
+    keep = columns < 3
+    corners = numpy.zeros((len(starts), 3), dtype=numpy.int64)
+    corners[rows[keep], columns[keep]] = values[keep]
+    return corners
+
+def parse_chunk(buf, totals):
+    ''' v/vt/vn/f records of one chunk (uint8 array of whole lines), totals are the (v, vt, vn) counts of the chunks before
+
+        Tokens are located with array operations, the numbers of each record type are converted in one call. '''
+    newline = buf == 10
+    gap = newline | (buf == 32) | (buf == 9) | (buf == 13)
+    starts = numpy.flatnonzero(~gap & numpy.concatenate(([True], gap[:-1])))
+    if not len(starts):                                                     # blank lines only
+        empty = dict((name, numpy.zeros((0, OBJ_RECORD_WIDTHS[name][0]))) for name in ('v', 'vt', 'vn'))
+        return dict(empty, corners=numpy.zeros((0, 3), dtype=numpy.int32), corner_counts=numpy.zeros(0, dtype=numpy.int64))
+    ends = numpy.flatnonzero(~gap & numpy.concatenate((gap[1:], [True]))) + 1
+    lines = numpy.searchsorted(numpy.flatnonzero(newline), starts)          # line of every token
+    keyword = numpy.concatenate(([True], lines[1:] != lines[:-1]))           # first token of a line
+
+    # record type per line from its keyword, 0 for everything else (comments, groups, materials ..)
+    first, length = starts[keyword], ends[keyword] - starts[keyword]
+    head = buf[first]
+    second = buf[numpy.minimum(first + 1, len(buf) - 1)]
+    kinds = numpy.zeros(len(first), dtype=numpy.int8)
+    kinds[(length == 1) & (head == ord('v'))] = 1
+    kinds[(length == 2) & (head == ord('v')) & (second == ord('t'))] = 2
+    kinds[(length == 2) & (head == ord('v')) & (second == ord('n'))] = 3
+    kinds[(length == 1) & (head == ord('f'))] = 4
+    record = numpy.cumsum(keyword) - 1
+    counts = numpy.bincount(record[~keyword], minlength=len(first))           # values per record
+
+    # record type of every byte of a value and the whitespace behind it
+    value_kinds = numpy.where(keyword, 0, kinds[record]).astype(numpy.int8)
+    bounds = numpy.concatenate(([0], numpy.stack([starts, ends], axis=1).ravel(), [len(buf)]))
+    labels = numpy.repeat(numpy.concatenate(([0], numpy.repeat(value_kinds, 2))).astype(numpy.int8), numpy.diff(bounds))
+
+    chunk = {}
+    for kind, name in enumerate(('v', 'vt', 'vn'), 1):
+        numbers = parse_numbers(token_text(buf, labels == kind), int((value_kinds == kind).sum()))
+        chunk[name] = record_values(numbers, counts[kinds == kind], *OBJ_RECORD_WIDTHS[name])
+    corners = parse_corners(token_text(buf, labels == 4))
+
+    # negative indices count back from the elements defined before the face, the rest are one based
+    faces = kinds == 4
+    offsets = numpy.stack([numpy.cumsum(kinds == kind)[faces] + total for kind, total in zip((1, 2, 3), totals)], axis=1)
+    offsets = numpy.repeat(offsets, counts[faces], axis=0)
+    chunk['corners'] = numpy.where(corners < 0, corners + offsets, corners - 1).astype(numpy.int32)
+    chunk['corner_counts'] = counts[faces]
+    return chunk
+
+def parse_obj(path, chunk_size=OBJ_CHUNK_SIZE):
+    ''' Parses v/vn/vt/f records of an .obj file (memory mapped) in chunks of about chunk_size bytes,
+        polygons are fan-triangulated '''
+    chunks, totals = [], (0, 0, 0)
+    if os.path.getsize(path):
+        with open(path, 'rb') as data, mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            for start, end in chunk_ranges(content, chunk_size):
+                chunks.append(parse_chunk(numpy.frombuffer(content[start:end], dtype=numpy.uint8), totals))
+                totals = tuple(total + len(chunks[-1][name]) for total, name in zip(totals, ('v', 'vt', 'vn')))
+
+    def joined(name, shape, dtype=numpy.float64):
+        return numpy.concatenate([chunk[name] for chunk in chunks] + [numpy.zeros(shape, dtype=dtype)])
+
+    vertices  = joined('v', (0, 3))
+    normals   = joined('vn', (0, 3))
+    texcoords = joined('vt', (0, 2))
+    corners   = joined('corners', (0, 3), numpy.int32)                      # (corners, v/vt/vn), -1 where not given
+    corner_counts = joined('corner_counts', 0, numpy.int64)
+
+    # fan triangulation (c0, ci, ci+1) of each polygon
+    triangles = numpy.maximum(corner_counts - 2, 0)
+    first = numpy.repeat(numpy.cumsum(corner_counts) - corner_counts, triangles)
+    step = numpy.arange(triangles.sum()) - numpy.repeat(numpy.cumsum(triangles) - triangles, triangles)
+    ids = numpy.stack([first, first + step + 1, first + step + 2], axis=1)
+    tris = corners[ids]                                                     # (m, 3 corners, v/vt/vn)
+
+    return {
+        'vertices': vertices,
+        'normals': normals,
+        'texcoords': texcoords,
+        'faces': numpy.ascontiguousarray(tris[:, :, 0]),
+        'face_texcoords': numpy.ascontiguousarray(tris[:, :, 1]),
+        'face_normals': numpy.ascontiguousarray(tris[:, :, 2]),
+    }
 
 
 # -----  Light  ---------------------------------------------------------------------------------------- #
@@ -0,0 +1,359 @@
+# Description
+'''
+Render Farm
+
+Renders the Tiles of a capture on worker Processes of other hosts. The capturing Process is
+the coordinator (Lense.capture(farm=address) uses a FarmRenderer instead of the local Pool),
+workers connect to it over TCP (multiprocessing.connection, pickled messages authenticated
+with authkey - only run workers for coordinators you trust). There is no default key: it is
+given with --authkey or $RAYTRACER_FARM_AUTHKEY, a coordinator without one makes up a random
+key and prints it. Coordinators listen on localhost unless another address is given:
+
+    python farm.py render sc0 --address 0.0.0.0:25250 --width 1280 --height 768
+    RAYTRACER_FARM_AUTHKEY=<key> python farm.py worker coordinator-host:25250 --processes 8
+
+Every worker gets the Lense (with Scene and BVH) once and then pulls Tiles. Workers send a
+heartbeat while rendering, Tiles of workers that disconnect or stay silent for longer than
+HEARTBEAT_TIMEOUT are handed out again. Workers can join and leave at any time.
+'''
+
+# Imports
+import argparse, collections, os, queue, secrets, socket, threading, time
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import numpy
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+FARM_HOST = '127.0.0.1'     # coordinators listen on this host unless told otherwise
+FARM_PORT = 25250
+FARM_AUTHKEY_VARIABLE = 'RAYTRACER_FARM_AUTHKEY'     # environment variable holding the shared secret
+HEARTBEAT_INTERVAL = 2.0    # seconds between two heartbeats of a worker
+HEARTBEAT_TIMEOUT = 10.0    # silent workers are given up after this many seconds
+RETRY_INTERVAL = 1.0        # seconds between two connection attempts of a worker
+
+
+def parse_address(address):
+    ''' (host, port) from 'host:port', ':port' or a (host, port) tuple '''
+    if isinstance(address, str):
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+    return tuple(address)
+
+def farm_authkey(authkey=None):
+    ''' authkey as bytes, else the one in $RAYTRACER_FARM_AUTHKEY, else None '''
+    authkey = authkey or os.environ.get(FARM_AUTHKEY_VARIABLE)
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    return authkey or None
+
+
+# -----  Coordinator  ---------------------------------------------------------------------------------- #
+
+class RemoteWorker():
+    ''' Coordinator side of one worker connection '''
+    def __init__(self, conn, version):
+        self.conn = conn
+        self.name = '?'
+        self.seen = time.time()                                                 # last message
+        self.version = version                                                  # Scene version it knows
+        self.tasks = set()                                                      # ids of the Tiles it renders
+
+    def __repr__(self):
+        return 'RemoteWorker(%s, %d tiles)' %(self.name, len(self.tasks))
+
+
+class FarmRenderer():
+    ''' Renders Tiles of one Lense on remote workers (see run_worker), used like TileRenderer
+
+        Tasks are queued until a worker asks for one, the worker gets the task with the current
+        pixels of its Tile (refine and progressive passes build on them) and sends the rendered
+        Tile back, which is then written into the Framebuffer. The first result of a Tile wins,
+        late results of Tiles handed out again are dropped.
+        Without authkey (see farm_authkey) a random one is made up and printed for the workers. '''
+    def __init__(self, lense, framebuffer, address=(FARM_HOST, FARM_PORT), authkey=None, timeout=HEARTBEAT_TIMEOUT):
+        self.lense = lense
+        self.framebuffer = framebuffer
+        self.address = parse_address(address)
+        self.authkey = farm_authkey(authkey)
+        self.generated = self.authkey is None
+        if self.generated:
+            self.authkey = secrets.token_urlsafe(24).encode()
+        self.timeout = timeout
+        self.listener = None
+        self.acceptor = None
+        self.closed = False
+        self.lock = threading.Condition()
+        self.pending = collections.deque()                                      # task ids waiting for a worker
+        self.outstanding = {}                                                   # {task id: task} not finished yet
+        self.results = queue.Queue()                                            # finished (task, result)
+        self.workers = []                                                       # connected RemoteWorkers
+        self.next_id = 0
+        self.version = 0                                                        # number of Scene updates so far
+        self.updates = {}                                                       # {index: Barrier} changed since start
+
+    def __repr__(self):
+        return 'FarmRenderer(%s:%d, %d workers)' %(self.address[0], self.address[1], len(self.workers))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.listener is None:
+            self.closed = False
+            self.listener = Listener(self.address, authkey=self.authkey)
+            self.acceptor = threading.Thread(target=self.accept, daemon=True)
+            self.acceptor.start()
+            print('|-- Waiting for render workers at %s:%d' %(self.listener.address))
+            if self.generated:
+                print('|-- Workers need %s=%s' %(FARM_AUTHKEY_VARIABLE, self.authkey.decode()))
+
+    def close(self):
+        ''' Ends the job, workers are told so the next time they ask for a Tile '''
+        if self.listener is None:
+            return
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        host, port = self.listener.address
+        try:
+            socket.create_connection(('127.0.0.1' if host in ('', '0.0.0.0') else host, port)).close()     # wakes accept
+        except OSError:
+            pass
+        self.acceptor.join()
+        self.listener.close()
+        self.listener = None
+
+    def update(self, changes):
+        ''' Puts changed Barriers {index: Barrier} into the Scene (here and, lazily, in every worker) '''
+        self.lense.scene.update_barriers(changes)
+        with self.lock:
+            self.version += 1
+            self.updates.update(changes)
+
+    def render(self, tasks):
+        ''' Renders all tasks (arguments of Lense.compute_tile), yields (task, result) as they finish '''
+        with self.lock:
+            count = 0
+            for task in tasks:
+                self.outstanding[self.next_id] = task
+                self.pending.append(self.next_id)
+                self.next_id += 1
+                count += 1
+            self.lock.notify_all()
+
+        while count:
+            self.check()
+            try:
+                task, result = self.results.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                continue
+            self.framebuffer.release(task[1], task[3])
+            count -= 1
+            yield task, result
+
+    def check(self):
+        ''' Gives up workers silent for longer than timeout, their Tiles are handed out again '''
+        now = time.time()
+        for worker in list(self.workers):
+            if now - worker.seen > self.timeout:
+                self.drop(worker, 'silent for %.0f seconds' %(now - worker.seen))
+
+    def drop(self, worker, reason):
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            lost = [task_id for task_id in worker.tasks if task_id in self.outstanding]
+            self.pending.extendleft(sorted(lost, reverse=True))
+            worker.tasks.clear()
+            self.lock.notify_all()
+        print('|-- Worker %s %s, handing out %d Tiles again' %(worker.name, reason, len(lost)))
+
+    # -----  Connections  ----- #
+
+    def accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue                                                        # failed handshakes (and the wake up of close)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        ''' Handles the messages of one worker until it disconnects '''
+        worker = RemoteWorker(conn, self.version)
+        try:
+            kind, worker.name = conn.recv()
+            conn.send(('job', self.lense))
+            with self.lock:
+                self.workers.append(worker)
+            print('|-- Worker %s joined' %(worker.name))
+            while True:
+                message = conn.recv()
+                worker.seen = time.time()
+                if worker not in self.workers:
+                    with self.lock:
+                        self.workers.append(worker)                             # back after being given up
+                if message[0] == 'next':
+                    conn.send(self.assign(worker))
+                    if self.closed:
+                        break
+                elif message[0] == 'result':
+                    self.finish(worker, *message[1:])
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.drop(worker, 'left')
+            conn.close()
+
+    def assign(self, worker):
+        ''' Next message for worker: ('task', id, task, pixels, updates), ('wait',) or ('done',) '''
+        with self.lock:
+            self.lock.wait_for(lambda: self.pending or self.closed, HEARTBEAT_INTERVAL)
+            if self.closed:
+                return ('done',)
+            while self.pending:
+                task_id = self.pending.popleft()
+                if task_id in self.outstanding:
+                    break
+            else:
+                return ('wait',)
+            task = self.outstanding[task_id]
+            worker.tasks.add(task_id)
+            updates = None
+            if worker.version != self.version:
+                updates = dict(self.updates)
+                worker.version = self.version
+        x0, y0, x1, y1 = task[:4]
+        return ('task', task_id, task, self.framebuffer.pixels[y0:y1, x0:x1].copy(), updates)
+
+    def finish(self, worker, task_id, pixels, result):
+        with self.lock:
+            worker.tasks.discard(task_id)
+            task = self.outstanding.pop(task_id, None)
+            if task is None:
+                return                                                          # already rendered by another worker
+            x0, y0, x1, y1 = task[:4]
+            self.framebuffer.pixels[y0:y1, x0:x1] = pixels
+        self.results.put((task, result))
+
+
+# -----  Worker  --------------------------------------------------------------------------------------- #
+
+def run_worker(address, authkey=None, once=False, name=None):
+    ''' Renders Tiles for the coordinator at address, waiting for it if it is not up (yet)
+
+        authkey defaults to $RAYTRACER_FARM_AUTHKEY (see farm_authkey), there is no fallback.
+        Serves one job after another, with once only the first one. '''
+    address = parse_address(address)
+    authkey = farm_authkey(authkey)
+    if authkey is None:
+        raise ValueError('no authkey, pass one or set %s' %(FARM_AUTHKEY_VARIABLE))
+    name = name or '%s:%d' %(socket.gethostname(), os.getpid())
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+        except OSError:
+            time.sleep(RETRY_INTERVAL)
+            continue
+        try:
+            work(conn, name)
+        except (EOFError, OSError):
+            pass                                                                # coordinator gone, job over
+        finally:
+            conn.close()
+        if once:
+            return
+
+def work(conn, name):
+    ''' Renders Tiles of one job until the coordinator is done '''
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send(('heartbeat',))
+            except (OSError, ValueError):
+                return
+
+    send(('hello', name))
+    kind, lense = conn.recv()
+    pixels = numpy.zeros((lense.h, lense.w, 3), dtype=numpy.uint8)             # only the rendered Tiles take up memory
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        while True:
+            send(('next',))
+            message = conn.recv()
+            if message[0] == 'done':
+                return
+            if message[0] == 'wait':
+                continue
+            kind, task_id, task, tile, updates = message
+            if updates:
+                lense.scene.update_barriers(updates)
+            x0, y0, x1, y1 = task[:4]
+            pixels[y0:y1, x0:x1] = tile
+            result = lense.compute_tile(pixels, *task)
+            send(('result', task_id, pixels[y0:y1, x0:x1].copy(), result))
+    finally:
+        stopped.set()
+
+
+# -----  Command Line  --------------------------------------------------------------------------------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Renders the built-in Scenes on several hosts')
+    parser.add_argument('--authkey', default=None, help='shared secret of coordinator and workers (default: $%s, '
+                        'render makes up one)' %(FARM_AUTHKEY_VARIABLE))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    worker = commands.add_parser('worker', help='render Tiles for a coordinator')
+    worker.add_argument('address', help='host:port of the coordinator')
+    worker.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='worker Processes on this host (default %(default)s)')
+    worker.add_argument('--once', action='store_true', help='exit after one job')
+
+    render = commands.add_parser('render', help='coordinate the rendering of a built-in Scene')
+    render.add_argument('scene', help='sc0 .. sc4')
+    render.add_argument('--address', default='%s:%d' %(FARM_HOST, FARM_PORT),
+                        help='host:port to listen on (default %(default)s, 0.0.0.0:port for all interfaces)')
+    render.add_argument('--width', type=int, default=640)
+    render.add_argument('--height', type=int, default=384)
+    render.add_argument('--output', default='default.png')
+    render.add_argument('--backend', default='python', choices=['python', 'numpy', 'numba'])
+    render.add_argument('--antialias', type=int, default=1, help='max. samples per edge pixel')
+    args = parser.parse_args(argv)
+    authkey = farm_authkey(args.authkey)
+
+    if args.command == 'worker':
+        if authkey is None:
+            parser.error('workers need --authkey or $%s' %(FARM_AUTHKEY_VARIABLE))
+        processes = [multiprocessing.Process(target=run_worker, args=(args.address, authkey, args.once)) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return 0
+
+    import camera
+    scenes = camera.build_scenes()
+    if args.scene not in scenes:
+        parser.error('unknown scene %s' %(args.scene))
+    lense, scene = scenes[args.scene]
+    lense.capture(scene, {'width': args.width, 'height': args.height}, args.output, backend=args.backend, antialias=args.antialias,
+                  farm=args.address, authkey=authkey)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,127 @@
+# Description
+'''
+Framebuffers shared between the rendering Processes
+'''
+
+# Imports
+import os, mmap, numpy
+from multiprocessing import shared_memory
+
+__author__ = 'Jan Ningelgen'
+
+
+# -----  Framebuffer  ---------------------------------------------------------------------------------- #
+
+class SharedFramebuffer():
+    ''' (height, width, 3) uint8 Image living in multiprocessing.shared_memory
+
+        Created once by the capturing Process, worker Processes attach to it by name (see spec)
+        and write their Tiles directly into pixels - no Pixel data is sent back over pipes. '''
+    def __init__(self, width, height, name=None):
+        self.width = width
+        self.height = height
+        self.owner = name is None
+        size = max(1, width * height * 3)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.pixels = numpy.ndarray((height, width, 3), dtype=numpy.uint8, buffer=self.shm.buf)
+        if self.owner:
+            self.pixels[:] = 0
+
+    def __repr__(self):
+        return 'SharedFramebuffer(%d x %d, %s)' %(self.width, self.height, self.shm.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def spec(self):
+        ''' Picklable description used by open_framebuffer in other Processes '''
+        return ('shared', self.width, self.height, self.shm.name)
+
+    def release(self, y0=0, y1=None):
+        ''' Nothing to release, shared memory always lives in RAM (see DiskFramebuffer.release) '''
+
+    def close(self):
+        ''' Releases the mapping (and the shared memory itself when owning it) '''
+        if self.shm is None:
+            return
+        self.pixels = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+class DiskFramebuffer():
+    ''' (height, width, 3) uint8 Image in a memory mapped file
+
+        For images larger than memory: all Processes map the same file (see spec), finished rows
+        are dropped from their mappings (see release) and the image is streamed from the file into
+        the output (see writers), so memory use stays flat for any resolution.
+        The creating Framebuffer removes the file on close unless keep is set. '''
+    def __init__(self, width, height, path, create=True, keep=False):
+        self.width = width
+        self.height = height
+        self.path = path
+        self.owner = create
+        self.keep = keep
+        size = max(1, width * height * 3)
+        with open(path, 'w+b' if create else 'r+b') as f:
+            if create:
+                f.truncate(size)                                                # sparse, reads as black
+            self.mmap = mmap.mmap(f.fileno(), size)
+        self.pixels = numpy.ndarray((height, width, 3), dtype=numpy.uint8, buffer=self.mmap)
+
+    def __repr__(self):
+        return 'DiskFramebuffer(%d x %d, %s)' %(self.width, self.height, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def spec(self):
+        ''' Picklable description used by open_framebuffer in other Processes '''
+        return ('disk', self.width, self.height, self.path)
+
+    def release(self, y0=0, y1=None):
+        ''' Drops rows [y0:y1] from this Process' memory, they stay in the file (and the OS cache) '''
+        if self.mmap is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        row = self.width * 3
+        start = (y0 * row) // mmap.PAGESIZE * mmap.PAGESIZE
+        end = len(self.mmap) if y1 is None else min(y1 * row, len(self.mmap))
+        if end > start:
+            self.mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def flush(self):
+        ''' Writes the pixels back to the file (see checkpoint) '''
+        if self.mmap is not None:
+            self.mmap.flush()
+
+    def close(self):
+        ''' Writes back and unmaps the pixels (and removes the file when owning it) '''
+        if self.mmap is None:
+            return
+        self.pixels = None
+        self.mmap.flush()
+        self.mmap.close()
+        self.mmap = None
+        if self.owner and not self.keep and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_framebuffer(spec):
+    ''' Attaches to the Framebuffer described by spec (see SharedFramebuffer.spec) '''
+    kind, width, height, name = spec
+    if kind == 'shared':
+        return SharedFramebuffer(width, height, name)
+    if kind == 'disk':
+        return DiskFramebuffer(width, height, name, create=False)
+    raise ValueError('unknown framebuffer %s' %(repr(kind)))
@@ -0,0 +1,432 @@
+# Description
+'''
+Compiled Rendering Kernels (Numba)
+
+The Scene is flattened into plain arrays (SceneArrays) and traced by njit compiled functions,
+following Lense.trace / compute_light / diffuse_specular step by step. Without Numba installed
+the kernels are not used and Lense falls back to the pure Python backend (see available).
+'''
+
+# Imports
+import math, numpy
+from elements import *
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+SPHERE, PLANE, TRIANGLE = 0, 1, 2                       # primitive kinds
+PLAIN, CHECKERBOARD = 0, 1                              # texture kinds
+
+
+def available():
+    ''' True if Numba is installed and the compiled backend can be used '''
+    return numba is not None
+
+def jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+# -----  Scene Arrays  --------------------------------------------------------------------------------- #
+
+class SceneArrays():
+    ''' Scene flattened into arrays for the kernels
+
+        Every Barrier becomes one or more primitives (a TriangleMesh one per face), listed in Barrier
+        order so ties are resolved like in Lense.trace. Per primitive: kind, owning Barrier, face and
+        12 floats (sphere: center, radius / plane: point, normal / triangle: a, u, v, normal).
+
+        The Scene BVH and the face BVH of every mesh are flattened into one Node list: bounds (lo, hi),
+        links (axis, left|start, right|count, is_leaf) and the Leaf items, primitives or -1 - root Node
+        of a mesh. Primitives without bounds are listed in unbounded. '''
+    def __init__(self, scene):
+        kinds, owners, faces, data, starts = [], [], [], [], []
+        self.mesh = numpy.zeros(len(scene.barriers), dtype=numpy.bool_)
+        self.materials = numpy.zeros((len(scene.barriers), 5))               # ambient, diffuse, specular, reflection, shininess
+        self.textures = numpy.zeros(len(scene.barriers), dtype=numpy.int64)
+        self.texture_colors = numpy.zeros((len(scene.barriers), 6))          # primary, secondary
+        self.texture_sizes = numpy.ones(len(scene.barriers))
+
+        for i, b in enumerate(scene.barriers):
+            starts.append(sum(len(k) for k in kinds))                       # first primitive of b
+            if isinstance(b, TriangleMesh):
+                n = len(b.faces)
+                kinds.append(numpy.full(n, TRIANGLE))
+                faces.append(numpy.arange(n))
+                data.append(numpy.hstack([b.a, b.u, b.v, b.normals]).astype(float))
+                self.mesh[i] = True
+            else:
+                n = 1
+                faces.append(numpy.zeros(1, dtype=int))
+                row = numpy.zeros((1, 12))
+                if isinstance(b, Sphere):
+                    kinds.append(numpy.full(1, SPHERE))
+                    row[0, :4] = (b.center[0], b.center[1], b.center[2], b.radius)
+                elif isinstance(b, Plane):
+                    kinds.append(numpy.full(1, PLANE))
+                    row[0, :6] = numpy.concatenate([b.point.values, b.normal.values])
+                elif isinstance(b, Triangle):
+                    kinds.append(numpy.full(1, TRIANGLE))
+                    row[0] = numpy.concatenate([b.a.values, b.u.values, b.v.values, b.normalAt(None).values])
+                else:
+                    raise TypeError('%s can not be compiled' %(repr(b)))
+                data.append(row)
+            owners.append(numpy.full(n, i))
+
+            self.materials[i] = (b.get_ambient_factor(), b.get_diffuse_factor(), b.get_specular_factor(),
+                                 b.get_reflection_factor(), b.get_shininess_exponent())
+            self.texture_colors[i, :3] = b.texture.primary.values
+            if isinstance(b.texture, Checkerboard):
+                self.textures[i] = CHECKERBOARD
+                self.texture_colors[i, 3:] = b.texture.secondary.values
+                self.texture_sizes[i] = b.texture.size
+
+        self.kinds = numpy.concatenate(kinds).astype(numpy.int64) if kinds else numpy.zeros(0, dtype=numpy.int64)
+        self.owners = numpy.concatenate(owners).astype(numpy.int64) if owners else numpy.zeros(0, dtype=numpy.int64)
+        self.faces = numpy.concatenate(faces).astype(numpy.int64) if faces else numpy.zeros(0, dtype=numpy.int64)
+        self.data = numpy.ascontiguousarray(numpy.vstack(data)) if data else numpy.zeros((0, 12))
+
+        self.flatten(scene.get_bvh(), scene.barriers, starts)
+
+        self.lights = numpy.array([numpy.concatenate([l.origin.values, l.color.values]) for l in scene.lights], dtype=float).reshape(-1, 6)
+        self.light_samples = int(scene.light_samples or 0)                   # 0: all lights
+        self.global_ambient_factor = float(scene.global_ambient_factor)
+
+    def __repr__(self):
+        return 'SceneArrays(%d primitives, %d nodes)' %(len(self.kinds), len(self.links))
+
+    def flatten(self, bvh, barriers, starts):
+        ''' Node arrays of bvh (the Scene BVH) with the face BVH of each mesh below its Leaf item '''
+        bounds, links, items, meshes = [], [], [], []
+        def append(tree, entries):
+            base, first = len(links), len(items)
+            for lo, hi, axis, a, b, leaf in tree.nodes:
+                bounds.append(lo + hi)
+                links.append((axis, first + a, b, 1) if leaf else (axis, base + a, base + b, 0))
+            items.extend(entries)
+            return base
+
+        entries = []
+        for i, barrier in bvh.items:
+            if isinstance(barriers[i], TriangleMesh):
+                meshes.append((len(entries), barriers[i], starts[i]))
+            entries.append(starts[i])
+        append(bvh, entries)
+        for position, mesh, start in meshes:
+            root = append(mesh.get_bvh(), (start + mesh.face_order).tolist())
+            items[position] = -1 - root
+
+        self.bounds = numpy.array(bounds, dtype=float).reshape(-1, 6)
+        self.links = numpy.array(links, dtype=numpy.int64).reshape(-1, 4)
+        self.items = numpy.array(items, dtype=numpy.int64)
+        self.unbounded = numpy.array([starts[i] for i, b in bvh.unbounded], dtype=numpy.int64)
+
+
+# -----  Rendering  ------------------------------------------------------------------------------------ #
+
+def render_tile(lense, x0, y0, x1, y1, depth):
+    ''' Renders pixels [y0:y1, x0:x1] of a prepared Lense into a (y1-y0, x1-x0, 3) uint8 array '''
+    xs, ys = numpy.meshgrid(numpy.arange(x0, x1), numpy.arange(y0, y1))
+    return render_pixels(lense, xs.ravel(), ys.ravel(), depth).astype(numpy.uint8).reshape(y1 - y0, x1 - x0, 3)
+
+def render_pixels(lense, xs, ys, depth):
+    ''' Renders the (possibly fractional) pixels (xs[i], ys[i]) of a prepared Lense into (n,3) float Colors '''
+    arrays = lense.scene.get_arrays()
+    camera = numpy.array([lense.h, lense.pixel_height, lense.sensor_height, lense.pixel_width, lense.sensor_width], dtype=float)
+    axes = numpy.array([lense.origin.values, lense.f.values, lense.s.values, lense.u.values], dtype=float)
+    out = numpy.zeros((len(xs), 3))
+    tree = (arrays.unbounded, arrays.bounds, arrays.links, arrays.items)
+    seed = (int(ys[0]) * lense.w + int(xs[0])) if len(xs) else 0                   # light sampling, same per Tile
+    render_kernel(numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float), camera, axes, depth,
+                  arrays.kinds, arrays.owners, arrays.faces, arrays.data, arrays.mesh, tree, arrays.materials,
+                  arrays.textures, arrays.texture_colors, arrays.texture_sizes, arrays.lights, arrays.light_samples,
+                  seed, arrays.global_ambient_factor, float(lense.min_contribution), float(lense.roulette_weight), out)
+    return out
+
+
+# -----  Kernels  -------------------------------------------------------------------------------------- #
+
+@jit
+def render_kernel(xs, ys, camera, axes, depth, kinds, owners, faces, data, mesh, tree, materials,
+                  textures, texture_colors, texture_sizes, lights, samples, seed, global_ambient, min_contribution,
+                  roulette_weight, out):
+    h, pixel_height, sensor_height, pixel_width, sensor_width = camera[0], camera[1], camera[2], camera[3], camera[4]
+    levels = numpy.zeros((depth + 1, 3))
+    reflections = numpy.zeros(depth + 1)
+    order = numpy.arange(len(lights))                                       # light indices, first ones are shaded
+    last = numpy.full(len(lights), -1)                                      # primitive that shadowed last per light
+    stack = numpy.zeros(len(tree[2]) + 1, dtype=numpy.int64)               # Nodes to visit, each is pushed once at most
+    numpy.random.seed(seed)
+    for i in range(len(xs)):
+        # Lense.compute_ray
+        yf = (h - ys[i])*pixel_height - sensor_height/2
+        xf = xs[i]*pixel_width - sensor_width/2
+        dx = axes[1, 0] + axes[2, 0]*xf + axes[3, 0]*yf
+        dy = axes[1, 1] + axes[2, 1]*xf + axes[3, 1]*yf
+        dz = axes[1, 2] + axes[2, 2]*xf + axes[3, 2]*yf
+        inv = 1/math.sqrt(dx*dx + dy*dy + dz*dz)
+        dx, dy, dz = dx*inv, dy*inv, dz*inv
+        ox, oy, oz = axes[0, 0], axes[0, 1], axes[0, 2]
+
+        # Lense.trace, recursion unrolled: light and reflection factor per level
+        count = 0
+        weight = 1.0
+        for level in range(depth + 1):
+            t, p = closest_hit(ox, oy, oz, dx, dy, dz, kinds, data, tree, stack)
+            if p < 0:
+                break
+            b = owners[p]
+            px, py, pz = ox + dx*t, oy + dy*t, oz + dz*t
+            nx, ny, nz = normal_at(kinds[p], data[p], px, py, pz)
+            r, g, bl = compute_light(b, faces[p], px, py, pz, nx, ny, nz, dx, dy, dz, kinds, owners, faces, data, mesh,
+                                     tree, stack, materials, textures, texture_colors, texture_sizes, lights, samples, order,
+                                     last, global_ambient)
+            levels[level, 0], levels[level, 1], levels[level, 2] = r, g, bl
+            reflections[level] = materials[b, 3]
+            count += 1
+
+            # stop where the reflection would not be traced (see Lense.trace)
+            weight *= materials[b, 3]
+            if level == depth or materials[b, 3] <= 0 or weight < min_contribution:
+                break
+            if weight < roulette_weight:
+                survival = weight / roulette_weight
+                if numpy.random.random() >= survival:
+                    break
+                reflections[level] /= survival
+                weight = roulette_weight
+
+            # Vector.reflect_on (normal normalized again) and Ray (direction normalized)
+            inv = 1/math.sqrt(nx*nx + ny*ny + nz*nz)
+            mx, my, mz = nx*inv, ny*inv, nz*inv
+            k = (mx*dx + my*dy + mz*dz)*2
+            rx, ry, rz = dx - mx*k, dy - my*k, dz - mz*k
+            inv = 1/math.sqrt(rx*rx + ry*ry + rz*rz)
+            ox, oy, oz, dx, dy, dz = px, py, pz, rx*inv, ry*inv, rz*inv
+
+        # Color of level k = clip(light_k + Color of level k+1 * reflection_k)
+        r, g, bl = 0.0, 0.0, 0.0
+        for level in range(count - 1, -1, -1):
+            if level == depth:
+                r, g, bl = levels[level, 0], levels[level, 1], levels[level, 2]
+            else:
+                r = clip(levels[level, 0] + r*reflections[level])
+                g = clip(levels[level, 1] + g*reflections[level])
+                bl = clip(levels[level, 2] + bl*reflections[level])
+        out[i, 0], out[i, 1], out[i, 2] = r, g, bl
+
+@jit
+def clip(c):
+    return min(max(c, 0.0), 255.0)
+
+@jit
+def intersect(kind, d, ox, oy, oz, dx, dy, dz):
+    ''' intersectionParameter of one primitive, NaN where missed '''
+    if kind == SPHERE:
+        cx, cy, cz = d[0] - ox, d[1] - oy, d[2] - oz
+        v = cx*dx + cy*dy + cz*dz
+        discriminant = v**2 - (cx*cx + cy*cy + cz*cz) + d[3]**2
+        if discriminant < 0:
+            return math.nan
+        return v - math.sqrt(discriminant)
+    if kind == PLANE:
+        a = (ox - d[0])*d[3] + (oy - d[1])*d[4] + (oz - d[2])*d[5]
+        b = dx*d[3] + dy*d[4] + dz*d[5]
+        if b == 0:
+            return math.nan
+        return -a/b
+    # triangle
+    wx, wy, wz = ox - d[0], oy - d[1], oz - d[2]
+    ux, uy, uz, vx, vy, vz = d[3], d[4], d[5], d[6], d[7], d[8]
+    dvx, dvy, dvz = dy*vz - dz*vy, dz*vx - dx*vz, dx*vy - dy*vx
+    dvu = dvx*ux + dvy*uy + dvz*uz
+    if dvu == 0.0:
+        return math.nan
+    wux, wuy, wuz = wy*uz - wz*uy, wz*ux - wx*uz, wx*uy - wy*ux
+    r = (dvx*wx + dvy*wy + dvz*wz) / dvu
+    s = (wux*dx + wuy*dy + wuz*dz) / dvu
+    if 0 <= r <= 1 and 0 <= s <= 1 and r + s <= 1:
+        return (wux*vx + wuy*vy + wuz*vz) / dvu
+    return math.nan
+
+@jit
+def slab(lo, hi, o, inv, tmin, tmax):
+    ''' One axis of bvh.slab_entry, the narrowed (tmin, tmax) '''
+    if inv == math.inf:
+        if o < lo or o > hi:
+            return math.inf, -math.inf
+        return tmin, tmax
+    t0 = (lo - o)*inv
+    t1 = (hi - o)*inv
+    if t0 > t1:
+        t0, t1 = t1, t0
+    return max(tmin, t0), min(tmax, t1)
+
+@jit
+def box_entered(box, ox, oy, oz, ix, iy, iz, t_far):
+    ''' bvh.slab_entry: True if the box (lo, hi) is entered within (0, t_far] '''
+    tmin, tmax = slab(box[0], box[3], ox, ix, 0.0, t_far)
+    tmin, tmax = slab(box[1], box[4], oy, iy, tmin, tmax)
+    tmin, tmax = slab(box[2], box[5], oz, iz, tmin, tmax)
+    return tmin <= tmax
+
+@jit
+def inverse(d):
+    if d == 0:
+        return math.inf
+    return 1.0/d
+
+@jit
+def closest_hit(ox, oy, oz, dx, dy, dz, kinds, data, tree, stack):
+    ''' (distance, primitive) of the closest hit, (inf, -1) if missed
+
+        Walks the Nodes of tree (see SceneArrays) near child first like BVH.closest_hit,
+        equal distances go to the lower primitive as in a loop over all of them. '''
+    unbounded, bounds, links, items = tree
+    closest_d, closest_p = math.inf, -1
+    for p in unbounded:
+        t = intersect(kinds[p], data[p], ox, oy, oz, dx, dy, dz)
+        if t > 0 and t < closest_d:
+            closest_d, closest_p = t, p
+    if len(links) == 0:
+        return closest_d, closest_p
+
+    ix, iy, iz = inverse(dx), inverse(dy), inverse(dz)
+    stack[0], top = 0, 1
+    while top:
+        top -= 1
+        node = stack[top]
+        if not box_entered(bounds[node], ox, oy, oz, ix, iy, iz, closest_d):
+            continue
+        axis, a, b, leaf = links[node, 0], links[node, 1], links[node, 2], links[node, 3]
+        if leaf:
+            for k in range(a, a + b):
+                p = items[k]
+                if p < 0:                                                   # root Node of a mesh
+                    stack[top], top = -1 - p, top + 1
+                    continue
+                t = intersect(kinds[p], data[p], ox, oy, oz, dx, dy, dz)
+                if t > 0 and (t < closest_d or (t == closest_d and p < closest_p)):
+                    closest_d, closest_p = t, p
+        elif (dx if axis == 0 else dy if axis == 1 else dz) < 0:            # visit near child first
+            stack[top], stack[top + 1], top = a, b, top + 2
+        else:
+            stack[top], stack[top + 1], top = b, a, top + 2
+    return closest_d, closest_p
+
+@jit
+def occluded(b, face, ox, oy, oz, dx, dy, dz, t_max, cached, kinds, owners, faces, data, mesh, tree, stack):
+    ''' primitive of any hit within (0, t_max) or -1, the own Barrier only counts with other faces of a mesh
+
+        cached (the last occluder of this light or -1) is tested first, then the Nodes of tree are
+        walked like BVH.any_hit. '''
+    if cached >= 0 and not (owners[cached] == b and (not mesh[b] or faces[cached] == face)):
+        t = intersect(kinds[cached], data[cached], ox, oy, oz, dx, dy, dz)
+        if t > 0 and t < t_max:
+            return cached
+    unbounded, bounds, links, items = tree
+    for p in unbounded:
+        if owners[p] == b and (not mesh[b] or faces[p] == face):
+            continue
+        t = intersect(kinds[p], data[p], ox, oy, oz, dx, dy, dz)
+        if t > 0 and t < t_max:
+            return p
+    if len(links) == 0:
+        return -1
+
+    ix, iy, iz = inverse(dx), inverse(dy), inverse(dz)
+    stack[0], top = 0, 1
+    while top:
+        top -= 1
+        node = stack[top]
+        if not box_entered(bounds[node], ox, oy, oz, ix, iy, iz, t_max):
+            continue
+        if links[node, 3]:
+            for k in range(links[node, 1], links[node, 1] + links[node, 2]):
+                p = items[k]
+                if p < 0:
+                    stack[top], top = -1 - p, top + 1
+                    continue
+                if owners[p] == b and (not mesh[b] or faces[p] == face):
+                    continue
+                t = intersect(kinds[p], data[p], ox, oy, oz, dx, dy, dz)
+                if t > 0 and t < t_max:
+                    return p
+        else:
+            stack[top], stack[top + 1], top = links[node, 2], links[node, 1], top + 2
+    return -1
+
+@jit
+def normal_at(kind, d, px, py, pz):
+    if kind == SPHERE:
+        nx, ny, nz = px - d[0], py - d[1], pz - d[2]
+        inv = 1/math.sqrt(nx*nx + ny*ny + nz*nz)
+        return nx*inv, ny*inv, nz*inv
+    if kind == PLANE:
+        return d[3], d[4], d[5]
+    return d[9], d[10], d[11]
+
+@jit
+def color_at(b, px, py, pz, textures, texture_colors, texture_sizes):
+    if textures[b] == CHECKERBOARD:
+        scale = 1.0/texture_sizes[b]
+        if (int(abs(px*scale) + 0.5) + int(abs(py*scale) + 0.5) + int(abs(pz*scale) + 0.5)) % 2:
+            return texture_colors[b, 0], texture_colors[b, 1], texture_colors[b, 2]
+        return texture_colors[b, 3], texture_colors[b, 4], texture_colors[b, 5]
+    return texture_colors[b, 0], texture_colors[b, 1], texture_colors[b, 2]
+
+@jit
+def compute_light(b, face, px, py, pz, nx, ny, nz, dx, dy, dz, kinds, owners, faces, data, mesh, tree, stack,
+                  materials, textures, texture_colors, texture_sizes, lights, samples, order, last, global_ambient):
+    # ambient
+    cr, cg, cb = color_at(b, px, py, pz, textures, texture_colors, texture_sizes)
+    factor = materials[b, 0] * global_ambient
+    ar, ag, ab = cr*factor, cg*factor, cb*factor
+
+    # all lights, or samples random ones (partial shuffle of order) weighted by their share
+    count, weight = len(lights), 1.0
+    if 0 < samples < len(lights):
+        for j in range(samples):
+            k = j + int(numpy.random.random() * (len(lights) - j))
+            order[j], order[k] = order[k], order[j]
+        count, weight = samples, len(lights) / samples
+
+    for j in range(count):
+        l = order[j]
+        dr, dg, db = diffuse_specular(b, face, px, py, pz, nx, ny, nz, dx, dy, dz, lights[l], l, last,
+                                      kinds, owners, faces, data, mesh, tree, stack, materials)
+        ar, ag, ab = ar + dr*weight, ag + dg*weight, ab + db*weight
+
+    return clip(ar), clip(ag), clip(ab)
+
+@jit
+def diffuse_specular(b, face, px, py, pz, nx, ny, nz, dx, dy, dz, light, l, last,
+                     kinds, owners, faces, data, mesh, tree, stack, materials):
+    sx, sy, sz = light[0] - px, light[1] - py, light[2] - pz
+    distance = math.sqrt(sx*sx + sy*sy + sz*sz)
+    inv = 1/distance
+    sx, sy, sz = sx*inv, sy*inv, sz*inv
+    inv = 1/math.sqrt(nx*nx + ny*ny + nz*nz)
+    mx, my, mz = nx*inv, ny*inv, nz*inv
+    k = (mx*-sx + my*-sy + mz*-sz)*2
+    rx, ry, rz = -sx - mx*k, -sy - my*k, -sz - mz*k
+    diffuse_cos = sx*nx + sy*ny + sz*nz
+    specular_cos = max(rx*-dx + ry*-dy + rz*-dz, 0)
+
+    if diffuse_cos <= 0:
+        return 0.0, 0.0, 0.0
+    inv = 1/math.sqrt(sx*sx + sy*sy + sz*sz)
+    p = occluded(b, face, px, py, pz, sx*inv, sy*inv, sz*inv, distance, last[l], kinds, owners, faces, data, mesh, tree, stack)
+    if p >= 0:
+        last[l] = p
+        return 0.0, 0.0, 0.0
+    diffuse = materials[b, 1]*diffuse_cos
+    specular = materials[b, 2]*(specular_cos**materials[b, 4])
+    return (clip(light[3]*diffuse + light[3]*specular), clip(light[4]*diffuse + light[4]*specular),
+            clip(light[5]*diffuse + light[5]*specular))
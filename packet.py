@@ -0,0 +1,232 @@
+# Description
+'''
+Vectorized Ray-Packet Renderer
+
+Traces whole batches of Rays as (n,3) NumPy arrays instead of one Ray object per pixel.
+Mirrors Lense.trace / compute_light / diffuse_specular step by step, so the resulting
+image equals the one of Lense.capture (up to floating point rounding). Reflections and
+shadows are traced bounce by bounce (wavefront), each bounce as one batch.
+'''
+
+# Imports
+import math, numpy
+from elements import *
+from bvh import inverse_rows
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+PACKET_SIZE = 1 << 16       # max. Rays traced at once (bounds memory per batch)
+TILE_SIZE = 128             # edge length of the Tiles handed to the scheduler
+
+
+# -----  Rendering  ------------------------------------------------------------------------------------ #
+
+def render_image(lense, depth, packet_size=PACKET_SIZE):
+    ''' Renders the full frame of a prepared Lense (see Lense.capture) into a (h,w,3) uint8 array '''
+    pixels = numpy.zeros((lense.h, lense.w, 3), dtype=numpy.uint8)
+    rows = max(1, packet_size // lense.w)
+    for y0 in range(0, lense.h, rows):
+        y1 = min(y0 + rows, lense.h)
+        pixels[y0:y1] = render_tile(lense, 0, y0, lense.w, y1, depth)
+    return pixels
+
+def render_tile(lense, x0, y0, x1, y1, depth):
+    ''' Renders pixels [y0:y1, x0:x1] of a prepared Lense into a (y1-y0, x1-x0, 3) uint8 array '''
+    xs, ys = numpy.meshgrid(numpy.arange(x0, x1), numpy.arange(y0, y1))
+    return render_pixels(lense, xs.ravel(), ys.ravel(), depth).astype(numpy.uint8).reshape(y1 - y0, x1 - x0, 3)
+
+def render_pixels(lense, xs, ys, depth):
+    ''' Renders the (possibly fractional) pixels (xs[i], ys[i]) of a prepared Lense into (n,3) float Colors '''
+    origins, directions = camera_rays(lense, xs, ys)
+    rng = numpy.random.default_rng([int(xs[0]), int(ys[0])]) if len(xs) else None   # light sampling, same per Tile
+    return trace(lense.scene, origins, directions, depth, rng, None, lense.min_contribution, lense.roulette_weight)
+
+def camera_rays(lense, xs, ys):
+    ''' Primary Rays through the pixels (xs[i], ys[i]) (like Lense.compute_ray) '''
+    ycomp = numpy.outer((lense.h - ys)*lense.pixel_height - lense.sensor_height/2, lense.u.values)
+    xcomp = numpy.outer(xs*lense.pixel_width - lense.sensor_width/2, lense.s.values)
+    directions = normalized_rows(lense.f.values + xcomp + ycomp)
+    origins = numpy.broadcast_to(numpy.asarray(lense.origin.values, dtype=float), directions.shape)
+    return origins, directions
+
+
+# -----  Tracing  -------------------------------------------------------------------------------------- #
+
+def trace(scene, origins, directions, depth, rng=None, weights=None, min_contribution=0.0, roulette_weight=0.0):
+    ''' Colors (n,3) of n Rays, black where nothing is hit
+
+        Wavefront: all Rays of a bounce are intersected, shaded and shadow tested together (see
+        shade), the surviving reflected Rays of all Barriers form the next bounce. Colors are put
+        together from the last bounce backwards, clipped per bounce just like Lense.trace.
+        weights are the shares of the pixel Colors carried by the Rays (see Lense.trace) '''
+    barriers = scene.barriers
+    reflections = numpy.array([b.get_reflection_factor() for b in barriers], dtype=float)
+    weights = numpy.ones(len(directions)) if weights is None else weights
+    bounces = []                                                                # [(colors, parent rows, scales)] per bounce
+
+    for bounce in range(depth + 1):
+        colors = numpy.zeros(directions.shape)
+        closest_d, closest_b, closest_f = closest_hits(scene, origins, directions)
+        rows = numpy.flatnonzero(closest_b >= 0)
+        rows = rows[numpy.lexsort((closest_f[rows], closest_b[rows]))]          # coherent: grouped by Barrier and face
+        owners, faces, d = closest_b[rows], closest_f[rows], directions[rows]
+        points = origins[rows] + d * closest_d[rows][:, None]
+        colors[rows], normals = shade(scene, owners, points, faces, d, rng)
+        bounces.append([colors, None, None])
+        if bounce == depth:
+            break
+
+        reflection = reflections[owners]
+        w = weights[rows] * reflection
+        scale = reflection.copy()
+        go = (reflection > 0) & (w >= min_contribution)
+        if roulette_weight > 0:                                                 # Russian roulette
+            rng = rng if rng is not None else numpy.random.default_rng()
+            low = numpy.flatnonzero(go & (w < roulette_weight))
+            survival = w[low] / roulette_weight
+            survived = rng.random(len(low)) < survival
+            go[low[~survived]] = False
+            scale[low[survived]] /= survival[survived]
+            w[low[survived]] = roulette_weight
+        go = numpy.flatnonzero(go)
+        if not len(go):
+            break
+
+        bounces[-1][1:] = rows[go], scale[go]
+        origins, directions = points[go], normalized_rows(reflect_rows(d[go], normals[go]))
+        weights = w[go]
+
+    # reflected Colors into the Colors of the Rays they came from, last bounce first
+    colors = bounces[-1][0]
+    for parent_colors, parents, scales in reversed(bounces[:-1]):
+        parent_colors[parents] = numpy.clip(parent_colors[parents] + colors * scales[:, None], 0, 255)
+        colors = parent_colors
+    return colors
+
+def closest_hits(scene, origins, directions):
+    ''' Distance, Barrier index and face of the closest positive intersection (-1 where missed)
+
+        Unbounded Barriers are tested with all Rays, the others only with the Rays reaching them
+        through the Scene's BVH (see BVH.packet_ranges). Ties go to the lower Barrier index. '''
+    bvh = scene.get_bvh()
+    closest = (numpy.full(len(directions), math.inf), numpy.full(len(directions), -1), numpy.full(len(directions), -1))
+    everyone = numpy.arange(len(directions))
+    for i, barrier in bvh.unbounded:
+        put_hits(closest, i, barrier, origins, directions, everyone)
+    for first, count, rows in bvh.packet_ranges(origins, inverse_rows(directions), closest[0]):
+        for i, barrier in bvh.items[first:first + count]:
+            put_hits(closest, i, barrier, origins, directions, rows)
+    return closest
+
+def put_hits(closest, i, barrier, origins, directions, rows):
+    ''' Puts the hits of the Rays rows with barrier (index i) into closest (distances, Barriers, faces) where closer '''
+    closest_d, closest_b, closest_f = closest
+    t, faces = barrier.intersectionFaces(origins[rows], directions[rows])
+    d = closest_d[rows]
+    hit = (t > 0) & ((t < d) | ((t == d) & (i < closest_b[rows])))            # NaN (no hit) compares False
+    hit_rows = rows[hit]
+    closest_d[hit_rows] = t[hit]
+    closest_b[hit_rows] = i
+    closest_f[hit_rows] = -1 if faces is None else faces[hit]
+
+def shade(scene, owners, points, faces, directions, rng=None):
+    ''' Colors (n,3) and normals (n,3) of n hit points, owners (Barrier indices) sorted ascending
+
+        Like Lense.compute_light / diffuse_specular, but for the hits on all Barriers at once: the
+        Materials become per row arrays and all shadow Rays towards a light are one batch. '''
+    barriers = scene.barriers
+    bounds = numpy.searchsorted(owners, numpy.arange(len(barriers) + 1))       # owners[bounds[i]:bounds[i+1]] == i
+    groups = [(i, slice(bounds[i], bounds[i+1])) for i in range(len(barriers)) if bounds[i] < bounds[i+1]]
+    colors = numpy.empty(points.shape)
+    normals = numpy.empty(points.shape)
+    for i, g in groups:
+        b = barriers[i]
+        colors[g] = b.colorsAt(points[g]) * (b.get_ambient_factor() * scene.global_ambient_factor)   # ambient lighting
+        normals[g] = b.normalsAt(points[g], faces[g])
+    diffuse = numpy.array([b.get_diffuse_factor() for b in barriers], dtype=float)[owners]
+    specular = numpy.array([b.get_specular_factor() for b in barriers], dtype=float)[owners]
+
+    for index, sel, weight in sample_lights(scene, len(points), rng):           # diffuse and specular lighting
+        source = scene.lights[index]
+        p, n = points[sel], normals[sel]
+        to_light = numpy.subtract(source.origin.values, p)
+        distances = numpy.sqrt(dot_rows(to_light, to_light))
+        bs  = normalized_rows(to_light)                                         # Point on barrier to lightsource
+        bsr = reflect_rows(-bs, n)
+        diffuse_cos  = dot_rows(bs, n)
+        specular_cos = numpy.maximum(dot_rows(bsr, -directions[sel]), 0)
+
+        # shadow where the angle is > 90° or any other barrier is in between
+        lit = diffuse_cos > 0
+        lit[lit] = ~occluded(scene, owners[sel][lit], p[lit], faces[sel][lit], normalized_rows(bs[lit]), distances[lit], index)
+
+        shine = numpy.empty(len(p))
+        sel_owners = owners[sel]
+        for i, g in groups:                                                     # exponent per Barrier (same rounding as before)
+            mine = sel_owners == i if isinstance(sel, numpy.ndarray) else g
+            shine[mine] = specular_cos[mine]**barriers[i].get_shininess_exponent()
+        total_diffuse_factor  = diffuse[sel]*diffuse_cos
+        total_specular_factor = specular[sel]*shine
+        color = numpy.asarray(source.color.values, dtype=float)
+        ds = numpy.clip(numpy.outer(total_diffuse_factor, color) + numpy.outer(total_specular_factor, color), 0, 255)
+        ds[~lit] = 0
+        colors[sel] += ds if weight == 1 else ds * weight
+    return numpy.clip(colors, 0, 255), normals
+
+def sample_lights(scene, count, rng=None):
+    ''' (light index, selected points, weight) per light (like Scene.sample_lights, drawn for each of count points) '''
+    n, k = len(scene.lights), scene.light_samples
+    if not k or k >= n:
+        return [(index, slice(None), 1.0) for index in range(n)]
+    rng = rng if rng is not None else numpy.random.default_rng()
+    chosen = numpy.argsort(rng.random((count, n)), axis=1)[:, :k]
+    selections = [(index, numpy.flatnonzero((chosen == index).any(axis=1)), n / k) for index in range(n)]
+    return [(index, sel, weight) for index, sel, weight in selections if len(sel)]
+
+def occluded(scene, owners, origins, faces, directions, distances, light=0):
+    ''' True for every Ray hitting any Barrier before distances (its owner Barrier only via its other faces)
+
+        The Barrier blocking most Rays towards light in the last batch is tested first with all Rays
+        (see Scene.occluders), then the unbounded Barriers and the others through the BVH. '''
+    bvh = scene.get_bvh()
+    t_far = numpy.array(distances, dtype=float)                                 # -1 once blocked (see BVH.packet_ranges)
+    blocks = {}                                                                 # {Barrier index: Rays blocked}
+    everyone = numpy.arange(len(directions))
+    cached = scene.occluders.get(light)
+    if cached is not None and cached < len(scene.barriers):
+        put_blocks(t_far, blocks, cached, scene.barriers[cached], owners, origins, faces, directions, everyone)
+    for i, barrier in bvh.unbounded:
+        if i != cached:
+            put_blocks(t_far, blocks, i, barrier, owners, origins, faces, directions, everyone)
+    for first, count, rows in bvh.packet_ranges(origins, inverse_rows(directions), t_far):
+        for i, barrier in bvh.items[first:first + count]:
+            if i != cached:
+                put_blocks(t_far, blocks, i, barrier, owners, origins, faces, directions, rows)
+    if blocks:
+        occluder = max(blocks, key=blocks.get)
+        if blocks[occluder]:
+            scene.occluders[light] = occluder
+    return t_far < 0
+
+def put_blocks(t_far, blocks, i, barrier, owners, origins, faces, directions, rows):
+    ''' Sets t_far to -1 for the Rays rows blocked by barrier (index i), counting them in blocks '''
+    rows = rows[t_far[rows] >= 0]
+    if not len(rows):
+        return
+    own = owners[rows] == i
+    t = numpy.empty(len(rows))
+    if own.any():
+        mine = rows[own]
+        t[own] = barrier.selfIntersectionParameters(origins[mine], directions[mine], faces[mine])
+    if not own.all():
+        other = rows[~own]
+        t[~own] = barrier.intersectionParameters(origins[other], directions[other])
+    hit = (t > 0) & (t < t_far[rows])                                           # NaN (no hit) compares False
+    t_far[rows[hit]] = -1
+    blocks[i] = blocks.get(i, 0) + int(hit.sum())
+
+def reflect_rows(directions, normals):
+    ''' Vector.reflect_on for each row '''
+    normals = normalized_rows(numpy.asarray(normals, dtype=float))
+    return directions - normals * (dot_rows(normals, directions)*2)[:, None]
@@ -0,0 +1,113 @@
+# Description
+'''
+Render Statistics and Cost Heatmaps
+
+Counters and timers filled by Lense.trace and the BVH while profiling (see Lense.capture).
+Every worker fills one RenderStats per Tile and returns it with the task, the capturing
+Process merges them into the statistics of the whole image.
+'''
+
+# Imports
+import time, numpy
+from PIL import Image
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+RAY_TYPES = ('primary', 'reflected', 'shadow')
+STAGES = ('ray_generation', 'intersection', 'shading', 'shadow')     # exclusive times, 'render' is the total
+HEATMAP_PERCENTILE = 99.0   # cost mapped to white (single outliers would darken everything else)
+HEATMAP_RAMP = ((0.0, (0, 0, 0)), (0.25, (40, 20, 140)), (0.5, (200, 30, 60)), (0.75, (250, 160, 20)), (1.0, (255, 255, 255)))
+
+
+# -----  Statistics  ----------------------------------------------------------------------------------- #
+
+class RenderStats():
+    ''' Counters and timers of one Tile (or, merged, of one image)
+
+        rays          {type: count} of traced primary, reflected and shadow Rays
+        node_tests    BVH Nodes visited
+        cached_occlusions  shadow Rays blocked by the light's last occluder (see Scene.occluded)
+        tests         Intersection tests per Barrier (Scene index)
+        test_times    seconds spent in these tests per Barrier
+        hits          closest hits per Barrier
+        times         seconds per stage plus 'render' (wall time of all Tiles)
+        tiles         [(x0, y0, cost)] seconds spent per pixel '''
+    def __init__(self, barriers, tile=None):
+        self.rays = dict.fromkeys(RAY_TYPES, 0)
+        self.node_tests = 0
+        self.cached_occlusions = 0
+        self.tests = [0] * barriers
+        self.test_times = [0.0] * barriers
+        self.hits = [0] * barriers
+        self.times = dict.fromkeys(STAGES + ('render',), 0.0)
+        self.tiles = []
+        if tile is not None:
+            x0, y0, x1, y1 = tile
+            self.x0, self.y0 = x0, y0
+            self.cost = numpy.zeros((y1 - y0, x1 - x0))
+            self.tiles.append((x0, y0, self.cost))
+
+    def __repr__(self):
+        return 'RenderStats(%d rays, %d tests)' %(sum(self.rays.values()), sum(self.tests))
+
+    def intersect(self, index, function, ray, *args):
+        ''' Calls function(ray, *args) (an intersection test of Barrier index), counting and timing it '''
+        start = time.perf_counter()
+        dist = function(ray, *args)
+        self.test_times[index] += time.perf_counter() - start
+        self.tests[index] += 1
+        return dist
+
+    def merge(self, other):
+        ''' Adds the counters, timers and Tiles of other '''
+        if other is None:
+            return
+        for key, count in other.rays.items():
+            self.rays[key] += count
+        self.node_tests += other.node_tests
+        self.cached_occlusions += other.cached_occlusions
+        for i in range(len(other.tests)):
+            self.tests[i] += other.tests[i]
+            self.test_times[i] += other.test_times[i]
+            self.hits[i] += other.hits[i]
+        for key, seconds in other.times.items():
+            self.times[key] += seconds
+        self.tiles.extend(other.tiles)
+
+    def heatmap(self, width, height):
+        ''' (height, width) seconds spent per pixel '''
+        cost = numpy.zeros((height, width))
+        for x0, y0, tile in self.tiles:
+            cost[y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] += tile
+        return cost
+
+    def as_dict(self):
+        ''' JSON-ready counters and timers (without the per pixel cost) '''
+        return {'rays': dict(self.rays), 'node_tests': self.node_tests, 'cached_occlusions': self.cached_occlusions,
+                'tests': list(self.tests), 'test_times': list(self.test_times), 'hits': list(self.hits), 'times': dict(self.times)}
+
+    def report(self, barriers):
+        ''' Human readable summary, barriers are the Scene's Barriers '''
+        rays = sum(self.rays.values())
+        tests = sum(self.tests)
+        lines = ['|-- Rays: %s' %(', '.join('%s %d' %(key, count) for key, count in self.rays.items())),
+                 '|-- Tests: %d BVH nodes, %d barriers (%.1f per ray), %d shadows from the occluder cache'
+                 %(self.node_tests, tests, tests / max(rays, 1), self.cached_occlusions),
+                 '|-- Time: %s' %(', '.join('%s %.3fs' %(key, seconds) for key, seconds in self.times.items()))]
+        for i in sorted(range(len(self.tests)), key=lambda i: -self.test_times[i]):
+            if self.tests[i]:
+                lines.append('|--     %-40.40s %9d tests %9d hits %8.3fs' %(repr(barriers[i]), self.tests[i], self.hits[i], self.test_times[i]))
+        return '\n'.join(lines)
+
+
+# -----  Heatmap  -------------------------------------------------------------------------------------- #
+
+def save_heatmap(cost, filename, percentile=HEATMAP_PERCENTILE):
+    ''' Saves a (h,w) cost array as false color image (black cheap, white expensive) '''
+    cost = numpy.asarray(cost, dtype=float)
+    top = numpy.percentile(cost, percentile) if cost.size else 0.0
+    level = numpy.clip(cost / top, 0, 1) if top > 0 else numpy.zeros(cost.shape)
+    stops = [stop for stop, color in HEATMAP_RAMP]
+    rgb = numpy.stack([numpy.interp(level, stops, [color[c] for stop, color in HEATMAP_RAMP]) for c in range(3)], axis=-1)
+    Image.fromarray(rgb.astype(numpy.uint8), 'RGB').save(filename)
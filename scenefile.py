@@ -0,0 +1,179 @@
+# Description
+'''
+Scene Files
+
+A Scene (with its Lense) stored as a directory: scene.json describes Lense, Lights, Textures
+and Barriers, the arrays of TriangleMeshes are stored next to it as .npy files. Loading maps
+these files into memory instead of reading them, and worker Processes receive meshes as file
+names (see TriangleMesh.__getstate__) - so startup and IPC cost stay flat for big meshes.
+Workers on other hosts (see farm) need the scene directory at the same path.
+
+    python scenefile.py export sc1 scenes/squirrel
+    python scenefile.py render scenes/squirrel --width 640 --height 480 --output squirrel.png
+'''
+
+# Imports
+import argparse, json, os
+import numpy
+from elements import Point, Vector, Color, Texture, Checkerboard, Material, Sphere, Plane, Triangle, TriangleMesh, Light
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+SCENE_FORMAT = 1            # version of scene.json, bumped on incompatible changes
+SCENE_JSON = 'scene.json'
+MESH_ARRAYS = ('vertices', 'faces', 'normals', 'texcoords', 'face_normals', 'face_texcoords')
+
+
+# -----  Saving  --------------------------------------------------------------------------------------- #
+
+def save_scene(path, lense, scene):
+    ''' Writes lense and scene into the directory path (created if missing) '''
+    os.makedirs(path, exist_ok=True)
+    textures = []                                                               # shared Textures are stored once
+    barriers = []
+    for i, b in enumerate(scene.barriers):
+        entry = {'texture': texture_index(textures, b.texture)}
+        if isinstance(b, Sphere):
+            entry.update(type='sphere', center=values(b.center), radius=b.radius)
+        elif isinstance(b, Plane):
+            entry.update(type='plane', point=values(b.point), normal=values(b.normal))
+        elif isinstance(b, Triangle):
+            entry.update(type='triangle', a=values(b.a), b=values(b.b), c=values(b.c))
+        elif isinstance(b, TriangleMesh):
+            entry.update(type='mesh', dtype=b.dtype.name, arrays={})
+            arrays = {'vertices': b.vertices, 'faces': b.faces, 'normals': b.vertex_normals, 'texcoords': b.texcoords,
+                      'face_normals': b.face_normals, 'face_texcoords': b.face_texcoords}
+            for name in MESH_ARRAYS:
+                if arrays[name] is not None:
+                    filename = 'barrier%d.%s.npy' %(i, name)
+                    numpy.save(os.path.join(path, filename), numpy.ascontiguousarray(arrays[name]))
+                    entry['arrays'][name] = filename
+        else:
+            raise TypeError('can not save %s' %(repr(b)))
+        barriers.append(entry)
+
+    data = {
+        'format': SCENE_FORMAT,
+        'lense': {'origin': values(lense.origin), 'center': values(lense.center), 'up': values(lense.up), 'fow': lense.fow},
+        'scene': {'global_ambient_factor': scene.global_ambient_factor, 'ambient_light': values(scene.ambient_light),
+                  'light_samples': scene.light_samples},
+        'lights': [{'origin': values(l.origin), 'color': values(l.color)} for l in scene.lights],
+        'textures': [texture_entry(t) for t in textures],
+        'barriers': barriers,
+    }
+    temporary = os.path.join(path, SCENE_JSON + '.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temporary, os.path.join(path, SCENE_JSON))
+
+def values(point):
+    return [point.x, point.y, point.z]
+
+def texture_index(textures, texture):
+    for i, t in enumerate(textures):
+        if t is texture:
+            return i
+    textures.append(texture)
+    return len(textures) - 1
+
+def texture_entry(texture):
+    entry = {'type': 'texture', 'color': values(texture.primary),
+             'material': [texture.ambient_factor, texture.diffuse_factor, texture.specular_factor,
+                          texture.reflection_factor, texture.shininess_exponent]}
+    if isinstance(texture, Checkerboard):
+        entry.update(type='checkerboard', secondary=values(texture.secondary), size=texture.size)
+    return entry
+
+
+# -----  Loading  -------------------------------------------------------------------------------------- #
+
+def load_scene(path, mmap=True):
+    ''' (Lense, Scene) stored in the directory path, mesh arrays memory mapped unless mmap is False '''
+    from camera import Lense, Scene
+    with open(os.path.join(path, SCENE_JSON)) as f:
+        data = json.load(f)
+    if data.get('format') != SCENE_FORMAT:
+        raise ValueError('%s has scene format %s, expected %d' %(path, data.get('format'), SCENE_FORMAT))
+
+    textures = []
+    for entry in data['textures']:
+        material = Material(*entry['material'])
+        if entry['type'] == 'checkerboard':
+            textures.append(Checkerboard(Color(*entry['color']), Color(*entry['secondary']), material, entry['size']))
+        else:
+            textures.append(Texture(Color(*entry['color']), material))
+
+    barriers = []
+    for entry in data['barriers']:
+        texture = textures[entry['texture']]
+        kind = entry['type']
+        if kind == 'sphere':
+            barriers.append(Sphere(Point(*entry['center']), entry['radius'], texture))
+        elif kind == 'plane':
+            plane = Plane(Point(*entry['point']), Vector(*entry['normal']), texture)
+            plane.normal = Vector(*entry['normal'])                             # stored normalized, not again
+            barriers.append(plane)
+        elif kind == 'triangle':
+            barriers.append(Triangle(Point(*entry['a']), Point(*entry['b']), Point(*entry['c']), texture))
+        elif kind == 'mesh':
+            files = dict((name, os.path.abspath(os.path.join(path, filename))) for name, filename in entry['arrays'].items())
+            arrays = dict((name, numpy.load(filename, mmap_mode='r' if mmap else None)) for name, filename in files.items())
+            mesh = TriangleMesh(texture=texture, dtype=entry['dtype'], **arrays)
+            mesh.files = files if mmap else None
+            barriers.append(mesh)
+        else:
+            raise ValueError('unknown barrier type %s in %s' %(repr(kind), path))
+
+    settings = data['scene']
+    scene = Scene(barriers, [Light(Point(*l['origin']), Color(*l['color'])) for l in data['lights']],
+                  settings['global_ambient_factor'], Color(*settings['ambient_light']), settings['light_samples'])
+    l = data['lense']
+    lense = Lense(Point(*l['origin']), Point(*l['center']), Vector(*l['up']), l['fow'])
+    return lense, scene
+
+
+# -----  Command Line  --------------------------------------------------------------------------------- #
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exports and renders scene files')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='save a built-in Scene as scene file')
+    export.add_argument('scene', help='sc0 .. sc4')
+    export.add_argument('path', help='directory to write')
+
+    render = commands.add_parser('render', help='render a scene file')
+    render.add_argument('path', help='scene directory')
+    render.add_argument('--width', type=int, default=640)
+    render.add_argument('--height', type=int, default=384)
+    render.add_argument('--output', default='default.png')
+    render.add_argument('--backend', default='python', choices=['python', 'numpy', 'numba'])
+    render.add_argument('--processes', type=int, default=None, help='worker Processes (default: cpu count)')
+    render.add_argument('--depth', type=int, default=None, help='reflection depth')
+    render.add_argument('--antialias', type=int, default=1, help='max. samples per edge pixel')
+    render.add_argument('--disk', action='store_true', help='render into a memory mapped file (huge images)')
+    render.add_argument('--farm', default=None, help='host:port to coordinate remote workers on (see farm)')
+    args = parser.parse_args(argv)
+
+    import camera
+    if args.command == 'export':
+        scenes = camera.build_scenes()
+        if args.scene not in scenes:
+            parser.error('unknown scene %s' %(args.scene))
+        save_scene(args.path, *scenes[args.scene])
+        print('|-- %s written to %s' %(args.scene, args.path))
+        return 0
+
+    lense, scene = load_scene(args.path)
+    options = {'backend': args.backend, 'antialias': args.antialias, 'disk': args.disk, 'farm': args.farm}
+    if args.processes is not None:
+        options['processes'] = args.processes
+    if args.depth is not None:
+        options['depth'] = args.depth
+    lense.capture(scene, {'width': args.width, 'height': args.height}, args.output, **options)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,233 @@
+# Description
+'''
+Tile based Work Scheduling for Lense.capture
+'''
+
+# Imports
+import collections, itertools, pickle, secrets, threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from framebuffer import open_framebuffer
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+TILE_SIZE = 32              # edge length of a square Tile in pixels
+JOB_CACHE = 4               # jobs (Lense + Framebuffer) a WorkerPool Process keeps between Tiles
+POLL_INTERVAL = 0.1         # seconds a PooledRenderer waits for a Tile before checking for WorkerPool.stop
+
+
+# -----  Tiles  ---------------------------------------------------------------------------------------- #
+
+def tiles(width, height, size=TILE_SIZE):
+    ''' Square Tiles (x0, y0, x1, y1) covering a width x height Image in row-major order '''
+    return [(x, y, min(x + size, width), min(y + size, height))
+            for y in range(0, height, size) for x in range(0, width, size)]
+
+
+# -----  Renderer  ------------------------------------------------------------------------------------- #
+
+class RenderStopped(Exception):
+    ''' Raised by renders of a WorkerPool that is stopped (see WorkerPool.stop) '''
+
+
+class TileRenderer():
+    ''' Pool of worker Processes rendering Tiles of one Lense into a shared Framebuffer
+
+        The Lense (with its Scene and BVH) is sent to each worker once when the Pool starts.
+        Workers pull the next Tile from the common task queue as soon as they are done
+        (chunksize 1), so expensive regions don't hold back the others, and write the pixels
+        straight into the Framebuffer. Only the finished task comes back.
+        Scene changes (see update) are published once per version in shared memory, the Tiles
+        only carry the version number, never the whole Scene again. '''
+    def __init__(self, lense, framebuffer, processes):
+        self.lense = lense
+        self.framebuffer = framebuffer
+        self.processes = processes
+        self.pool = None
+        self.version = 0                                                        # number of Scene updates so far
+        self.updates = {}                                                       # {index: Barrier} changed since start
+        self.prefix = 'rt%s' %(secrets.token_hex(6))                            # shared memory name of version n: prefix_n
+        self.shm = None                                                         # updates of the current version
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.processes > 1 and self.pool is None:
+            resource_tracker.ensure_running()                                   # shared by the workers, see SharedMemory
+            self.pool = multiprocessing.Pool(self.processes, init_worker, (self.lense, self.framebuffer.spec(), self.prefix))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.unlink()
+
+    def unlink(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def update(self, changes):
+        ''' Puts changed Barriers {index: Barrier} into the Scene (here and, lazily, in every worker)
+
+            Called between renders, the workers read all changes since the start once per version. '''
+        self.lense.scene.update_barriers(changes)
+        self.version += 1
+        self.updates.update(changes)
+        if self.pool is not None:
+            self.unlink()                                                       # no Tile of the old version is left
+            data = pickle.dumps(self.updates, pickle.HIGHEST_PROTOCOL)
+            self.shm = shared_memory.SharedMemory('%s_%d' %(self.prefix, self.version), create=True, size=len(data))
+            self.shm.buf[:len(data)] = data
+
+    def render(self, tasks):
+        ''' Renders all tasks (arguments of Lense.compute_tile), yields (task, result) as they finish '''
+        if self.pool is None:
+            for task in tasks:
+                result = self.lense.compute_tile(self.framebuffer.pixels, *task)
+                self.framebuffer.release(task[1], task[3])
+                yield task, result
+        else:
+            tasks = ((self.version, task) for task in tasks)
+            yield from self.pool.imap_unordered(render_task, tasks, chunksize=1)
+
+
+class WorkerPool():
+    ''' Persistent Pool of worker Processes rendering Tiles of any Lense (see job)
+
+        Unlike TileRenderer the Processes outlive one render: every job is published once as
+        pickle in shared memory, a worker unpickles it with its first Tile of the job and keeps
+        the last JOB_CACHE jobs. Jobs may be rendered at the same time from several threads,
+        stop (or close) makes the running renders raise a RenderStopped. '''
+    def __init__(self, processes):
+        self.processes = processes
+        resource_tracker.ensure_running()                                       # shared by the workers, see SharedMemory
+        self.pool = multiprocessing.Pool(processes, init_pool_worker)
+        self.ids = itertools.count()
+        self.stopped = threading.Event()
+
+    def __repr__(self):
+        return 'WorkerPool(%d processes)' %(self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stop(self):
+        ''' Ends all running renders (within POLL_INTERVAL), no new ones can be started '''
+        self.stopped.set()
+
+    def close(self):
+        self.stop()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def job(self, lense, framebuffer):
+        ''' PooledRenderer for lense (prepared) rendering into framebuffer '''
+        return PooledRenderer(self, next(self.ids), lense, framebuffer)
+
+
+class PooledRenderer():
+    ''' One job of a WorkerPool, used like TileRenderer (without Scene updates) '''
+    def __init__(self, workers, job, lense, framebuffer):
+        self.workers = workers
+        self.job = job
+        self.lense = lense
+        self.framebuffer = framebuffer
+        self.shm = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.shm is None:
+            data = pickle.dumps(self.lense, pickle.HIGHEST_PROTOCOL)
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+            self.shm.buf[:len(data)] = data
+            self.spec = (self.job, self.shm.name, len(data), self.framebuffer.spec())
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def render(self, tasks):
+        ''' Renders all tasks (arguments of Lense.compute_tile), yields (task, result) as they finish '''
+        tasks = ((self.spec, task) for task in tasks)
+        if self.workers.stopped.is_set():
+            raise RenderStopped('%s is stopped' %(repr(self.workers)))
+        results = self.workers.pool.imap_unordered(render_job_task, tasks, chunksize=1)
+        while True:
+            try:
+                result = results.next(POLL_INTERVAL)
+            except StopIteration:
+                return
+            except multiprocessing.TimeoutError:
+                if self.workers.stopped.is_set():
+                    raise RenderStopped('%s is stopped' %(repr(self.workers)))
+                continue
+            yield result
+
+
+# -----  Worker  --------------------------------------------------------------------------------------- #
+
+worker = {}                 # per Process state of a worker (Lense, Framebuffer, Scene version)
+
+def init_worker(lense, spec, prefix):
+    worker['lense'] = lense
+    worker['framebuffer'] = open_framebuffer(spec)
+    worker['prefix'] = prefix
+    worker['version'] = 0
+
+def render_task(args):
+    version, task = args
+    lense = worker['lense']
+    if version != worker['version']:
+        shm = shared_memory.SharedMemory(name='%s_%d' %(worker['prefix'], version))
+        try:
+            updates = pickle.loads(shm.buf)                                     # bytes after the pickle are ignored
+        finally:
+            shm.close()
+        lense.scene.update_barriers(updates)
+        worker['version'] = version
+    framebuffer = worker['framebuffer']
+    result = lense.compute_tile(framebuffer.pixels, *task)
+    framebuffer.release(task[1], task[3])                                       # finished rows are not needed here again
+    return task, result
+
+def init_pool_worker():
+    worker['jobs'] = collections.OrderedDict()                                  # {job: (Lense, Framebuffer)}
+
+def render_job_task(args):
+    (job, name, size, spec), task = args
+    jobs = worker['jobs']
+    if job not in jobs:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            lense = pickle.loads(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+        jobs[job] = (lense, open_framebuffer(spec))
+        while len(jobs) > JOB_CACHE:
+            jobs.popitem(last=False)[1][1].close()
+    lense, framebuffer = jobs[job]
+    result = lense.compute_tile(framebuffer.pixels, *task)
+    framebuffer.release(task[1], task[3])
+    return task, result
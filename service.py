@@ -0,0 +1,239 @@
+# Description
+'''
+Asynchronous Render Service
+
+For callers running an asyncio event loop (e.g. a web tier): jobs (Lense, Scene, resolution,
+options) are queued and rendered on one persistent WorkerPool, nothing is printed or written
+to disk - results are encoded images (bytes). Progress can be streamed per job, identical
+requests share one render and finished images are kept in a size bounded LRU cache keyed by
+the content of the request (see checkpoint.fingerprint), so repeated renders return at once.
+
+    async with RenderService(processes=4) as service:
+        job = await service.submit(lense, scene, {'width': 160, 'height': 96}, antialias=4)
+        async for state, done, total in job.events():
+            ...
+        png = await job
+'''
+
+# Imports
+import asyncio, collections, copy, functools, io, threading
+import multiprocessing
+from PIL import Image
+from checkpoint import fingerprint
+from framebuffer import SharedFramebuffer
+from scheduler import WorkerPool, RenderStopped
+from antialiasing import AA_THRESHOLD
+from camera import RECURSION_DEPTH, MIN_CONTRIBUTION
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+CACHE_BYTES = 64 << 20      # size of all cached images
+CONCURRENT_JOBS = 2         # jobs rendered at the same time (sharing the WorkerPool)
+RENDER_OPTIONS = {'backend': 'python', 'antialias': 1, 'aa_threshold': AA_THRESHOLD, 'depth': RECURSION_DEPTH,
+                  'min_contribution': MIN_CONTRIBUTION, 'roulette': False, 'format': 'PNG'}
+FINAL_STATES = ('done', 'cached', 'failed')
+
+
+# -----  Cache  ---------------------------------------------------------------------------------------- #
+
+class ResultCache():
+    ''' LRU cache {key: bytes} evicting the least recently used entries beyond max_bytes '''
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'ResultCache(%d entries, %d / %d bytes)' %(len(self.entries), self.size, self.max_bytes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        ''' Stores data unless it alone exceeds max_bytes '''
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1])
+
+
+# -----  Jobs  ----------------------------------------------------------------------------------------- #
+
+class RenderJob():
+    ''' One requested render, awaitable for the encoded image
+
+        state is 'queued', 'render', 'antialias' (the running pass), 'done', 'cached' or 'failed',
+        done / total count the Tiles of the running pass. '''
+    def __init__(self, key, lense, scene, resolution, options):
+        self.key = key
+        self.lense = lense
+        self.scene = scene
+        self.resolution = resolution
+        self.options = options
+        self.state = 'queued'
+        self.done = 0
+        self.total = 0
+        self.future = asyncio.get_running_loop().create_future()
+        self.listeners = []                                                     # asyncio.Queues of events()
+
+    def __repr__(self):
+        return 'RenderJob(%s, %s %d/%d)' %(self.key[:12], self.state, self.done, self.total)
+
+    def __await__(self):
+        return asyncio.shield(self.future).__await__()
+
+    def publish(self, state, done=0, total=0):
+        ''' Sets the progress and tells every listener (call from the event loop only) '''
+        self.state, self.done, self.total = state, done, total
+        for listener in self.listeners:
+            listener.put_nowait((state, done, total))
+
+    async def events(self):
+        ''' Yields (state, done, total) from the current one until the job is finished '''
+        queue = asyncio.Queue()
+        self.listeners.append(queue)
+        try:
+            event = (self.state, self.done, self.total)
+            while True:
+                yield event
+                if event[0] in FINAL_STATES:
+                    return
+                event = await queue.get()
+                while not queue.empty() and event[0] not in FINAL_STATES:
+                    event = queue.get_nowait()                                  # slow listeners skip to the latest
+        finally:
+            self.listeners.remove(queue)
+
+
+# -----  Service  -------------------------------------------------------------------------------------- #
+
+class RenderService():
+    ''' Queues RenderJobs and renders them on a persistent WorkerPool (see module description) '''
+    def __init__(self, processes=multiprocessing.cpu_count(), cache_bytes=CACHE_BYTES, concurrency=CONCURRENT_JOBS):
+        self.processes = processes
+        self.concurrency = concurrency
+        self.cache = ResultCache(cache_bytes)
+        self.running = {}                                                       # {key: RenderJob} queued or rendering
+        self.queue = None
+        self.pool = None
+        self.runners = []
+        self.threads = set()                                                    # futures of the running render_job calls
+        self.prepare_lock = threading.Lock()                                    # see render_job
+
+    def __repr__(self):
+        return 'RenderService(%d processes, %d jobs, %s)' %(self.processes, len(self.running), repr(self.cache))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def start(self):
+        if self.pool is None:
+            self.pool = await asyncio.to_thread(WorkerPool, self.processes)
+            self.queue = asyncio.Queue()
+            self.runners = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        ''' Stops the running renders and waits for their threads (freeing their shared memory),
+            unfinished jobs fail with RenderStopped '''
+        jobs = list(self.running.values())
+        if self.pool is not None:
+            self.pool.stop()
+        for runner in self.runners:
+            runner.cancel()
+        await asyncio.gather(*self.runners, return_exceptions=True)
+        await asyncio.gather(*self.threads, return_exceptions=True)
+        self.runners = []
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(RenderStopped('%s is closed' %(repr(self))))
+                job.publish('failed')
+        self.running = {}
+        if self.pool is not None:
+            await asyncio.to_thread(self.pool.close)
+            self.pool = None
+
+    async def submit(self, lense, scene, resolution, **options):
+        ''' RenderJob for scene seen through lense (options see RENDER_OPTIONS)
+
+            Returns a finished job for cached results and the running job for identical requests.
+            The key is computed in a thread, hashing a big Scene must not block the event loop. '''
+        unknown = set(options) - set(RENDER_OPTIONS)
+        if unknown:
+            raise TypeError('unknown render options %s' %(', '.join(sorted(unknown))))
+        options = dict(RENDER_OPTIONS, **options)
+        resolution = {'width': resolution['width'], 'height': resolution['height']}
+        key = await asyncio.to_thread(fingerprint, lense.origin, lense.center, lense.up, lense.fow, scene, resolution, options)
+
+        if key in self.running:
+            return self.running[key]
+        job = RenderJob(key, lense, scene, resolution, options)
+        data = self.cache.get(key)
+        if data is not None:
+            job.future.set_result(data)
+            job.publish('cached')
+            return job
+        self.running[key] = job
+        self.queue.put_nowait(job)
+        return job
+
+    async def render(self, lense, scene, resolution, **options):
+        ''' Encoded image of the job (see submit) '''
+        return await (await self.submit(lense, scene, resolution, **options))
+
+    async def run(self):
+        ''' Renders queued jobs one after another (CONCURRENT_JOBS of these run at once) '''
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            publish = lambda *event, job=job: loop.call_soon_threadsafe(job.publish, *event)
+            thread = loop.run_in_executor(None, functools.partial(self.render_job, job, publish))
+            self.threads.add(thread)
+            thread.add_done_callback(self.threads.discard)
+            try:
+                data = await asyncio.shield(thread)                             # close waits for the thread
+            except Exception as error:
+                job.future.set_exception(error)
+                job.publish('failed')
+            else:
+                self.cache.put(job.key, data)
+                job.future.set_result(data)
+                job.publish('done', job.done, job.total)
+            finally:
+                self.running.pop(job.key, None)
+
+    def render_job(self, job, publish):
+        ''' Renders job (in a worker thread) and returns the encoded image '''
+        options = job.options
+        lense = copy.copy(job.lense)                                            # prepare must not change the caller's Lense
+        with SharedFramebuffer(job.resolution['width'], job.resolution['height']) as framebuffer:
+            renderer = self.pool.job(lense, framebuffer)
+            with self.prepare_lock:                                             # jobs may share a Scene, prepare changes it
+                lense.prepare(job.scene, job.resolution, options['backend'], antialias=options['antialias'], depth=options['depth'],
+                              min_contribution=options['min_contribution'], roulette=options['roulette'])
+                renderer.start()                                                # publishes a snapshot of Lense and Scene
+            with renderer:
+                lense.render_passes(renderer, framebuffer, options['aa_threshold'], publish=publish, quiet=True)
+
+            output = io.BytesIO()
+            Image.fromarray(framebuffer.pixels, 'RGB').save(output, options['format'])
+        return output.getvalue()
@@ -0,0 +1,83 @@
+# Description
+'''
+Backend Tests
+
+Renders the built-in Scenes (and sc1 with its mesh stored as float32) small on the python, numpy
+and numba backends (with and without antialiasing) and checks that the images match the python
+backend within TOLERANCE. The numba
+kernels are run compiled and, through their .py_func, as plain Python.
+'''
+
+# Imports
+import contextlib, functools, io, os, sys, tempfile
+import numpy
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import camera, kernels
+from elements import TriangleMesh
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+SCENES = ('sc0', 'sc1', 'sc2', 'sc3', 'sc4', 'sc1_float32')
+RESOLUTION = (40, 24)
+PLAIN_RESOLUTION = (16, 12)     # the un-jitted kernels are slow
+ANTIALIAS = 4
+TOLERANCE = 1                   # max. difference per channel
+
+
+# -----  Helpers  -------------------------------------------------------------------------------------- #
+
+def build_scene(name):
+    ''' (Lense, Scene) of a built-in Scene, name_float32 stores its meshes as float32 '''
+    name, _, dtype = name.partition('_')
+    lense, scene = camera.build_scenes()[name]
+    if dtype:
+        scene.barriers = [TriangleMesh(b.vertices, b.faces, b.texture, dtype=dtype) if isinstance(b, TriangleMesh) else b
+                          for b in scene.barriers]
+    return lense, scene
+
+def render(name, backend, resolution=RESOLUTION, antialias=1):
+    ''' (h,w,3) int image of the Scene name (see build_scene) rendered in this Process '''
+    lense, scene = build_scene(name)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'image.png')
+        with contextlib.redirect_stdout(io.StringIO()):
+            lense.capture(scene, {'width': resolution[0], 'height': resolution[1]}, filename, backend, 1, antialias=antialias)
+        with Image.open(filename) as image:
+            return numpy.asarray(image.convert('RGB')).astype(int)
+
+@functools.lru_cache(maxsize=None)
+def reference(name, resolution=RESOLUTION, antialias=1):
+    return render(name, 'python', resolution, antialias)
+
+def assert_close(image, expected):
+    difference = numpy.abs(image - expected)
+    assert image.shape == expected.shape
+    assert difference.max() <= TOLERANCE, '%d pixels differ by up to %d' %((difference > TOLERANCE).any(axis=2).sum(), difference.max())
+
+
+# -----  Tests  ---------------------------------------------------------------------------------------- #
+
+@pytest.mark.parametrize('antialias', [1, ANTIALIAS])
+@pytest.mark.parametrize('name', SCENES)
+def test_numpy(name, antialias):
+    assert_close(render(name, 'numpy', antialias=antialias), reference(name, antialias=antialias))
+
+@pytest.mark.parametrize('antialias', [1, ANTIALIAS])
+@pytest.mark.parametrize('name', SCENES)
+def test_numba(name, antialias):
+    pytest.importorskip('numba')
+    assert_close(render(name, 'numba', antialias=antialias), reference(name, antialias=antialias))
+
+@pytest.mark.parametrize('name', SCENES)
+def test_numba_plain(name, monkeypatch):
+    ''' The kernels as plain Python functions (what Numba compiles) '''
+    pytest.importorskip('numba')
+    for key, value in list(vars(kernels).items()):
+        if hasattr(value, 'py_func'):
+            monkeypatch.setattr(kernels, key, value.py_func)
+    assert not hasattr(kernels.render_kernel, 'py_func')
+    assert_close(render(name, 'numba', PLAIN_RESOLUTION, ANTIALIAS), reference(name, PLAIN_RESOLUTION, ANTIALIAS))
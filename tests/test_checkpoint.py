@@ -0,0 +1,77 @@
+# Description
+'''
+Checkpoint Tests
+
+Crashes captures with checkpoint=True in the render and the antialias pass (by failing
+Checkpoint.finished) and checks that resuming gives the image of an uninterrupted capture,
+also when an interrupted capture of another Scene left its files under the same name.
+'''
+
+# Imports
+import contextlib, io, os, sys
+import numpy
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import camera
+from checkpoint import Checkpoint
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+RESOLUTION = {'width': 64, 'height': 48}
+ANTIALIAS = 4
+
+
+class Crash(Exception):
+    pass
+
+
+# -----  Helpers  -------------------------------------------------------------------------------------- #
+
+def capture(name, filename, **options):
+    lense, scene = camera.build_scenes()[name]
+    with contextlib.redirect_stdout(io.StringIO()):
+        lense.capture(scene, RESOLUTION, filename, 'python', 1, antialias=ANTIALIAS, **options)
+    with Image.open(filename) as image:
+        return numpy.asarray(image.convert('RGB')).astype(int)
+
+def crashed(name, filename, kind, after, monkeypatch):
+    ''' capture with checkpoint=True failing once after Tiles of pass kind are finished '''
+    finished = Checkpoint.finished
+    count = []
+    def failing(self, pass_kind, task, framebuffer):
+        finished(self, pass_kind, task, framebuffer)
+        if pass_kind == kind:
+            count.append(task)
+            if len(count) == after:
+                raise Crash()
+    with monkeypatch.context() as patch:
+        patch.setattr(Checkpoint, 'finished', failing)
+        with pytest.raises(Crash):
+            capture(name, filename, checkpoint=True)
+
+def leftovers(directory):
+    return sorted(name for name in os.listdir(directory) if name != 'clean.png')
+
+
+# -----  Tests  ---------------------------------------------------------------------------------------- #
+
+@pytest.mark.parametrize('kind', ['render', 'antialias'])
+def test_resume(tmp_path, monkeypatch, kind):
+    filename = str(tmp_path / 'image.png')
+    crashed('sc0', filename, kind, 1, monkeypatch)
+    image = capture('sc0', filename, resume=True)
+    assert numpy.array_equal(image, capture('sc0', str(tmp_path / 'clean.png')))
+    assert leftovers(str(tmp_path)) == ['image.png']
+
+def test_stale_task_files(tmp_path, monkeypatch):
+    ''' Files of an interrupted capture of sc0 must not leak into a capture of sc3 '''
+    filename = str(tmp_path / 'image.png')
+    crashed('sc0', filename, 'antialias', 1, monkeypatch)
+    assert os.path.exists(filename + camera.CHECKPOINT_SUFFIX + '.antialias.npz')
+    crashed('sc3', filename, 'render', 1, monkeypatch)
+    image = capture('sc3', filename, resume=True)
+    assert numpy.array_equal(image, capture('sc3', str(tmp_path / 'clean.png')))
+    assert leftovers(str(tmp_path)) == ['image.png']
@@ -0,0 +1,78 @@
+# Description
+'''
+OBJ Loader Tests
+
+Parses small .obj files (blank ones, polygons, negative indices, v/vt/vn corners) with
+elements.load_obj and parse_obj, also in chunks small enough to hold only blank lines.
+'''
+
+# Imports
+import os, sys
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elements
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+POLYGONS = b'''# polygons
+o thing
+v 0 0 0
+v 1 0 0 1.0
+  v 1 1 0
+v 0 1 0
+vt 0.5
+vt 0.25 0.75
+vn 0 0 1
+f 1/1/1 2/2/1 3/1/1 4/2/1
+f -4//-1 -3//-1 -2//-1
+\tf\t1 2 3
+
+
+'''
+CHUNK_SIZES = (elements.OBJ_CHUNK_SIZE, 1, 7, 40)
+
+
+# -----  Helpers  -------------------------------------------------------------------------------------- #
+
+def write(tmp_path, content, name='mesh.obj'):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+def assert_empty(obj):
+    assert sorted(obj) == sorted(elements.OBJ_ARRAYS)
+    assert obj['vertices'].shape == (0, 3) and obj['normals'].shape == (0, 3) and obj['texcoords'].shape == (0, 2)
+    for name in ('faces', 'face_texcoords', 'face_normals'):
+        assert obj[name].shape == (0, 3) and obj[name].dtype == numpy.int32
+
+
+# -----  Tests  ---------------------------------------------------------------------------------------- #
+
+@pytest.mark.parametrize('content', [b'', b'\n', b'   \n', b'\t\r\n\n', b'# only a comment\n'])
+def test_blank_files(tmp_path, content):
+    assert_empty(elements.load_obj(write(tmp_path, content), cache=False))
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_polygons(tmp_path, chunk_size):
+    obj = elements.parse_obj(write(tmp_path, POLYGONS), chunk_size)
+    assert numpy.array_equal(obj['vertices'], [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]])
+    assert numpy.array_equal(obj['texcoords'], [[0.5, 0], [0.25, 0.75]])
+    assert numpy.array_equal(obj['normals'], [[0, 0, 1]])
+    assert numpy.array_equal(obj['faces'], [[0, 1, 2], [0, 2, 3], [0, 1, 2], [0, 1, 2]])
+    assert numpy.array_equal(obj['face_texcoords'], [[0, 1, 0], [0, 0, 1], [-1, -1, -1], [-1, -1, -1]])
+    assert numpy.array_equal(obj['face_normals'], [[0, 0, 0], [0, 0, 0], [0, 0, 0], [-1, -1, -1]])
+
+def test_chunks_without_tokens(tmp_path):
+    ''' Chunks holding only the blank lines behind the last record '''
+    content = b'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n' + b'\n' * 64 + b'  \n' * 16
+    for chunk_size in CHUNK_SIZES:
+        obj = elements.parse_obj(write(tmp_path, content), chunk_size)
+        assert obj['vertices'].shape == (3, 3)
+        assert numpy.array_equal(obj['faces'], [[0, 1, 2]])
+
+def test_invalid_number(tmp_path):
+    with pytest.raises(ValueError):
+        elements.parse_obj(write(tmp_path, b'v 0 zero 0\n'))
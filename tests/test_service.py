@@ -0,0 +1,69 @@
+# Description
+'''
+Render Service Tests
+
+Closes a RenderService while a job is rendering: close must return, the job must fail with
+RenderStopped and no shared memory (Lense snapshot, Framebuffer) may be left behind.
+'''
+
+# Imports
+import asyncio, os, sys, threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import camera
+from scheduler import RenderStopped
+from service import RenderService
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+RESOLUTION = {'width': 320, 'height': 240}     # rendering takes seconds on the python backend
+TIMEOUT = 60.0
+SHM_DIRECTORY = '/dev/shm'
+
+
+# -----  Helpers  -------------------------------------------------------------------------------------- #
+
+def segments():
+    return set(os.listdir(SHM_DIRECTORY)) if os.path.isdir(SHM_DIRECTORY) else set()
+
+def run(coroutine):
+    ''' asyncio.run(coroutine) in a thread, fails instead of hanging after TIMEOUT '''
+    outcome = {}
+    def target():
+        try:
+            outcome['result'] = asyncio.run(coroutine)
+        except BaseException as error:
+            outcome['error'] = error
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'asyncio.run did not return'
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+# -----  Tests  ---------------------------------------------------------------------------------------- #
+
+def test_close_while_rendering():
+    before = segments()
+
+    async def main():
+        lense, scene = camera.build_scenes()['sc1']
+        service = RenderService(processes=2)
+        await service.start()
+        job = await service.submit(lense, scene, RESOLUTION)
+        async for state, done, total in job.events():
+            if state == 'render' and done > 0:
+                break
+        await service.close()
+        assert job.state == 'failed'
+        with pytest.raises(RenderStopped):
+            await job
+        return service
+
+    service = run(main())
+    assert service.pool is None and not service.threads
+    assert segments() <= before
@@ -0,0 +1,117 @@
+# Description
+'''
+Streamed Image Writers
+
+Encode a (height, width, 3) uint8 array (usually the pixels of a DiskFramebuffer) a few
+rows or Tiles at a time, so memory use does not grow with the image size - unlike PIL, which
+needs the whole image as one more copy in memory.
+'''
+
+# Imports
+import os, struct, zlib
+import numpy
+
+__author__ = 'Jan Ningelgen'
+
+# Constants
+PNG_ROWS = 64               # rows compressed at once
+PNG_LEVEL = 6               # zlib level
+TIFF_TILE = 256             # edge length of the TIFF Tiles (multiple of 16)
+STREAMED_FORMATS = ('.png', '.tif', '.tiff')
+
+
+def check_streamed(filename):
+    ''' Raises a ValueError unless write_image can write filename '''
+    if os.path.splitext(filename)[1].lower() not in STREAMED_FORMATS:
+        raise ValueError('can not stream %s, use one of %s' %(filename, ', '.join(STREAMED_FORMATS)))
+
+def write_image(pixels, filename, release=None):
+    ''' Writes pixels as PNG or tiled TIFF depending on the extension of filename
+
+        release(y0, y1) is called once rows [y0:y1] are written (see DiskFramebuffer.release) '''
+    check_streamed(filename)
+    if os.path.splitext(filename)[1].lower() == '.png':
+        write_png(pixels, filename, release=release)
+    else:
+        write_tiff(pixels, filename, release=release)
+
+
+# -----  PNG  ------------------------------------------------------------------------------------------ #
+
+def write_png(pixels, filename, rows=PNG_ROWS, level=PNG_LEVEL, release=None):
+    ''' 8 bit RGB PNG, rows with the Sub filter, PNG_ROWS rows per IDAT chunk '''
+    height, width = pixels.shape[:2]
+    compressor = zlib.compressobj(level)
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for y in range(0, height, rows):
+            block = numpy.asarray(pixels[y:y + rows], dtype=numpy.uint8).reshape(-1, width * 3)
+            filtered = numpy.empty((len(block), width * 3 + 1), dtype=numpy.uint8)
+            filtered[:, 0] = 1                                                  # Sub: difference to the pixel on the left
+            filtered[:, 1:4] = block[:, :3]
+            filtered[:, 4:] = block[:, 3:] - block[:, :-3]                      # uint8 wraps around like PNG expects
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                write_chunk(f, b'IDAT', data)
+            if release is not None:
+                release(y, y + rows)
+        write_chunk(f, b'IDAT', compressor.flush())
+        write_chunk(f, b'IEND', b'')
+
+def write_chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+
+# -----  TIFF  ----------------------------------------------------------------------------------------- #
+
+def write_tiff(pixels, filename, tile=TIFF_TILE, level=PNG_LEVEL, release=None):
+    ''' Tiled 8 bit RGB TIFF (deflate compressed), one Tile in memory at a time
+
+        Classic TIFF uses 32 bit offsets, so the compressed file must stay below 4 GB. '''
+    height, width = pixels.shape[:2]
+    offsets, counts = [], []
+    with open(filename, 'wb') as f:
+        f.write(b'II*\x00\x00\x00\x00\x00')                                     # IFD offset patched below
+        for y in range(0, height, tile):
+            for x in range(0, width, tile):
+                block = numpy.zeros((tile, tile, 3), dtype=numpy.uint8)         # edge Tiles are padded
+                part = pixels[y:y + tile, x:x + tile]
+                block[:part.shape[0], :part.shape[1]] = part
+                data = zlib.compress(block.tobytes(), level)
+                offsets.append(f.tell())
+                counts.append(len(data))
+                f.write(data)
+                if f.tell() & 1:
+                    f.write(b'\x00')                                            # TIFF values start at word boundaries
+            if release is not None:
+                release(y, y + tile)
+
+        # values not fitting into an IFD entry follow the Tiles
+        bits = f.tell()
+        f.write(struct.pack('<3H', 8, 8, 8))
+        offsets_at = f.tell()
+        f.write(struct.pack('<%dI' %(len(offsets)), *offsets))
+        counts_at = f.tell()
+        f.write(struct.pack('<%dI' %(len(counts)), *counts))
+        if f.tell() > 0xffffffff:
+            raise ValueError('%s exceeds the 4 GB limit of classic TIFF' %(filename))
+
+        single = len(offsets) == 1
+        entries = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 3, bits), (259, 3, 1, 8), (262, 3, 1, 2),
+                   (277, 3, 1, 3), (284, 3, 1, 1), (322, 3, 1, tile), (323, 3, 1, tile),
+                   (324, 4, len(offsets), offsets[0] if single else offsets_at),
+                   (325, 4, len(counts), counts[0] if single else counts_at)]
+        ifd = f.tell()
+        f.write(struct.pack('<H', len(entries)))
+        for tag, kind, count, value in entries:
+            if kind == 3 and count == 1:
+                f.write(struct.pack('<HHIHH', tag, kind, count, value, 0))
+            else:
+                f.write(struct.pack('<HHII', tag, kind, count, value))
+        f.write(struct.pack('<I', 0))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd))